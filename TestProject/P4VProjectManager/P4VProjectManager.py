@@ -7,11 +7,32 @@ import logging
 from pathlib import Path
 from datetime import datetime
 from typing import Dict, List, Optional, Set, Tuple
+from concurrent.futures import Future
 from dataclasses import dataclass
-from enum import Enum
 import threading
 import re
 import queue
+import tempfile
+
+from build_history import BuildHistory
+from resource_monitor import ResourceLimits, ResourceMonitor, SyncEstimate, preview_sync
+from sync_retry import RetryPolicy, SyncRetryManager
+from process_supervisor import ProcessSupervisor
+from build_logs import BuildLogStore
+from build_agents import AgentCoordinator
+from task_table import ProjectStatus, ProjectTask, TaskTable
+from content_cache import LINK_MODES, ContentCache
+from build_bisect import BisectSession, BuildBisector
+from control_api import ControlServer
+from task_executor import ExecutorBusy, TaskExecutor
+from tick_profiler import PROFILER, timed
+from notifications import EVENTS, SINK_CLASSES, Notification, NotificationManager
+from p4_servers import DEFAULT_SERVER, P4Server, P4ServerPool
+from workspace_verify import HAVE_FIELDS, HaveFile, WorkspaceVerifier, parse_have_list
+from artifact_store import ArtifactStore, PublishSession
+from presubmit import CLONE_MODES, PresubmitJob, PresubmitRunner, list_shelved_changes
+from sync_sharing import SHARE_MODES, SyncGroup, WorkspaceFanout, depot_relative, find_sync_groups
+from window_status import COMPLETED, FAILED, IDLE, RUNNING, StatusReader
 
 # 配置日志
 logging.basicConfig(
@@ -25,17 +46,6 @@ logging.basicConfig(
 logger = logging.getLogger('P4VProjectManager')
 
 
-class ProjectStatus(Enum):
-    """项目状态枚举"""
-    IDLE = "idle"  # 空闲
-    PENDING_SYNC = "pending_sync"  # 等待同步
-    SYNCING = "syncing"  # 正在同步
-    PENDING_BUILD = "pending_build"  # 等待构建
-    BUILDING = "building"  # 正在构建
-    COMPLETED = "completed"  # 完成
-    FAILED = "failed"  # 失败
-
-
 @dataclass
 class ProjectWindow:
     """项目窗口信息"""
@@ -44,22 +54,15 @@ class ProjectWindow:
     command_file: Path  # 命令文件，用于传递新的构建命令
     status_file: Path  # 状态文件，用于读取构建状态
     main_batch_file: Path  # 主批处理文件（持续运行的）
+    log_dir_file: Path  # 日志目录文件，用于传递本次构建的日志目录
+    status_reader: StatusReader  # 状态记录读取器
     build_status: str = "idle"  # 构建状态
+    build_seq: int = 0  # 发出构建命令时已读到的状态序号
     last_build_time: float = 0
     current_script: str = ""
-
-
-@dataclass
-class ProjectTask:
-    """项目任务信息"""
-    project_name: str
-    depot_path: str
-    local_path: str
-    version: str
-    status: ProjectStatus = ProjectStatus.IDLE
-    sync_start_time: float = 0
-    build_start_time: float = 0
-    last_update_time: float = 0
+    script_start_time: float = 0  # 当前脚本开始时间
+    reclaiming: bool = False  # 超时后进程树尚未确认结束
+    build_log_dir: Optional[Path] = None  # 本次构建的日志目录
 
 
 @dataclass
@@ -70,11 +73,31 @@ class SyncProgress:
     current_file: str = ""
     bytes_transferred: int = 0
     current_action: str = ""  # updating, added, deleted
+    estimated_bytes: int = 0  # 同步前预估的传输量
     errors: List[str] = None
+    planned_files: Dict[str, int] = None  # 同步计划 {"//depot/file#rev": 文件大小}
+    synced_files: Set[str] = None  # 已完成的文件 "//depot/file#rev"
+    client_files: Dict[str, str] = None  # 同步计划中文件的本地路径 {"//depot/file#rev": 本地路径}
 
     def __post_init__(self):
         if self.errors is None:
             self.errors = []
+        if self.planned_files is None:
+            self.planned_files = {}
+        if self.synced_files is None:
+            self.synced_files = set()
+        if self.client_files is None:
+            self.client_files = {}
+
+
+@dataclass
+class FanoutJob:
+    """后台进行中的共享同步分发"""
+    leader: str
+    future: Future
+    cancelled: threading.Event
+    previous_status: ProjectStatus  # 分发前的状态，没有需要更新的内容时恢复
+    start_time: float
 
 
 class P4VProjectManager:
@@ -94,21 +117,31 @@ class P4VProjectManager:
         self.default_check_interval = 300
         self.build_timeout = 10800  # 默认3小时超时
         self.sync_timeout = 7200  # 同步超时2小时
+        self.max_parallel_builds = 0  # 0表示不限制
+        self.schedule_policy = "fifo"  # 调度策略: fifo / shortest_first / deadline
+        self.priority_aging = 600  # 等待多少秒提升一级优先级，0表示不提升
+        self.sync_preemption: Dict = {}  # 高优先级项目抢占正在进行的同步
+        self.sync_sharing: Dict = {}  # depot路径重叠的项目共享同步
 
         # 每个项目的CMD窗口
         self.project_windows: Dict[str, ProjectWindow] = {}
 
-        # 项目任务状态
-        self.project_tasks: Dict[str, ProjectTask] = {}
+        # 项目任务状态（按状态建立索引，调度时只访问相关状态的项目）
+        self.project_tasks = TaskTable()
 
         # 当前正在同步的项目
         self.current_sync_project: Optional[str] = None
         self.sync_process: Optional[subprocess.Popen] = None
         self.sync_thread: Optional[threading.Thread] = None
+        self.sync_prefill: Optional[Future] = None  # 同步前从本地缓存放置文件（io线程中执行）
+        self.prefill_cancel: Optional[threading.Event] = None  # 设置后放置在下一个文件之前停止
+        self.abandoned_prefills: Dict[str, Future] = {}  # 已取消但尚未结束的放置，结束前不开始该项目的同步
         self.sync_progress: SyncProgress = SyncProgress()
 
         # 记录项目的最后同步版本
         self.last_sync_versions: Dict[str, str] = {}
+        # 通过控制接口取消同步的版本，有更新的变更之前不再自动同步 {项目: 版本}
+        self.skipped_versions: Dict[str, str] = {}
 
         # 测试模式下的构建计数
         self.test_build_count: Dict[str, int] = {}
@@ -116,6 +149,187 @@ class P4VProjectManager:
         # 加载并验证配置
         self.load_and_validate_config()
 
+        # 构建历史（用于预估耗时和调度）
+        history_file = self.config.get('history_file',
+                                       str(Path(self.config_path).parent / 'build_history.json'))
+        self.history = BuildHistory(Path(history_file), self.config.get('history_samples', 50),
+                                    self.config.get('history_flush_interval', 30))
+        # 正在后台写入的构建历史
+        self.history_flush: Optional[Future] = None
+
+        # 主机资源监控（磁盘空间、磁盘/网络吞吐量）
+        self.resource_monitor = ResourceMonitor(
+            ResourceLimits.from_config(self.config.get('resource_limits', {})))
+        # 同步预估缓存 {项目: (版本, 预估)}
+        self.sync_estimates: Dict[str, Tuple[str, Optional[SyncEstimate]]] = {}
+        # 正在后台进行的同步预估 {项目: (版本, Future)}
+        self.estimate_futures: Dict[str, Tuple[str, Future]] = {}
+        # 被推迟的同步 {项目: 首次推迟的时间}
+        self.sync_deferrals: Dict[str, float] = {}
+        # 因磁盘空间不足推迟同步时最近一次警告的时间 {项目: 时间}
+        self.free_space_warnings: Dict[str, float] = {}
+
+        # 主循环性能分析：阶段计时（可选）和按需采集（SIGUSR1/SIGUSR2 或控制接口）
+        profiling_config = self.config.get('profiling', {})
+        self.profiler = PROFILER
+        self.profiler.configure(profiling_config, Path(self.config_path).parent / 'profiles')
+        self.profiler.install_signal_handlers(profiling_config.get('capture_seconds', 30))
+
+        # 后台任务执行器：解析、哈希等CPU密集的任务放到进程池，压缩等I/O任务放到线程池，不占用主循环
+        executor_config = self.config.get('executor', {})
+        self.executor = TaskExecutor(
+            cpu_workers=executor_config.get('cpu_workers', 0),
+            io_workers=executor_config.get('io_workers', 4),
+            max_queue=executor_config.get('max_queue', 64),
+            use_processes=executor_config.get('processes', True)
+        )
+
+        # 正在服务器线程中执行的检查更新 {项目: Future}
+        self.poll_futures: Dict[str, Future] = {}
+        self.forced_syncs: Set[str] = set()  # 通过控制接口要求立即同步、正在查询最新版本的项目
+        # 正在进行的同步占用的服务器名额
+        self.sync_server: Optional[P4Server] = None
+
+        # 工作区校验和修复：按索引只重新计算变化过的文件，只重新同步不一致的文件
+        verify_config = self.config.get('workspace_verify', {})
+        self.verifier = WorkspaceVerifier(
+            self.executor,
+            Path(verify_config.get('index_dir', str(Path(self.config_path).parent / 'workspace_index'))),
+            batch_size=verify_config.get('batch_size', 256),
+            timeout=verify_config.get('timeout', self.sync_timeout)
+        )
+        # 每个项目最近一次校验的结果
+        self.verify_results: Dict[str, Dict] = {}
+
+        # 同步失败重试（指数退避，续传未完成的文件）
+        self.sync_retry = SyncRetryManager(RetryPolicy.from_config(self.config.get('sync_retry', {})))
+
+        # 本地文件内容缓存：已下载过的文件版本直接从本地放到工作区
+        cache_config = self.config.get('content_cache', {})
+        self.content_cache: Optional[ContentCache] = None
+        if cache_config.get('enabled', False):
+            self.content_cache = ContentCache(
+                Path(cache_config.get('dir', str(Path(self.config_path).parent / 'p4_cache'))),
+                int(cache_config.get('max_size_mb', 20480) * 1024 * 1024),
+                cache_config.get('link_mode', 'reflink')
+            )
+        self.client_line_ends: Dict[str, str] = {}  # {项目: 工作区的LineEnd}，缓存键的一部分
+
+        # 共享同步：depot路径相同或嵌套的项目只同步一次，再分发给其他项目
+        self.sync_groups: Dict[str, SyncGroup] = {}
+        self.sync_leaders: Dict[str, str] = {}  # {follower项目: 主项目}
+        self.fanout = WorkspaceFanout(self.sync_sharing.get('mode', 'copy'))
+        # 忙碌的follower推迟分发 {follower项目: 模拟同步记录的depot文件（只在测试模式下使用）}
+        self.deferred_fanouts: Dict[str, Set[str]] = {}
+        self.fanout_jobs: Dict[str, FanoutJob] = {}  # 后台进行中的分发 {follower项目: 分发任务}
+        self.detect_sync_sharing()
+
+        # 构建日志（每次构建、每个脚本一个日志文件）
+        log_config = self.config.get('build_logs', {})
+        self.log_store = BuildLogStore(
+            Path(log_config.get('dir', str(Path(self.config_path).parent / 'build_logs'))),
+            keep_uncompressed=log_config.get('keep_uncompressed', 5),
+            retention_builds=log_config.get('retention_builds', 50),
+            index_stride=log_config.get('index_stride', 1000),
+            **({'error_pattern': log_config['error_pattern']} if 'error_pattern' in log_config else {})
+        )
+
+        # 构建窗口和同步进程的进程树监管
+        self.supervisor = ProcessSupervisor(self.config.get('kill_timeout', 10))
+
+        # 构建失败后在上次成功和失败的版本之间二分定位引入问题的变更
+        bisect_config = self.config.get('bisect', {})
+        self.bisector: Optional[BuildBisector] = None
+        if bisect_config.get('enabled', False):
+            self.bisector = BuildBisector(
+                self.supervisor,
+                Path(bisect_config.get('results_file',
+                                       str(Path(self.config_path).parent / 'bisect_results.json'))),
+                max_probes=bisect_config.get('max_probes', 12),
+                probe_timeout=bisect_config.get('probe_timeout', self.build_timeout)
+            )
+
+        # 构建产物发布：按块去重、压缩后保存到本地产物仓库
+        artifacts_config = self.config.get('artifacts', {})
+        self.artifacts: Optional[ArtifactStore] = None
+        if artifacts_config.get('enabled', False):
+            self.artifacts = ArtifactStore(
+                Path(artifacts_config.get('dir', str(Path(self.config_path).parent / 'artifacts'))),
+                self.executor,
+                chunk_size=int(artifacts_config.get('chunk_size_mb', 4) * 1024 * 1024),
+                level=artifacts_config.get('compression_level', 6),
+                keep_builds=artifacts_config.get('keep_builds', 10),
+                max_bytes=int(artifacts_config.get('max_size_mb', 0) * 1024 * 1024)
+            )
+        # 每个项目最近一次发布的结果
+        self.publish_results: Dict[str, Dict] = {}
+
+        # 预提交构建：带标记的搁置变更在克隆的临时工作区中构建，只使用空闲的构建槽位
+        presubmit_config = self.config.get('presubmit', {})
+        self.presubmit: Optional[PresubmitRunner] = None
+        self.presubmit_tag = presubmit_config.get('tag', '[presubmit]')
+        self.presubmit_interval = presubmit_config.get('check_interval', 120)
+        self.presubmit_max_builds = presubmit_config.get('max_builds', 1)
+        if presubmit_config.get('enabled', False) and not self.test_mode:
+            self.presubmit = PresubmitRunner(
+                self.supervisor,
+                self.log_store,
+                Path(presubmit_config.get('scratch_dir',
+                                          str(Path(self.config_path).parent / 'presubmit_workspaces'))),
+                Path(presubmit_config.get('results_file',
+                                          str(Path(self.config_path).parent / 'presubmit_results.json'))),
+                clone_mode=presubmit_config.get('clone_mode', 'copy'),
+                build_timeout=presubmit_config.get('build_timeout', self.build_timeout),
+                keep_results=presubmit_config.get('keep_results', 200)
+            )
+        # 等待构建的搁置变更、正在服务器线程中执行的查询 {项目: Future} 和下次查询的时间
+        self.presubmit_queue: List[PresubmitJob] = []
+        self.presubmit_polls: Dict[str, Future] = {}
+        self.presubmit_next_check = 0.0
+
+        # 分布式构建：协调器把构建分派给已注册的构建代理
+        distributed_config = self.config.get('distributed', {})
+        self.coordinator: Optional[AgentCoordinator] = None
+        self.local_builds = distributed_config.get('local_builds', True)  # 没有可用代理时是否在本机构建
+        # 没有配置共享令牌时不启动（配置验证会报告错误）
+        if distributed_config.get('enabled', False) and distributed_config.get('token'):
+            self.coordinator = AgentCoordinator(
+                distributed_config.get('host', '127.0.0.1'),
+                distributed_config.get('port', 7010),
+                distributed_config.get('heartbeat_timeout', 30),
+                token=str(distributed_config['token'])
+            )
+            self.coordinator.start()
+        # 分派到代理的构建 {项目: 任务ID}
+        self.remote_builds: Dict[str, str] = {}
+        # 代理上正在执行的脚本 {项目: 脚本名}
+        self.remote_scripts: Dict[str, str] = {}
+
+        # 构建通知：只在主循环中入队，由各渠道的线程批量发送和重试
+        notification_config = self.config.get('notifications', {})
+        self.notifier: Optional[NotificationManager] = None
+        if notification_config.get('enabled', False):
+            self.notifier = NotificationManager.from_config(notification_config)
+
+        # 暂停的项目：不检查更新，也不开始新的同步或构建（正在进行的任务继续）
+        self.paused_projects: Set[str] = set()
+
+        # 控制接口：以JSON提供状态快照，接收强制同步/构建、取消、暂停和调整优先级的命令
+        api_config = self.config.get('control_api', {})
+        self.control_api: Optional[ControlServer] = None
+        # 每个项目的状态快照，只在项目变化或处于活动状态时重新生成
+        self.project_snapshots: Dict[str, Dict] = {}
+        if api_config.get('enabled', False):
+            self.control_api = ControlServer(
+                api_config.get('host', '127.0.0.1'),
+                api_config.get('port', 7020),
+                api_config.get('command_timeout', 10),
+                profiler=self.profiler,
+                log_store=self.log_store,
+                token=api_config.get('token')
+            )
+            self.control_api.start()
+
         # 初始化所有项目的CMD窗口
         self.initialize_project_windows()
 
@@ -146,6 +360,13 @@ class P4VProjectManager:
         self.default_check_interval = self.config.get('default_check_interval', 300)
         self.build_timeout = self.config.get('build_timeout', 10800)
         self.sync_timeout = self.config.get('sync_timeout', 7200)
+        self.max_parallel_builds = self.config.get('max_parallel_builds', 0)
+        self.schedule_policy = self.config.get('schedule_policy', 'fifo')
+        self.priority_aging = self.config.get('priority_aging', 600)
+        self.sync_preemption = self.config.get('sync_preemption', {})
+        self.sync_sharing = self.config.get('sync_sharing', {})
+        # Perforce服务器：每个项目的连接设置，以及每个服务器的并发和速率限制
+        self.p4_servers = P4ServerPool(self.config.get('p4_servers', {}), self.projects)
 
         # 设置日志级别
         log_level = self.config.get('log_level', 'INFO')
@@ -157,6 +378,13 @@ class P4VProjectManager:
         logger.info(f"- 默认检查间隔: {self.default_check_interval}秒")
         logger.info(f"- 构建超时时间: {self.build_timeout}秒")
         logger.info(f"- 同步超时时间: {self.sync_timeout}秒")
+        logger.info(f"- 最大并行构建数: {self.max_parallel_builds or '不限制'}")
+        logger.info(f"- 调度策略: {self.schedule_policy}")
+        logger.info(f"- 优先级老化: {f'每 {self.priority_aging} 秒提升一级' if self.priority_aging else '关闭'}")
+        if len(self.p4_servers.in_use()) > 1:
+            logger.info(f"- Perforce服务器: {', '.join(server.name for server in self.p4_servers.in_use())}")
+        if self.sync_preemption.get('enabled'):
+            logger.info(f"- 同步抢占: 优先级高出 {self.sync_preemption.get('priority_gap', 1)} 级")
 
         # 验证配置
         self.validate_configuration()
@@ -224,6 +452,118 @@ class P4VProjectManager:
                 if depot_path and not depot_path.startswith('//'):
                     warnings.append(f"项目 {project_name} 的depot路径格式可能不正确: {depot_path}")
 
+            # 检查截止时间
+            deadline = project_config.get('deadline')
+            if deadline is not None and (not isinstance(deadline, (int, float)) or deadline <= 0):
+                errors.append(f"项目 {project_name} 的deadline必须是正数（秒）: {deadline}")
+
+            # 检查Perforce服务器
+            server_name = project_config.get('server', DEFAULT_SERVER)
+            if server_name not in self.p4_servers.servers:
+                errors.append(f"项目 {project_name} 的server未在p4_servers中配置: {server_name}")
+
+            # 检查优先级
+            priority = project_config.get('priority', 0)
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                errors.append(f"项目 {project_name} 的priority必须是整数: {priority}")
+
+        # 检查调度策略
+        if self.schedule_policy not in ('fifo', 'shortest_first', 'deadline'):
+            errors.append(f"未知的调度策略: {self.schedule_policy}")
+        if not isinstance(self.priority_aging, (int, float)) or self.priority_aging < 0:
+            errors.append(f"priority_aging必须是非负数（秒）: {self.priority_aging}")
+        flush_interval = self.config.get('history_flush_interval', 30)
+        if not isinstance(flush_interval, (int, float)) or isinstance(flush_interval, bool) or flush_interval < 0:
+            errors.append(f"history_flush_interval必须是非负数（秒）: {flush_interval}")
+        if self.sync_sharing.get('mode', 'copy') not in SHARE_MODES:
+            errors.append(f"未知的共享同步方式: {self.sync_sharing.get('mode')}")
+        if self.config.get('content_cache', {}).get('link_mode', 'reflink') not in LINK_MODES:
+            errors.append(f"未知的文件缓存放置方式: {self.config['content_cache'].get('link_mode')}")
+        for index, sink_config in enumerate(self.config.get('notifications', {}).get('sinks', [])):
+            sink_type = sink_config.get('type')
+            if sink_type not in SINK_CLASSES:
+                errors.append(f"通知渠道 #{index + 1} 的类型未知: {sink_type}")
+                continue
+            required = {'webhook': 'url', 'smtp': 'to', 'file': 'dir'}[sink_type]
+            if not sink_config.get(required):
+                errors.append(f"通知渠道 #{index + 1} ({sink_type}) 缺少 {required}")
+            unknown_events = set(sink_config.get('events', [])) - set(EVENTS)
+            if unknown_events:
+                errors.append(f"通知渠道 #{index + 1} 订阅了未知的事件: {', '.join(sorted(unknown_events))}")
+
+        for server_name, server_config in self.config.get('p4_servers', {}).items():
+            for key, minimum in (('max_concurrent', 1), ('burst', 0)):
+                value = server_config.get(key, minimum)
+                if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                    errors.append(f"p4_servers.{server_name}.{key}必须是不小于{minimum}的整数: {value}")
+            rate = server_config.get('rate', 0)
+            if not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate < 0:
+                errors.append(f"p4_servers.{server_name}.rate必须是非负数（每秒命令数）: {rate}")
+
+        retry_config = self.config.get('sync_retry', {})
+        max_retries = retry_config.get('max_retries', 5)
+        if not isinstance(max_retries, int) or isinstance(max_retries, bool) or max_retries < 1:
+            errors.append(f"sync_retry.max_retries必须是正整数: {max_retries}")
+        for key in ('base_delay', 'max_delay', 'jitter'):
+            value = retry_config.get(key, 0)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                errors.append(f"sync_retry.{key}必须是非负数: {value}")
+        if not isinstance(retry_config.get('resume', True), bool):
+            errors.append(f"sync_retry.resume必须是true或false: {retry_config['resume']!r}")
+
+        executor_config = self.config.get('executor', {})
+        for key, minimum in (('cpu_workers', 0), ('io_workers', 1), ('max_queue', 1)):
+            value = executor_config.get(key, minimum)
+            if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                errors.append(f"executor.{key}必须是不小于{minimum}的整数: {value}")
+        artifacts_config = self.config.get('artifacts', {})
+        keep_builds = artifacts_config.get('keep_builds', 10)
+        if not isinstance(keep_builds, int) or isinstance(keep_builds, bool) or keep_builds < 1:
+            errors.append(f"artifacts.keep_builds必须是正整数: {keep_builds}")
+        level = artifacts_config.get('compression_level', 6)
+        if not isinstance(level, int) or isinstance(level, bool) or not 1 <= level <= 9:
+            errors.append(f"artifacts.compression_level必须是1-9的整数: {level}")
+        chunk_size = artifacts_config.get('chunk_size_mb', 4)
+        if not isinstance(chunk_size, (int, float)) or isinstance(chunk_size, bool) or chunk_size <= 0:
+            errors.append(f"artifacts.chunk_size_mb必须是正数: {chunk_size}")
+        for project_name, project_config in self.projects.items():
+            patterns = project_config.get('artifacts', [])
+            if not isinstance(patterns, list) or not all(isinstance(item, str) and item for item in patterns):
+                errors.append(f"项目 {project_name} 的artifacts必须是glob字符串列表")
+        presubmit_config = self.config.get('presubmit', {})
+        if presubmit_config.get('clone_mode', 'copy') not in CLONE_MODES:
+            errors.append(f"未知的预提交工作区克隆方式: {presubmit_config.get('clone_mode')}")
+        for project_name, project_config in self.projects.items():
+            scripts = project_config.get('presubmit_scripts', [])
+            if not isinstance(scripts, list) or not all(isinstance(item, str) and item for item in scripts):
+                errors.append(f"项目 {project_name} 的presubmit_scripts必须是脚本名列表")
+                continue
+            for script in scripts:
+                script_file = Path(project_config.get('scripts_path', '')) / script
+                if not script_file.exists():
+                    errors.append(f"项目 {project_name} 的预提交脚本不存在: {script_file}")
+        presubmit_builds = presubmit_config.get('max_builds', 1)
+        if not isinstance(presubmit_builds, int) or isinstance(presubmit_builds, bool) or presubmit_builds < 1:
+            errors.append(f"presubmit.max_builds必须是正整数: {presubmit_builds}")
+        presubmit_tag = presubmit_config.get('tag', '[presubmit]')
+        if not isinstance(presubmit_tag, str) or not presubmit_tag.strip():
+            errors.append(f"presubmit.tag必须是非空字符串: {presubmit_tag!r}")
+        verify_batch = self.config.get('workspace_verify', {}).get('batch_size', 256)
+        if not isinstance(verify_batch, int) or isinstance(verify_batch, bool) or verify_batch < 1:
+            errors.append(f"workspace_verify.batch_size必须是正整数: {verify_batch}")
+        capture_seconds = self.config.get('profiling', {}).get('capture_seconds', 30)
+        if not isinstance(capture_seconds, (int, float)) or capture_seconds <= 0:
+            errors.append(f"profiling.capture_seconds必须是正数: {capture_seconds}")
+        distributed_config = self.config.get('distributed', {})
+        if distributed_config.get('enabled', False) and not distributed_config.get('token'):
+            errors.append("启用distributed时必须配置共享令牌distributed.token")
+        api_token = self.config.get('control_api', {}).get('token')
+        if api_token is not None and (not isinstance(api_token, str) or not api_token):
+            errors.append("控制接口的token必须是非空字符串")
+        api_port = self.config.get('control_api', {}).get('port', 7020)
+        if not isinstance(api_port, int) or isinstance(api_port, bool) or not 0 <= api_port <= 65535:
+            errors.append(f"控制接口端口无效: {api_port}")
+
         # 输出验证结果
         logger.info("-" * 60)
         if warnings:
@@ -241,27 +581,58 @@ class P4VProjectManager:
         logger.info("-" * 60)
 
     def check_p4_connection(self) -> bool:
-        """检查P4连接是否正常"""
-        try:
-            result = subprocess.run(
-                'p4 info',
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            if result.returncode == 0:
-                logger.info("  ✓ Perforce连接正常")
-                return True
-            else:
-                logger.error(f"  ✗ Perforce连接失败: {result.stderr}")
-                return False
-        except subprocess.TimeoutExpired:
-            logger.error("  ✗ Perforce连接超时")
-            return False
-        except Exception as e:
-            logger.error(f"  ✗ 检查Perforce连接时出错: {e}")
-            return False
+        """检查项目使用的每个Perforce服务器的连接是否正常"""
+        connected = True
+        for server in self.p4_servers.in_use():
+            label = f"Perforce连接 ({server.name}: {server.port})" if server.port else "Perforce连接"
+            try:
+                result = subprocess.run(
+                    'p4 info',
+                    shell=True,
+                    capture_output=True,
+                    text=True,
+                    env=self.p4_servers.server_env(server.name),
+                    timeout=10
+                )
+                if result.returncode == 0:
+                    logger.info(f"  ✓ {label}正常")
+                else:
+                    logger.error(f"  ✗ {label}失败: {result.stderr}")
+                    connected = False
+            except subprocess.TimeoutExpired:
+                logger.error(f"  ✗ {label}超时")
+                connected = False
+            except Exception as e:
+                logger.error(f"  ✗ 检查{label}时出错: {e}")
+                connected = False
+        return connected
+
+    def detect_sync_sharing(self):
+        """检测depot路径相同或嵌套的项目，启用共享同步时建立主项目与follower的关系"""
+        # 不同服务器上相同的depot路径是不同的内容，只在同一服务器的项目之间共享
+        groups: Dict[str, SyncGroup] = {}
+        for names in self.p4_servers.group_by_server(list(self.projects)).values():
+            groups.update(find_sync_groups({name: self.projects[name] for name in names}))
+        if not groups:
+            return
+
+        if not self.sync_sharing.get('enabled', False):
+            for group in groups.values():
+                logger.info(f"项目 {group.leader} 的depot路径包含 {', '.join(group.followers)}，"
+                            f"可启用 sync_sharing 共享同步")
+            return
+
+        mode = self.fanout.mode
+        logger.info(f"共享同步 ({mode}):")
+        for leader, group in groups.items():
+            logger.info(f"  {leader} -> {', '.join(group.followers)}")
+            for follower, (_, subdir) in group.followers.items():
+                self.sync_leaders[follower] = leader
+                if mode == 'shared':
+                    # 共用主项目的工作区：follower直接在主项目工作区的子目录中构建
+                    leader_local = self.projects[leader].get('local_path', '')
+                    self.projects[follower]['local_path'] = str(Path(leader_local) / subdir) if leader_local else ''
+        self.sync_groups = groups
 
     def initialize_project_windows(self):
         """为每个项目初始化CMD窗口"""
@@ -270,73 +641,10 @@ class P4VProjectManager:
 
         for project_name, project_config in self.projects.items():
             try:
-                scripts_path = Path(project_config['scripts_path'])
-
-                # 确保脚本路径存在
-                if not scripts_path.exists():
-                    logger.error(f"脚本路径不存在: {scripts_path}")
-                    continue
-
-                # 创建控制文件路径
-                command_file = scripts_path / f"_command_{project_name}.txt"
-                status_file = scripts_path / f"_status_{project_name}.txt"
-                main_batch_file = scripts_path / f"_monitor_{project_name}.bat"
-
-                # 清理旧文件
-                for file_path in [command_file, status_file]:
-                    if file_path.exists():
-                        try:
-                            file_path.unlink()
-                        except Exception as e:
-                            logger.warning(f"无法删除文件 {file_path}: {e}")
-
-                # 创建初始命令文件
-                try:
-                    command_file.write_text("WAIT", encoding='utf-8')
-                except Exception as e:
-                    logger.error(f"无法创建命令文件 {command_file}: {e}")
+                project_window = self.launch_project_window(project_name, project_config)
+                if project_window is None:
                     continue
 
-                # 创建主批处理文件（持续运行的监控脚本）
-                try:
-                    self.create_monitor_batch(main_batch_file, project_name, project_config,
-                                              command_file, status_file)
-                except Exception as e:
-                    logger.error(f"无法创建批处理文件 {main_batch_file}: {e}")
-                    continue
-
-                # 启动CMD窗口
-                window_title = f"P4V Monitor: {project_name}"
-                cmd_command = f'start "{window_title}" cmd /k "{main_batch_file}"'
-
-                try:
-                    process = subprocess.Popen(
-                        cmd_command,
-                        shell=True,
-                        cwd=str(scripts_path),
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        stdin=subprocess.DEVNULL,
-                        creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == 'nt' else 0
-                    )
-
-                    # 等待一下确保窗口启动
-                    time.sleep(0.5)
-
-                except Exception as e:
-                    logger.error(f"无法启动项目 {project_name} 的CMD窗口: {e}")
-                    continue
-
-                # 创建ProjectWindow对象
-                project_window = ProjectWindow(
-                    project_name=project_name,
-                    process=process,
-                    command_file=command_file,
-                    status_file=status_file,
-                    main_batch_file=main_batch_file,
-                    build_status="idle"
-                )
-
                 self.project_windows[project_name] = project_window
                 self.test_build_count[project_name] = 0
 
@@ -348,6 +656,9 @@ class P4VProjectManager:
                     version="",
                     status=ProjectStatus.IDLE
                 )
+                # follower不单独检查更新，由主项目同步后分发
+                if project_name not in self.sync_leaders:
+                    self.project_tasks.schedule_poll(project_name, time.time())
 
                 logger.info(f"✓ 项目 {project_name} 的监控窗口已启动")
 
@@ -358,12 +669,129 @@ class P4VProjectManager:
 
         logger.info("-" * 60)
 
+    @timed('call:launch_window')
+    def launch_project_window(self, project_name: str, project_config: Dict) -> Optional[ProjectWindow]:
+        """
+        创建控制文件并启动项目的CMD窗口
+
+        窗口中的cmd进程直接由管理器启动（而不是通过start命令），并在独立的进程组中运行，
+        这样超时或关闭时可以结束整个进程树。
+
+        Returns:
+            ProjectWindow对象，失败时返回None
+        """
+        scripts_path = Path(project_config['scripts_path'])
+
+        # 确保脚本路径存在
+        if not scripts_path.exists():
+            logger.error(f"脚本路径不存在: {scripts_path}")
+            return None
+
+        # 创建控制文件路径
+        command_file = scripts_path / f"_command_{project_name}.txt"
+        status_file = scripts_path / f"_status_{project_name}.txt"
+        main_batch_file = scripts_path / f"_monitor_{project_name}.bat"
+        log_dir_file = scripts_path / f"_logdir_{project_name}.txt"
+
+        status_reader = StatusReader(status_file)
+
+        # 清理旧文件
+        for file_path in [command_file, status_file, status_reader.temp_file, log_dir_file]:
+            if file_path.exists():
+                try:
+                    file_path.unlink()
+                except Exception as e:
+                    if file_path in (status_file, status_reader.temp_file):
+                        # 旧窗口的记录序号较大，新窗口从1开始会被当作序号倒退，状态一直未知
+                        logger.error(f"无法删除旧的状态文件 {file_path}，放弃启动窗口: {e}")
+                        return None
+                    logger.warning(f"无法删除文件 {file_path}: {e}")
+
+        # 创建初始命令文件
+        try:
+            command_file.write_text("WAIT", encoding='utf-8')
+        except Exception as e:
+            logger.error(f"无法创建命令文件 {command_file}: {e}")
+            return None
+
+        # 创建主批处理文件（持续运行的监控脚本）
+        try:
+            self.create_monitor_batch(main_batch_file, project_name, project_config,
+                                      command_file, status_reader, log_dir_file)
+        except Exception as e:
+            logger.error(f"无法创建批处理文件 {main_batch_file}: {e}")
+            return None
+
+        # 启动CMD窗口（窗口标题由批处理文件设置）
+        try:
+            process = subprocess.Popen(
+                ['cmd', '/k', str(main_batch_file)],
+                cwd=str(scripts_path),
+                **self.supervisor.group_options(
+                    subprocess.CREATE_NEW_CONSOLE if os.name == 'nt' else 0)
+            )
+
+            # 等待一下确保窗口启动
+            time.sleep(0.5)
+
+        except Exception as e:
+            logger.error(f"无法启动项目 {project_name} 的CMD窗口: {e}")
+            return None
+
+        self.supervisor.track(self.window_key(project_name), process)
+
+        # 创建ProjectWindow对象
+        return ProjectWindow(
+            project_name=project_name,
+            process=process,
+            command_file=command_file,
+            status_file=status_file,
+            main_batch_file=main_batch_file,
+            log_dir_file=log_dir_file,
+            status_reader=status_reader,
+            build_status="idle"
+        )
+
+    @staticmethod
+    def window_key(project_name: str) -> str:
+        """项目窗口在进程监管中的名称"""
+        return f"window:{project_name}"
+
+    def reclaim_project_window(self, project_name: str) -> bool:
+        """
+        结束项目窗口的整个进程树（包括正在执行的构建脚本），确认退出后重新启动窗口
+
+        Returns:
+            是否已确认资源释放并重新启动窗口
+        """
+        window = self.project_windows[project_name]
+        if not self.supervisor.kill_tree(self.window_key(project_name)):
+            window.reclaiming = True
+            logger.error(f"项目 {project_name} 的构建进程未能结束，稍后重试")
+            return False
+
+        logger.info(f"项目 {project_name} 的构建进程树已结束，重新启动监控窗口")
+        new_window = self.launch_project_window(project_name, self.projects[project_name])
+        if new_window is None:
+            window.reclaiming = True
+            return False
+
+        self.project_windows[project_name] = new_window
+        return True
+
     def create_monitor_batch(self, batch_file: Path, project_name: str,
                              project_config: Dict, command_file: Path,
-                             status_file: Path):
-        """创建监控批处理文件（持续运行）"""
+                             status_reader: StatusReader, log_dir_file: Path):
+        """
+        创建监控批处理文件（持续运行），每个构建脚本的输出重定向到本次构建的日志目录
+
+        状态通过 WRITE_STATUS 子程序更新：每次写入一行带递增序号的记录（序号 状态 错误码 脚本）到临时文件，
+        再用 move /y 替换状态文件，管理器不会读到写了一半的状态。
+        """
         scripts_path = project_config['scripts_path']
         build_scripts = project_config.get('build_scripts', [])
+        status_file = status_reader.status_file
+        temp_file = status_reader.temp_file
 
         with open(batch_file, 'w', encoding='utf-8') as f:
             f.write('@echo off\n')
@@ -379,6 +807,8 @@ class P4VProjectManager:
             f.write('echo.\n')
             f.write('echo Monitoring for build commands...\n')
             f.write('echo.\n')
+            f.write('set STATUS_SEQ=0\n')
+            f.write(f'call :WRITE_STATUS {IDLE} 0 ""\n')
 
             # 主循环
             f.write(':MAIN_LOOP\n')
@@ -396,29 +826,42 @@ class P4VProjectManager:
             f.write('    echo.\n')
 
             # 更新状态为运行中
-            f.write(f'    echo RUNNING > "{status_file}"\n')
+            f.write('    set "FAILED_SCRIPT="\n')
+            f.write('    set FAILED_CODE=0\n')
+            f.write(f'    call :WRITE_STATUS {RUNNING} 0 ""\n')
 
             # 重置命令文件
             f.write(f'    echo WAIT > "{command_file}"\n')
 
+            # 读取本次构建的日志目录
+            f.write(f'    set /p LOGDIR=<"{log_dir_file}"\n')
+            f.write('    echo Log directory: !LOGDIR!\n')
+
             # 执行所有构建脚本
             for i, script in enumerate(build_scripts, 1):
                 script_full_path = Path(scripts_path) / script
 
+                log_name = BuildLogStore.script_log_name(i, script)
+
                 f.write(f'    echo [{i}/{len(build_scripts)}] Executing: {script}\n')
+                f.write(f'    echo Log: !LOGDIR!\\{log_name}\n')
                 f.write(f'    echo ----------------------------------------\n')
-                f.write(f'    echo RUNNING:{script} > "{status_file}"\n')
+                f.write(f'    call :WRITE_STATUS {RUNNING} 0 "{script}"\n')
 
-                # 执行脚本
-                f.write(f'    call "{script_full_path}" "{project_name}"\n')
+                # 执行脚本，输出写入日志文件
+                f.write(f'    call "{script_full_path}" "{project_name}" > "!LOGDIR!\\{log_name}" 2>&1\n')
 
                 # 检查错误
                 f.write('    if errorlevel 1 (\n')
-                f.write(f'        echo [ERROR] Script {script} failed with error code !errorlevel!\n')
-                f.write(f'        echo ERROR:{script}:!errorlevel! >> "{status_file}"\n')
+                f.write('        set SCRIPT_CODE=!errorlevel!\n')
+                f.write(f'        echo [ERROR] Script {script} failed with error code !SCRIPT_CODE!\n')
+                # 记录第一个失败的脚本，构建结束时写入状态
+                f.write('        if not defined FAILED_SCRIPT (\n')
+                f.write(f'            set "FAILED_SCRIPT={script}"\n')
+                f.write('            set FAILED_CODE=!SCRIPT_CODE!\n')
+                f.write('        )\n')
                 f.write('    ) else (\n')
                 f.write(f'        echo [SUCCESS] Script {script} completed\n')
-                f.write(f'        echo COMPLETED:{script} >> "{status_file}"\n')
                 f.write('    )\n')
                 f.write('    echo.\n')
 
@@ -428,7 +871,11 @@ class P4VProjectManager:
             f.write('    echo End Time: %date% %time%\n')
             f.write('    echo ========================================\n')
             f.write('    echo.\n')
-            f.write(f'    echo IDLE > "{status_file}"\n')
+            f.write('    if defined FAILED_SCRIPT (\n')
+            f.write(f'        call :WRITE_STATUS {FAILED} !FAILED_CODE! "!FAILED_SCRIPT!"\n')
+            f.write('    ) else (\n')
+            f.write(f'        call :WRITE_STATUS {COMPLETED} 0 ""\n')
+            f.write('    )\n')
             f.write('    echo Waiting for next build command...\n')
             f.write('    echo.\n')
 
@@ -441,11 +888,36 @@ class P4VProjectManager:
             # 等待一秒后继续循环
             f.write('timeout /t 1 /nobreak >nul\n')
             f.write('goto MAIN_LOOP\n')
+            f.write('\n')
+
+            # 写入状态记录：参数为 状态 错误码 "脚本"
+            # 管理器正在读取状态文件时替换会失败，稍后重试
+            f.write(':WRITE_STATUS\n')
+            f.write('set /a STATUS_SEQ+=1\n')
+            f.write(f'> "{temp_file}" echo !STATUS_SEQ! %~1 %~2 %~3\n')
+            f.write('set STATUS_RETRY=0\n')
+            f.write(':WRITE_STATUS_MOVE\n')
+            f.write(f'move /y "{temp_file}" "{status_file}" >nul 2>&1\n')
+            f.write('if errorlevel 1 (\n')
+            f.write('    set /a STATUS_RETRY+=1\n')
+            f.write('    if !STATUS_RETRY! lss 10 (\n')
+            f.write('        timeout /t 1 /nobreak >nul\n')
+            f.write('        goto WRITE_STATUS_MOVE\n')
+            f.write('    )\n')
+            f.write('    echo [WARNING] Unable to update status file\n')
+            f.write(')\n')
+            f.write('goto :eof\n')
 
-    def check_perforce_changes(self, depot_path: str) -> Tuple[bool, Optional[str]]:
+    @timed('call:p4 changes')
+    def check_perforce_changes(self, depot_path: str,
+                               env: Optional[Dict[str, str]] = None) -> Tuple[bool, Optional[str]]:
         """
         检查Perforce路径是否有更新
 
+        Args:
+            depot_path: depot路径
+            env: p4命令的环境变量（项目的服务器和工作区），None表示沿用当前环境
+
         Returns:
             (是否有更新, 最新版本号)
         """
@@ -462,6 +934,7 @@ class P4VProjectManager:
                 capture_output=True,
                 text=True,
                 encoding='utf-8',
+                env=env,
                 timeout=30
             )
 
@@ -481,38 +954,86 @@ class P4VProjectManager:
             logger.error(f"检查Perforce更新时出错: {e}")
             return False, None
 
+    def project_check_interval(self, project_name: str) -> float:
+        """项目的检查更新间隔（秒）"""
+        if self.test_mode:
+            return 30  # 测试模式30秒
+        members = [project_name]
+        if project_name in self.sync_groups:
+            # 主项目按组内最短的间隔检查
+            members += list(self.sync_groups[project_name].followers)
+        return min(self.projects[name].get('check_interval', self.default_check_interval) for name in members)
+
+    @timed('check_and_queue_project')
     def check_and_queue_project(self, project_name: str, project_config: Dict):
-        """检查项目更新并加入队列"""
-        try:
-            task = self.project_tasks[project_name]
-
-            # 如果项目不是空闲状态，跳过
-            if task.status != ProjectStatus.IDLE:
-                return
+        """
+        检查项目更新：p4 changes 在项目所在服务器的线程中执行（受该服务器的并发和速率限制），
+        结果由 collect_polls() 在之后的周期中处理
+        """
+        task = self.project_tasks[project_name]
 
-            depot_path = project_config.get('depot_path', '')
-            local_path = project_config.get('local_path', '')
+        # 如果项目不是空闲状态或已暂停，跳过；共享同步的follower由主项目同步后分发；上次检查尚未返回时也跳过
+        if (task.status != ProjectStatus.IDLE or project_name in self.paused_projects or
+                project_name in self.sync_leaders or project_name in self.poll_futures):
+            return
 
-            # 检查是否有更新
-            has_changes, latest_version = self.check_perforce_changes(depot_path)
+        server = self.p4_servers.for_project(project_name)
+        self.poll_futures[project_name] = server.submit(
+            self.check_perforce_changes, project_config.get('depot_path', ''), self.p4_servers.env(project_name))
 
-            # 判断是否需要同步
-            last_version = self.last_sync_versions.get(project_name)
+    def collect_polls(self):
+        """处理已返回的检查更新结果，有新版本的项目加入同步队列"""
+        for project_name in [name for name, future in self.poll_futures.items() if future.done()]:
+            future = self.poll_futures.pop(project_name)
+            forced = project_name in self.forced_syncs
+            self.forced_syncs.discard(project_name)
+            try:
+                has_changes, latest_version = future.result()
+                if forced:
+                    self.queue_forced_sync(project_name, has_changes, latest_version)
+                else:
+                    self.queue_if_changed(project_name, has_changes, latest_version)
+            except Exception as e:
+                logger.error(f"检查项目 {project_name} 时出错: {e}")
 
-            if has_changes and latest_version != last_version:
-                logger.info(f"检测到项目 {project_name} 有更新 (版本: {latest_version})")
+    def queue_if_changed(self, project_name: str, has_changes: bool, latest_version: Optional[str]):
+        """检测到新版本时把项目加入同步队列"""
+        task = self.project_tasks[project_name]
+        # 检查期间项目可能已被暂停或通过控制接口加入队列
+        if task.status != ProjectStatus.IDLE or project_name in self.paused_projects:
+            return
 
-                # 更新任务信息
-                task.depot_path = depot_path
-                task.local_path = local_path
-                task.version = latest_version
-                task.status = ProjectStatus.PENDING_SYNC
-                task.last_update_time = time.time()
+        # 判断是否需要同步（已取消的版本不再同步）
+        if not has_changes or latest_version in (self.last_sync_versions.get(project_name),
+                                                 self.skipped_versions.get(project_name)):
+            return
+        self.skipped_versions.pop(project_name, None)
+        logger.info(f"检测到项目 {project_name} 有更新 (版本: {latest_version})")
+        self.queue_sync(project_name, latest_version)
+        logger.info(f"项目 {project_name} 已加入同步队列")
 
-                logger.info(f"项目 {project_name} 已加入同步队列")
+    def queue_forced_sync(self, project_name: str, has_changes: bool, latest_version: Optional[str]):
+        """手动同步查询到最新版本后加入同步队列（即使版本与上次同步相同）"""
+        task = self.project_tasks[project_name]
+        if task.status != ProjectStatus.IDLE or project_name in self.paused_projects:
+            logger.info(f"项目 {project_name} 在查询最新版本期间状态已变化 ({task.status.value})，不再手动同步")
+            return
+        if not has_changes:
+            logger.warning(f"无法获取项目 {project_name} 的最新版本，手动同步未加入队列")
+            return
+        self.skipped_versions.pop(project_name, None)
+        self.queue_sync(project_name, latest_version)
+        logger.info(f"项目 {project_name} 已加入同步队列 (版本: {latest_version}，手动同步)")
 
-        except Exception as e:
-            logger.error(f"检查项目 {project_name} 时出错: {e}")
+    def queue_sync(self, project_name: str, version: str):
+        """把项目以指定版本加入同步队列"""
+        task = self.project_tasks[project_name]
+        project_config = self.projects[project_name]
+        task.depot_path = project_config.get('depot_path', '')
+        task.local_path = project_config.get('local_path', '')
+        task.version = version
+        task.status = ProjectStatus.PENDING_SYNC
+        task.last_update_time = time.time()
 
     def format_progress_bar(self, current: int, total: int, width: int = 40) -> str:
         """格式化进度条"""
@@ -623,6 +1144,7 @@ class P4VProjectManager:
                             if '#' in file_info:
                                 file_path = file_info.split('#')[0]
                                 self.sync_progress.current_file = file_path
+                                self.sync_progress.synced_files.add(file_info.strip())
 
                             # 提取动作
                             action = action_info.split()[0] if action_info else ""
@@ -631,8 +1153,12 @@ class P4VProjectManager:
                             # 更新计数
                             self.sync_progress.completed_files += 1
 
-                            # 估算文件大小（这里简化处理）
-                            self.sync_progress.bytes_transferred += 1024 * 100  # 假设每个文件100KB
+                            # 估算文件大小：按同步预估的平均文件大小，没有预估时假设每个文件100KB
+                            if self.sync_progress.estimated_bytes and self.sync_progress.total_files:
+                                self.sync_progress.bytes_transferred += (
+                                    self.sync_progress.estimated_bytes // self.sync_progress.total_files)
+                            else:
+                                self.sync_progress.bytes_transferred += 1024 * 100
 
                     # 检查是否是文件总数信息
                     # 示例: 235 files to refresh.
@@ -650,19 +1176,172 @@ class P4VProjectManager:
 
     def process_sync_queue(self):
         """处理同步队列 - 一次只同步一个项目"""
-        # 如果正在同步，检查进度
+        self.collect_fanouts()
+        self.apply_deferred_fanouts()
+
+        # 如果正在同步，检查进度；有更高优先级的项目等待时可以抢占
         if self.current_sync_project:
             self.check_sync_progress()
+            if self.current_sync_project:
+                self.check_sync_preemption()
             return
 
-        # 查找下一个需要同步的项目
-        for project_name, task in self.project_tasks.items():
-            if task.status == ProjectStatus.PENDING_SYNC:
-                self.start_sync_project(project_name)
+        # 上一次同步已结束（完成、失败、超时或取消），释放占用的服务器名额
+        if self.sync_server:
+            self.sync_server.release()
+            self.sync_server = None
+
+        self.resource_monitor.sample()
+
+        # 按调度策略查找下一个需要同步且资源允许的项目
+        pending = self.project_tasks.with_status(ProjectStatus.PENDING_SYNC)
+        estimating: Set[str] = set()  # 有项目正在等待预估的服务器
+        for project_name in self.order_pending(pending, 'sync'):
+            # 失败后的退避等待中，或已暂停
+            if not self.sync_retry.is_ready(project_name) or project_name in self.paused_projects:
+                continue
+            # 共用工作区的follower正在构建时不能修改工作区
+            if self.shared_followers_busy(project_name):
+                continue
+            # 预提交构建正在克隆工作区时不能修改工作区
+            if self.presubmit and self.presubmit.is_cloning(project_name):
+                continue
+            # 上次取消的缓存放置仍在写入工作区
+            if self.prefill_pending(project_name):
+                continue
+            # 项目所在的服务器繁忙时先处理其他服务器上的项目
+            server = self.p4_servers.for_project(project_name)
+            if server.saturated() or server.name in estimating:
+                continue
+            # 等待后台预估完成，不让同一服务器上排在后面的项目插队；其他服务器上的项目不受影响
+            if not self.estimate_sync(project_name)[0]:
+                estimating.add(server.name)
+                continue
+            if self.admit_sync(project_name) and server.try_acquire():
+                self.start_sync_project(project_name, server)
                 break
 
-    def start_sync_project(self, project_name: str):
-        """开始同步项目"""
+    def running_build_count(self) -> int:
+        """本机正在构建的项目数（不包括分派到构建代理的构建）"""
+        # 分派到代理的项目都处于 BUILDING 状态；二分定位和预提交构建也在本机执行构建脚本
+        return (self.project_tasks.count(ProjectStatus.BUILDING) - len(self.remote_builds) +
+                self.project_tasks.count(ProjectStatus.BISECTING) +
+                (self.presubmit.running_count() if self.presubmit else 0))
+
+    def sync_target(self, task: ProjectTask) -> str:
+        """同步目标（固定到检测到的变更号，保证预估与实际同步的内容一致）"""
+        if task.version.isdigit():
+            return f"{task.depot_path}@{task.version}"
+        return task.depot_path
+
+    @timed('estimate_sync')
+    def estimate_sync(self, project_name: str) -> Tuple[bool, Optional[SyncEstimate]]:
+        """
+        预估同步的文件数和传输量（按版本缓存）
+
+        启用续传时通过 p4 -ztag sync -n 获取完整的同步计划，否则只通过 p4 sync -N 获取汇总；
+        有未完成的续传计划时直接使用剩余文件，不再访问服务器。
+        大型同步的计划有数十万行，命令和解析都在执行器的工作进程中进行，不阻塞主循环。
+
+        Returns:
+            (预估是否已完成, 预估)；后台预估尚未完成时返回 (False, None)
+        """
+        task = self.project_tasks[project_name]
+        cached = self.sync_estimates.get(project_name)
+        if cached and cached[0] == task.version:
+            return True, cached[1]
+
+        remaining = self.sync_retry.resume_plan(project_name, task.version)
+        if remaining is not None:
+            estimate = SyncEstimate(files_updated=len(remaining),
+                                    bytes_updated=sum(remaining.values()),
+                                    files=dict(remaining))
+            self.sync_estimates[project_name] = (task.version, estimate)
+            return True, estimate
+
+        if self.test_mode:
+            self.sync_estimates[project_name] = (task.version, None)
+            return True, None
+
+        pending = self.estimate_futures.get(project_name)
+        if pending and pending[0] == task.version:
+            if not pending[1].done():
+                return False, None
+            del self.estimate_futures[project_name]
+            estimate = None
+            try:
+                estimate = pending[1].result()
+            except Exception as e:
+                logger.warning(f"预估项目 {project_name} 同步大小失败: {e}")
+            self.sync_estimates[project_name] = (task.version, estimate)
+            return True, estimate
+
+        with_plan = self.sync_retry.policy.resume
+        if with_plan:
+            cmd = f'p4 -ztag sync -n "{self.sync_target(task)}"'
+        else:
+            cmd = f'p4 sync -N "{self.sync_target(task)}"'
+        # 预估命令计入项目所在服务器的并发和速率限制
+        server = self.p4_servers.for_project(project_name)
+        if not server.try_acquire():
+            return False, None
+        try:
+            future = self.executor.submit('cpu', 'sync_preview', preview_sync, cmd, task.local_path or None,
+                                          with_plan, env=self.p4_servers.env(project_name), block=False)
+        except ExecutorBusy:
+            server.release()
+            return False, None  # 执行器队列已满，下个周期再提交
+        server.track(future)
+        self.estimate_futures[project_name] = (task.version, future)
+        return False, None
+
+    def admit_sync(self, project_name: str) -> bool:
+        """
+        检查主机资源是否允许开始同步
+
+        磁盘空间不足时一直推迟（每 free_space_warning_interval 秒警告一次）；
+        构建进行中且磁盘/网络繁忙时最多推迟 max_sync_defer 秒
+        """
+        task = self.project_tasks[project_name]
+        limits = self.resource_monitor.limits
+        _, estimate = self.estimate_sync(project_name)
+
+        admitted, reason = self.resource_monitor.check_free_space(
+            task.local_path, estimate.total_bytes if estimate else 0)
+        if not admitted:
+            # 磁盘空间不足时不会自动恢复，定期重复警告
+            now = time.time()
+            self.sync_deferrals.setdefault(project_name, now)
+            if now - self.free_space_warnings.get(project_name, 0) >= limits.free_space_warning_interval:
+                self.free_space_warnings[project_name] = now
+                logger.warning(f"推迟项目 {project_name} 的同步: {reason}")
+            return False
+        self.free_space_warnings.pop(project_name, None)
+
+        if self.running_build_count() and self.resource_monitor.is_busy():
+            deferred_since = self.sync_deferrals.get(project_name, time.time())
+            if time.time() - deferred_since < limits.max_sync_defer:
+                if project_name not in self.sync_deferrals:
+                    self.sync_deferrals[project_name] = time.time()
+                    logger.warning(f"推迟项目 {project_name} 的同步: 主机繁忙 ({self.resource_monitor.describe()})")
+                return False
+
+        if self.sync_deferrals.pop(project_name, None) is not None:
+            logger.info(f"项目 {project_name} 的资源条件已满足，开始同步")
+        return True
+
+    @timed('call:start_sync')
+    def start_sync_project(self, project_name: str, server: P4Server):
+        """
+        开始同步项目
+
+        Args:
+            project_name: 项目名称
+            server: 项目所在的服务器（调用者已占用名额，同步结束后释放）
+        """
+        if self.sync_server and self.sync_server is not server:
+            self.sync_server.release()
+        self.sync_server = server
         task = self.project_tasks[project_name]
         task.status = ProjectStatus.SYNCING
         task.sync_start_time = time.time()
@@ -670,6 +1349,13 @@ class P4VProjectManager:
 
         # 重置进度信息
         self.sync_progress = SyncProgress()
+        estimate = self.sync_estimates.pop(project_name, (None, None))[1]
+        if estimate:
+            self.sync_progress.total_files = estimate.total_files
+            self.sync_progress.estimated_bytes = estimate.total_bytes
+            self.sync_progress.planned_files = estimate.files
+            self.sync_progress.client_files = estimate.client_files
+        resume_files = self.sync_retry.resume_plan(project_name, task.version)
 
         logger.info("")
         logger.info("┌" + "─" * 78 + "┐")
@@ -678,65 +1364,421 @@ class P4VProjectManager:
         logger.info(f"│ Depot路径: {task.depot_path[:65]:<65} │")
         logger.info(f"│ 本地路径: {task.local_path[:65]:<65} │")
         logger.info(f"│ 目标版本: {task.version:<66} │")
+        if estimate:
+            sync_size = f"{estimate.total_files} 个文件, {self.format_bytes(estimate.total_bytes)}"
+            logger.info(f"│ 预估大小: {sync_size:<66} │")
+        if self.sync_retry.failures(project_name):
+            retry_info = f"第 {self.sync_retry.failures(project_name)} 次重试" + (" (续传)" if resume_files else "")
+            logger.info(f"│ 重试: {retry_info:<70} │")
         logger.info("└" + "─" * 78 + "┘")
         logger.info("")
 
         if self.test_mode:
             # 测试模式，模拟同步进度
             self.simulate_sync_progress()
+        elif self.content_cache and estimate and estimate.client_files:
+            # 先在io线程中从本地缓存放置文件，完成后（check_sync_progress中）再启动同步进程
+            self.prefill_cancel = threading.Event()
+            try:
+                self.sync_prefill = self.executor.submit('io', 'cache_prefill', self.prefill_from_cache,
+                                                         project_name, estimate, self.prefill_cancel,
+                                                         block=False)
+            except ExecutorBusy:
+                logger.warning(f"后台任务队列已满，项目 {project_name} 本次不使用本地缓存")
+                self.launch_sync_process(project_name)
         else:
-            # 实际同步
+            self.launch_sync_process(project_name)
+
+    def launch_sync_process(self, project_name: str):
+        """启动项目的 p4 sync 进程及输出读取线程"""
+        task = self.project_tasks[project_name]
+        resume_files = self.sync_retry.resume_plan(project_name, task.version)
+        try:
+            # 构建同步命令（主机繁忙时减少并行传输线程并降低进程优先级）
+            builds_running = self.running_build_count()
+            threads = self.resource_monitor.sync_threads(builds_running)
+            throttled = bool(builds_running) or self.resource_monitor.is_busy()
+            parallel = f' --parallel=threads={threads}' if threads else ''
+            if resume_files:
+                # 续传：只同步上次未完成的文件
+                list_file = self.sync_list_file(project_name)
+                self.sync_retry.write_file_list(list_file, list(resume_files))
+                cmd = f'p4 -x "{list_file}" sync{parallel}'
+            else:
+                cmd = f'p4 sync{parallel} "{self.sync_target(task)}"'
+
+            priority_flags = 0
+            popen_options = {}
+            if throttled:
+                logger.info(f"主机负载较高，以低优先级同步 (并行线程: {threads or '默认'})")
+                if os.name == 'nt':
+                    priority_flags = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+                else:
+                    popen_options['preexec_fn'] = lambda: os.nice(10)
+            # 在独立的进程组中启动，超时时可以结束shell及p4整个进程树
+            popen_options.update(self.supervisor.group_options(priority_flags))
+
+            # 启动同步进程
+            self.sync_process = subprocess.Popen(
+                cmd,
+                shell=True,
+                cwd=task.local_path,
+                env=self.p4_servers.env(project_name),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding='utf-8',
+                bufsize=1,
+                universal_newlines=True,
+                **popen_options
+            )
+            self.supervisor.track('sync', self.sync_process)
+
+            # 启动输出读取线程
+            self.sync_thread = threading.Thread(
+                target=self.sync_output_reader,
+                args=(self.sync_process,),
+                daemon=True
+            )
+            self.sync_thread.start()
+
+            logger.info(f"同步进程已启动 (PID: {self.sync_process.pid})")
+
+        except Exception as e:
+            logger.error(f"启动同步进程失败: {e}")
+            self.current_sync_project = None
+            self.sync_process = None
+            task.status = ProjectStatus.FAILED
+            self.handle_sync_failure(project_name, str(e))
+
+    def prefill_from_cache(self, project_name: str, estimate: SyncEstimate,
+                           cancelled: threading.Event) -> List[str]:
+        """
+        同步前把本地缓存中已有的文件版本放到工作区，并通过 p4 sync -k 更新have列表，
+        之后的 p4 sync 只下载未命中的文件（在io线程中执行，不访问同步进度）
+
+        Args:
+            cancelled: 同步被取消或抢占时设置，放置在下一个文件之前停止，不再更新have列表
+
+        Returns:
+            已放置并更新了have列表的版本
+        """
+        start_time = time.time()
+        keys = {self.cache_key(project_name, revision): revision for revision in estimate.client_files}
+        placed = [keys[key] for key in self.content_cache.materialize(
+            ((key, estimate.client_files[revision]) for key, revision in keys.items()), cancelled)]
+        if cancelled.is_set():
+            logger.info(f"项目 {project_name} 的同步已取消，停止从本地缓存放置文件")
+            return []
+        if placed:
+            list_file = self.sync_list_file(project_name).with_name(f"_prefill_{project_name}.txt")
+            self.sync_retry.write_file_list(list_file, placed)
+            task = self.project_tasks[project_name]
             try:
-                # 首先获取文件列表以确定总数
-                cmd_count = f'p4 sync -n "{task.depot_path}" 2>&1 | find /c " - "'
-                result = subprocess.run(
-                    cmd_count,
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    cwd=task.local_path,
-                    timeout=30
-                )
+                result = self.p4_servers.for_project(project_name).call(
+                    subprocess.run, f'p4 -x "{list_file}" sync -k', shell=True, capture_output=True, text=True,
+                    cwd=task.local_path, env=self.p4_servers.env(project_name), timeout=self.sync_timeout)
+                if result.returncode != 0:
+                    logger.warning(f"更新项目 {project_name} 的have列表失败: {result.stderr.strip()}")
+                    placed = []
+            except subprocess.TimeoutExpired:
+                logger.warning(f"更新项目 {project_name} 的have列表超时")
+                placed = []
+            list_file.unlink()
+
+        saved = sum(estimate.files.get(revision, 0) for revision in placed)
+        logger.info(f"本地缓存命中 {len(placed)}/{len(estimate.client_files)} 个文件，"
+                    f"节省 {self.format_bytes(saved)} (耗时 {time.time() - start_time:.1f}秒)")
+        self.content_cache.save()
+        return placed
+
+    def abandon_prefill(self, project_name: str):
+        """同步被取消或抢占：停止进行中的缓存放置，结束前不再开始该项目的同步"""
+        if self.sync_prefill:
+            self.prefill_cancel.set()
+            if not self.sync_prefill.done():
+                self.abandoned_prefills[project_name] = self.sync_prefill
+        self.sync_prefill = None
+        self.prefill_cancel = None
+
+    def prefill_pending(self, project_name: str) -> bool:
+        """项目上次取消的缓存放置是否仍在进行"""
+        future = self.abandoned_prefills.get(project_name)
+        if future is None:
+            return False
+        if not future.done():
+            return True
+        del self.abandoned_prefills[project_name]
+        return False
+
+    def client_line_end(self, project_name: str) -> str:
+        """项目工作区的换行符设置（LineEnd），第一次使用时通过 p4 client -o 查询（在io线程中执行）"""
+        line_end = self.client_line_ends.get(project_name)
+        if line_end is not None:
+            return line_end
+        line_end = 'local'
+        if not self.test_mode:
+            result = self.p4_servers.for_project(project_name).call(
+                subprocess.run, 'p4 -ztag client -o', shell=True, capture_output=True, text=True,
+                cwd=self.project_tasks[project_name].local_path or None, env=self.p4_servers.env(project_name),
+                timeout=30)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip())
+            for line in result.stdout.splitlines():
+                if line.startswith('... LineEnd '):
+                    line_end = line[len('... LineEnd '):].strip()
+        self.client_line_ends[project_name] = line_end
+        return line_end
+
+    def cache_key(self, project_name: str, revision: str) -> str:
+        """
+        文件版本在本地缓存中的键：不同服务器上相同的depot版本是不同的内容，以服务器地址区分；
+        换行符设置不同的工作区中文本文件的内容不同，以工作区的LineEnd区分
+        """
+        port = self.p4_servers.for_project(project_name).port
+        return f"{port}|{self.client_line_end(project_name)}|{revision}"
 
-                if result.returncode == 0:
-                    try:
-                        file_count = int(result.stdout.strip())
-                        self.sync_progress.total_files = file_count
-                        logger.info(f"需要同步 {file_count} 个文件")
-                    except:
-                        pass
-
-                # 构建同步命令
-                cmd = f'p4 sync "{task.depot_path}"'
-
-                # 启动同步进程
-                self.sync_process = subprocess.Popen(
-                    cmd,
-                    shell=True,
-                    cwd=task.local_path,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8',
-                    bufsize=1,
-                    universal_newlines=True
-                )
+    def server_digests(self, project_name: str, revisions: List[str]) -> Dict[str, HaveFile]:
+        """
+        通过 p4 fstat -Ol 查询文件版本在服务器上的digest（在io线程中执行）
 
-                # 启动输出读取线程
-                self.sync_thread = threading.Thread(
-                    target=self.sync_output_reader,
-                    args=(self.sync_process,),
-                    daemon=True
-                )
-                self.sync_thread.start()
+        Returns:
+            {"//depot/file#rev": have列表中的文件}，工作区中已不是该版本的文件不包括在内
+        """
+        task = self.project_tasks[project_name]
+        fd, name = tempfile.mkstemp(prefix=f"_digest_{project_name}_", suffix='.txt',
+                                    dir=self.projects[project_name]['scripts_path'])
+        os.close(fd)
+        list_file = Path(name)
+        try:
+            self.sync_retry.write_file_list(list_file, revisions)
+            result = self.p4_servers.for_project(project_name).call(
+                subprocess.run, f'p4 -x "{list_file}" -ztag fstat -Ol -T {HAVE_FIELDS}', shell=True,
+                capture_output=True, text=True, encoding='utf-8', cwd=task.local_path or None,
+                env=self.p4_servers.env(project_name), timeout=self.sync_timeout)
+        finally:
+            list_file.unlink()
+        if result.returncode != 0 and not result.stdout.strip():
+            raise RuntimeError(result.stderr.strip())
+        return {f"{have.depot_file}#{have.revision}": have for have in parse_have_list(result.stdout)}
+
+    def cache_synced_files(self):
+        """同步成功后在后台把新下载的文件加入本地缓存"""
+        if not self.content_cache:
+            return
+        project_name = self.current_sync_project
+        client_files = self.sync_progress.client_files
+        files = [(revision, client_files[revision])
+                 for revision in self.sync_progress.synced_files if revision in client_files]
+        if not files:
+            return
+
+        def ingest():
+            # 按服务器的digest校验，只缓存内容与同步的版本一致的文件；关键字展开等不可比的类型不缓存
+            try:
+                files_by_key = {self.cache_key(project_name, revision): (revision, path) for revision, path in files}
+                new_files = {key: value for key, value in files_by_key.items()
+                             if key not in self.content_cache.revisions}
+                if not new_files:
+                    return
+                have = self.server_digests(project_name, [revision for revision, _ in new_files.values()])
+                candidates = []
+                for key, (revision, path) in new_files.items():
+                    have_file = have.get(revision)
+                    if have_file and have_file.kind and have_file.digest:
+                        candidates.append((key, path, have_file.digest, have_file.kind == 'text'))
+                added, rejected = self.content_cache.ingest(candidates)
+                self.content_cache.save()
+                logger.debug(f"已缓存 {added} 个新文件，{rejected} 个文件与服务器digest不一致未缓存 "
+                             f"({self.content_cache.describe()})")
+            except Exception as e:
+                logger.warning(f"把项目 {project_name} 同步的文件加入缓存失败: {e}")
+
+        try:
+            self.executor.submit('io', 'cache_ingest', ingest, block=False)
+        except ExecutorBusy:
+            logger.warning("后台任务队列已满，本次同步的文件不加入缓存")
+
+    def sync_list_file(self, project_name: str) -> Path:
+        """续传文件列表的路径（与其他控制文件一起放在脚本目录）"""
+        return Path(self.projects[project_name]['scripts_path']) / f"_sync_{project_name}.txt"
+
+    def handle_sync_failure(self, project_name: str, error: str):
+        """同步失败：按退避策略重新加入队列，并保留未完成的文件以便续传"""
+        task = self.project_tasks[project_name]
+        progress = self.sync_progress
+        delay = self.sync_retry.record_failure(
+            project_name, task.version, error,
+            progress.planned_files or None, progress.synced_files)
+
+        remaining = self.sync_retry.resume_plan(project_name, task.version)
+        remaining_info = f"，剩余 {len(remaining)} 个文件待续传" if remaining else ""
+
+        if delay is None:
+            logger.error(f"项目 {project_name} 连续同步失败，"
+                         f"{self.sync_retry.policy.max_delay:.0f} 秒后再重试{remaining_info}")
+            self.notify('sync_failed', project_name,
+                        f"项目 {project_name} 连续 {self.sync_retry.failures(project_name)} 次同步失败: {error}",
+                        error=error)
+            # 冷却结束后由下一次检查重新加入队列
+            task.status = ProjectStatus.IDLE
+        else:
+            logger.warning(f"项目 {project_name} 将在 {delay:.0f} 秒后第 "
+                           f"{self.sync_retry.failures(project_name)} 次重试{remaining_info}")
+            task.status = ProjectStatus.PENDING_SYNC
+
+    def shared_followers_busy(self, project_name: str) -> bool:
+        """共用工作区(shared)时，主项目的follower是否正在构建"""
+        group = self.sync_groups.get(project_name)
+        if not group or self.fanout.mode != 'shared':
+            return False
+        return any(self.project_tasks[name].status in (ProjectStatus.BUILDING, ProjectStatus.PUBLISHING)
+                   for name in group.followers if name in self.project_tasks)
+
+    def share_sync_result(self, leader: str):
+        """主项目同步完成：把同步结果分发给组内的follower，并触发它们的构建"""
+        group = self.sync_groups.get(leader)
+        if not group:
+            return
+
+        # 需要分发的文件由follower自己的have列表计算（包括之前中断或未分发的文件）；
+        # 测试模式下没有p4，只分发模拟同步记录的文件
+        files = {name.split('#', 1)[0] for name in self.sync_progress.synced_files}
+        for follower in group.followers:
+            if follower in self.project_tasks:
+                self.fan_out_to_follower(leader, follower, files)
+
+    def fanout_blocked(self, follower: str) -> bool:
+        """follower的工作区是否正在使用（构建、发布、校验、二分定位或上一次分发），此时推迟分发"""
+        return self.project_tasks[follower].status in (
+            ProjectStatus.BUILDING, ProjectStatus.PUBLISHING, ProjectStatus.FAILED, ProjectStatus.SYNCING,
+            ProjectStatus.VERIFYING, ProjectStatus.BISECTING)
+
+    def defer_fanout(self, follower: str, files: Set[str]):
+        """推迟分发，合并需要分发的文件"""
+        self.deferred_fanouts[follower] = self.deferred_fanouts.get(follower, set()) | files
+
+    def apply_deferred_fanouts(self):
+        """分发之前因follower忙碌而推迟的同步结果"""
+        for follower in list(self.deferred_fanouts):
+            if self.fanout_blocked(follower):
+                continue
+            files = self.deferred_fanouts.pop(follower)
+            self.fan_out_to_follower(self.sync_leaders[follower], follower, files)
+
+    def fan_out_to_follower(self, leader: str, follower: str, files: Set[str]):
+        """
+        在后台分发主项目工作区中的文件给follower，完成后由 collect_fanouts 把follower加入构建队列
+
+        Args:
+            leader: 主项目
+            follower: 接收分发的项目
+            files: 模拟同步记录的depot文件（不含版本，只在测试模式下使用）
+        """
+        task = self.project_tasks[follower]
+        if self.fanout_blocked(follower):
+            # 不修改正在使用的工作区，结束后再分发
+            self.defer_fanout(follower, files)
+            logger.info(f"项目 {follower} 忙碌中 ({task.status.value})，{leader} 的同步结果将在结束后分发")
+            return
 
-                logger.info(f"同步进程已启动 (PID: {self.sync_process.pid})")
+        group = self.sync_groups[leader]
+        prefix, subdir = group.followers[follower]
+        leader_task = self.project_tasks[leader]
+        leader_version = self.last_sync_versions.get(leader, leader_task.version)
+        leader_local = self.projects[leader].get('local_path', '')
+        source_root = None
+        if self.fanout.mode != 'shared' and leader_local and task.local_path:
+            source_root = Path(leader_local) / subdir
+
+        cancelled = threading.Event()
+        try:
+            future = self.executor.submit('io', 'sync_fanout', self.run_fanout, follower, leader_version,
+                                          self.last_sync_versions.get(follower), source_root, prefix, files,
+                                          cancelled, block=False)
+        except ExecutorBusy:
+            self.defer_fanout(follower, files)  # 执行器队列已满，下个周期再提交
+            return
+        self.fanout_jobs[follower] = FanoutJob(leader, future, cancelled, task.status, time.time())
+        task.status = ProjectStatus.SYNCING
+        task.sync_start_time = time.time()
+        task.last_update_time = leader_task.last_update_time
 
+    def run_fanout(self, follower: str, leader_version: str, last_version: Optional[str],
+                   source_root: Optional[Path], prefix: str, files: Set[str],
+                   cancelled: threading.Event) -> Tuple[Optional[str], int, int, int]:
+        """
+        分发同步结果（在io线程中执行，p4命令计入follower所在服务器的并发和速率限制）
+
+        Returns:
+            (follower的新版本，没有变化时为None, 更新的文件数, 删除的文件数, 复制的字节数)
+        """
+        task = self.project_tasks[follower]
+        server = self.p4_servers.for_project(follower)
+        env = self.p4_servers.env(follower)
+
+        # follower的版本：其路径下不晚于主项目同步版本的最新变更
+        version = leader_version
+        if not self.test_mode and leader_version.isdigit():
+            has_changes, latest = server.call(self.check_perforce_changes,
+                                              f"{task.depot_path}@{leader_version}", env)
+            if has_changes and latest:
+                version = latest
+        if version == last_version or source_root is None:
+            return (None if version == last_version else version), 0, 0, 0
+
+        target = f"{task.depot_path}@{version}" if version.isdigit() else task.depot_path
+        if self.test_mode:
+            names = files
+        else:
+            # 按follower的have列表计算需要更新的文件，包括之前中断或启动前未分发的文件
+            estimate = server.call(preview_sync, f'p4 -ztag sync -n "{target}"', task.local_path, True,
+                                   self.sync_timeout, env)
+            names = estimate.files
+        relative_paths = [path for path in (depot_relative(name, prefix) for name in names) if path]
+        updated, deleted, copied = self.fanout.fan_out_files(source_root, Path(task.local_path),
+                                                             relative_paths, cancelled)
+        if cancelled.is_set() or self.test_mode:
+            return version, updated, deleted, copied
+
+        # 只更新follower的have列表，不从服务器传输文件
+        result = server.call(subprocess.run, f'p4 sync -k "{target}"', shell=True, capture_output=True,
+                             text=True, cwd=task.local_path, env=env, timeout=self.sync_timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"更新have列表失败: {result.stderr.strip()}")
+        return version, updated, deleted, copied
+
+    def collect_fanouts(self):
+        """处理完成的分发：更新follower的版本并加入构建队列"""
+        for follower, job in list(self.fanout_jobs.items()):
+            if not job.future.done():
+                continue
+            del self.fanout_jobs[follower]
+            task = self.project_tasks[follower]
+            if job.cancelled.is_set():
+                task.status = ProjectStatus.IDLE
+                logger.info(f"已取消分发 {job.leader} 的同步结果到项目 {follower}")
+                continue
+            try:
+                version, updated, deleted, copied = job.future.result()
             except Exception as e:
-                logger.error(f"启动同步进程失败: {e}")
-                task.status = ProjectStatus.FAILED
-                self.current_sync_project = None
-                self.sync_process = None
+                # 已分发的文件不在have列表中，下次分发时会重新计算
+                logger.error(f"分发 {job.leader} 的同步结果到项目 {follower} 失败: {e}")
+                task.status = job.previous_status
+                continue
+            if version is None:
+                logger.debug(f"{job.leader} 的本次同步不涉及项目 {follower}")
+                task.status = job.previous_status
+                continue
+
+            if updated or deleted:
+                logger.info(f"已把 {job.leader} 的同步结果分发到项目 {follower}: "
+                            f"更新 {updated} 个文件, 删除 {deleted} 个文件, 复制 {self.format_bytes(copied)}")
+            task.version = version
+            self.last_sync_versions[follower] = version
+            self.history.record(follower, 'sync', time.time() - job.start_time, version)
+            task.status = ProjectStatus.PENDING_BUILD
+            logger.info(f"项目 {follower} 已加入构建队列 (版本: {version}，与 {job.leader} 共享同步)")
 
     def simulate_sync_progress(self):
         """模拟同步进度（测试模式）"""
@@ -754,20 +1796,22 @@ class P4VProjectManager:
         ]
 
         # 启动模拟线程
-        def simulate():
+        def simulate(progress: SyncProgress):
             import random
-            for i in range(self.sync_progress.total_files):
+            for i in range(progress.total_files):
                 time.sleep(0.1)  # 模拟每个文件需要0.1秒
-                self.sync_progress.completed_files = i + 1
-                self.sync_progress.current_file = random.choice(test_files)
-                self.sync_progress.current_action = random.choice(['updating', 'added', 'updated'])
-                self.sync_progress.bytes_transferred += random.randint(1024, 1024 * 1024)
+                if self.sync_progress is not progress:
+                    return  # 同步被抢占
+                progress.completed_files = i + 1
+                progress.current_file = random.choice(test_files)
+                progress.current_action = random.choice(['updating', 'added', 'updated'])
+                progress.bytes_transferred += random.randint(1024, 1024 * 1024)
 
                 # 偶尔产生错误
                 if random.random() < 0.05:
-                    self.sync_progress.errors.append(f"Warning: file {self.sync_progress.current_file} is locked")
+                    progress.errors.append(f"Warning: file {progress.current_file} is locked")
 
-        thread = threading.Thread(target=simulate, daemon=True)
+        thread = threading.Thread(target=simulate, args=(self.sync_progress,), daemon=True)
         thread.start()
 
     def check_sync_progress(self):
@@ -812,9 +1856,28 @@ class P4VProjectManager:
 
                 task.status = ProjectStatus.PENDING_BUILD
                 self.last_sync_versions[self.current_sync_project] = task.version
+                self.history.record(self.current_sync_project, 'sync', elapsed_time, task.version)
+                self.share_sync_result(self.current_sync_project)
                 self.current_sync_project = None
             return
 
+        # 本地缓存放置完成后再启动同步进程
+        if self.sync_prefill:
+            if not self.sync_prefill.done():
+                return
+            future, self.sync_prefill = self.sync_prefill, None
+            self.prefill_cancel = None
+            try:
+                placed = future.result()
+            except Exception as e:
+                logger.warning(f"从本地缓存放置项目 {self.current_sync_project} 的文件出错: {e}")
+                placed = []
+            # 已放置的文件计入进度；失败后续传时也不再需要
+            self.sync_progress.synced_files.update(placed)
+            self.sync_progress.completed_files += len(placed)
+            self.launch_sync_process(self.current_sync_project)
+            return
+
         # 实际同步进度检查
         if not self.sync_process:
             return
@@ -826,14 +1889,26 @@ class P4VProjectManager:
             # 进程还在运行
             # 检查超时
             if elapsed_time > self.sync_timeout:
-                logger.error(f"项目 {self.current_sync_project} 同步超时")
-                self.sync_process.terminate()
+                project_name = self.current_sync_project
+                logger.error(f"项目 {project_name} 同步超时")
+                if not self.supervisor.kill_tree('sync'):
+                    # 进程树未能确认结束，保持同步占用，下次检查时再次尝试
+                    logger.error(f"项目 {project_name} 的同步进程未能结束，稍后重试")
+                    return
+                if self.sync_thread:
+                    self.sync_thread.join(timeout=1)
+                self.history.record(project_name, 'sync', elapsed_time, task.version, success=False)
                 task.status = ProjectStatus.FAILED
                 self.current_sync_project = None
                 self.sync_process = None
+                self.sync_thread = None
+                self.handle_sync_failure(project_name, "同步超时")
                 return
         else:
-            # 进程已结束
+            # 进程已结束，确认没有遗留的子进程
+            if self.supervisor.is_tree_alive('sync'):
+                self.supervisor.kill_tree('sync')
+            self.supervisor.untrack('sync')
             if self.sync_thread:
                 self.sync_thread.join(timeout=1)
 
@@ -857,6 +1932,13 @@ class P4VProjectManager:
 
                 task.status = ProjectStatus.PENDING_BUILD
                 self.last_sync_versions[self.current_sync_project] = task.version
+                self.history.record(self.current_sync_project, 'sync', elapsed_time, task.version)
+                self.sync_retry.record_success(self.current_sync_project)
+                self.cache_synced_files()
+                self.share_sync_result(self.current_sync_project)
+                list_file = self.sync_list_file(self.current_sync_project)
+                if list_file.exists():
+                    list_file.unlink()
             else:
                 # 同步失败
                 logger.error("┌" + "─" * 78 + "┐")
@@ -875,22 +1957,244 @@ class P4VProjectManager:
                 logger.error("└" + "─" * 78 + "┘")
                 logger.error("")
 
+                self.history.record(self.current_sync_project, 'sync', elapsed_time,
+                                    task.version, success=False)
                 task.status = ProjectStatus.FAILED
-                # 失败后重置为IDLE，允许重试
-                task.status = ProjectStatus.IDLE
+                # 失败后按退避策略重试
+                self.handle_sync_failure(self.current_sync_project, f"错误码 {poll_result}")
 
             self.current_sync_project = None
             self.sync_process = None
             self.sync_thread = None
 
+    def order_pending(self, project_names: List[str], kind: str) -> List[str]:
+        """
+        按调度策略对等待中的项目排序
+
+        Args:
+            project_names: 等待中的项目名称（保持入队顺序）
+            kind: 等待的阶段，"sync" 或 "build"
+
+        Returns:
+            排序后的项目名称列表
+        """
+        ordered = self.order_by_policy(project_names, kind)
+        # 优先级高的在前，同一优先级内保持调度策略的顺序（sorted是稳定的）
+        return sorted(ordered, key=lambda name: -self.effective_priority(name))
+
+    def order_by_policy(self, project_names: List[str], kind: str) -> List[str]:
+        """按调度策略排序（不考虑优先级）"""
+        if self.schedule_policy == 'shortest_first':
+            # 预计耗时最短的优先；没有历史样本的项目先执行以获得样本
+            return sorted(project_names,
+                          key=lambda name: self.history.estimate(name, kind) or 0)
+
+        if self.schedule_policy == 'deadline':
+            # 截止时间最早的优先（截止时间 = 检测到更新的时间 + 项目的deadline）
+            def deadline_key(name):
+                deadline = self.projects.get(name, {}).get('deadline')
+                if deadline is None:
+                    return float('inf'), 0
+                task = self.project_tasks[name]
+                return task.last_update_time + deadline, self.history.estimate(name, kind) or 0
+
+            return sorted(project_names, key=deadline_key)
+
+        return list(project_names)
+
+    def effective_priority(self, project_name: str) -> int:
+        """
+        项目的有效优先级：配置的priority加上老化提升
+
+        从检测到更新开始，每等待 priority_aging 秒提升一级，低优先级项目不会一直被插队
+        """
+        priority = self.projects.get(project_name, {}).get('priority', 0)
+        if self.priority_aging:
+            waited = time.time() - self.project_tasks[project_name].last_update_time
+            priority += int(max(0.0, waited) // self.priority_aging)
+        return priority
+
+    def check_sync_preemption(self):
+        """
+        检查是否需要抢占正在进行的同步
+
+        等待中优先级最高的项目比正在同步的项目高出 priority_gap 级，且当前同步已运行
+        至少 min_sync_time 秒时，结束当前同步并保留未完成的文件，当前项目重新排队后续传。
+        """
+        if not self.sync_preemption.get('enabled'):
+            return
+
+        current = self.current_sync_project
+        task = self.project_tasks[current]
+        if time.time() - task.sync_start_time < self.sync_preemption.get('min_sync_time', 60):
+            return
+
+        pending = [name for name in self.project_tasks.with_status(ProjectStatus.PENDING_SYNC)
+                   if self.sync_retry.is_ready(name) and name not in self.paused_projects
+                   and not self.prefill_pending(name)]
+        if not pending:
+            return
+        candidate = self.order_pending(pending, 'sync')[0]
+        candidate_priority = self.effective_priority(candidate)
+        current_priority = self.effective_priority(current)
+        if candidate_priority - current_priority < self.sync_preemption.get('priority_gap', 1):
+            return
+        if not self.estimate_sync(candidate)[0] or not self.admit_sync(candidate):
+            return
+        # 与当前同步在同一服务器时沿用其名额
+        server = self.p4_servers.for_project(candidate)
+        if server is not self.sync_server and not server.try_acquire():
+            return
+
+        logger.warning(f"项目 {candidate} (优先级 {candidate_priority}) 抢占项目 {current} "
+                       f"(优先级 {current_priority}) 的同步")
+        if self.sync_process:
+            if not self.supervisor.kill_tree('sync'):
+                logger.error(f"项目 {current} 的同步进程未能结束，取消抢占")
+                return
+            if self.sync_thread:
+                self.sync_thread.join(timeout=1)
+
+        progress = self.sync_progress
+        self.sync_retry.record_interruption(current, task.version,
+                                            progress.planned_files or None, progress.synced_files)
+        remaining = self.sync_retry.resume_plan(current, task.version)
+        if remaining:
+            logger.info(f"项目 {current} 重新加入同步队列，剩余 {len(remaining)} 个文件待续传")
+        task.status = ProjectStatus.PENDING_SYNC
+        self.current_sync_project = None
+        self.sync_process = None
+        self.sync_thread = None
+        self.abandon_prefill(current)
+        self.sync_progress = SyncProgress()
+
+        self.start_sync_project(candidate, server)
+
     def process_build_queue(self):
         """处理构建队列"""
-        for project_name, task in self.project_tasks.items():
-            if task.status == ProjectStatus.PENDING_BUILD:
-                # 检查窗口是否空闲
-                window = self.project_windows[project_name]
-                if self.get_window_status(window) == "idle":
-                    self.start_build_project(project_name)
+        pending = self.project_tasks.with_status(ProjectStatus.PENDING_BUILD)
+        if not pending:
+            return
+
+        # max_parallel_builds 只限制本机窗口中的构建，代理的并行能力由代理自己声明
+        running = self.running_build_count()
+
+        for project_name in self.order_pending(pending, 'build'):
+            if project_name in self.paused_projects:
+                continue
+
+            # 优先分派给构建代理
+            if self.coordinator and self.start_remote_build(project_name):
+                continue
+
+            if not self.local_builds:
+                continue
+            if self.max_parallel_builds and running >= self.max_parallel_builds:
+                continue
+            # 同一项目的预提交构建结束后才开始主线构建
+            if self.presubmit and self.presubmit.is_active(project_name):
+                continue
+
+            # 检查窗口是否空闲（已处理完上一次构建命令；状态未知时不启动，避免重复构建）
+            window = self.project_windows[project_name]
+            if self.get_window_status(window) in ("idle", "completed", "failed"):
+                self.start_build_project(project_name)
+                running += 1
+
+    def start_remote_build(self, project_name: str) -> bool:
+        """
+        把项目的构建分派给支持其平台且负载最低的构建代理
+
+        Returns:
+            是否已分派
+        """
+        task = self.project_tasks[project_name]
+        project_config = self.projects[project_name]
+        payload = {
+            'scripts_path': project_config['scripts_path'],
+            'build_scripts': project_config.get('build_scripts', []),
+            'depot_path': task.depot_path,
+            'local_path': task.local_path,
+            'version': task.version
+        }
+        server = self.p4_servers.for_project(project_name)
+        if server.port:
+            # 代理使用自己的工作区，只需要连接到项目所在的服务器
+            payload['p4port'] = server.port
+            payload['p4user'] = project_config.get('p4user') or server.user
+        job_id = self.coordinator.dispatch(project_name, project_config.get('platform', ''), payload)
+        if job_id is None:
+            return False
+
+        self.remote_builds[project_name] = job_id
+        task.status = ProjectStatus.BUILDING
+        task.build_start_time = time.time()
+        return True
+
+    def finish_remote_build(self, project_name: str):
+        """清除代理构建的记录"""
+        job_id = self.remote_builds.pop(project_name, None)
+        self.remote_scripts.pop(project_name, None)
+        if job_id:
+            self.coordinator.forget_job(job_id)
+
+    def monitor_remote_builds(self):
+        """监控分派到代理的构建，代理离线时重新加入构建队列"""
+        if not self.coordinator:
+            return
+
+        self.coordinator.check_agents()
+
+        for project_name, job_id in list(self.remote_builds.items()):
+            task = self.project_tasks[project_name]
+            job = self.coordinator.get_job(job_id)
+            elapsed_time = time.time() - task.build_start_time
+
+            if job is None or job.state == 'lost':
+                logger.warning(f"项目 {project_name} 的构建代理已离线，重新加入构建队列")
+                self.finish_remote_build(project_name)
+                task.status = ProjectStatus.PENDING_BUILD
+                continue
+
+            if job.current_script and job.current_script != self.remote_scripts.get(project_name):
+                self.remote_scripts[project_name] = job.current_script
+                logger.info(f"[{project_name}@{job.agent}] 正在执行: {job.current_script}")
+
+            if job.state == 'completed':
+                logger.info(f"项目 {project_name} 在代理 {job.agent} 上构建完成 "
+                            f"(耗时: {elapsed_time / 60:.1f} 分钟)")
+                self.history.record(project_name, 'build', elapsed_time, task.version)
+                self.finish_remote_build(project_name)
+                self.notify('build_completed', project_name,
+                            f"项目 {project_name} 在代理 {job.agent} 上构建完成 (版本: {task.version}, "
+                            f"耗时: {elapsed_time / 60:.1f} 分钟)",
+                            duration=elapsed_time, agent=job.agent)
+                task.status = ProjectStatus.COMPLETED
+                task.last_update_time = time.time()
+                task.status = ProjectStatus.IDLE
+
+            elif job.state == 'failed':
+                logger.error(f"项目 {project_name} 在代理 {job.agent} 上构建失败: "
+                             f"{job.current_script} {job.detail}")
+                self.history.record(project_name, 'build', elapsed_time, task.version, success=False)
+                self.finish_remote_build(project_name)
+                self.notify('build_failed', project_name,
+                            f"项目 {project_name} 在代理 {job.agent} 上构建失败 (版本: {task.version}, "
+                            f"脚本: {job.current_script or '未知'})",
+                            script=job.current_script, agent=job.agent, detail=job.detail)
+                task.status = ProjectStatus.FAILED
+                task.status = ProjectStatus.IDLE
+
+            elif elapsed_time > self.build_timeout:
+                logger.error(f"项目 {project_name} 在代理 {job.agent} 上构建超时，取消任务")
+                self.coordinator.cancel(job_id)
+                self.history.record(project_name, 'build', elapsed_time, task.version, success=False)
+                self.finish_remote_build(project_name)
+                self.notify('build_timeout', project_name,
+                            f"项目 {project_name} 在代理 {job.agent} 上构建超时 (版本: {task.version})",
+                            script=job.current_script, agent=job.agent)
+                task.status = ProjectStatus.FAILED
+                task.status = ProjectStatus.IDLE
 
     def start_build_project(self, project_name: str):
         """开始构建项目"""
@@ -900,10 +2204,17 @@ class P4VProjectManager:
         logger.info(f"触发项目 {project_name} 的构建")
         logger.info(f"  同步版本: {task.version}")
 
-        # 写入构建命令
+        # 创建本次构建的日志目录，并在写入构建命令之前告知监控窗口
+        window.build_log_dir = self.log_store.new_build_dir(project_name, task.version)
+        window.log_dir_file.write_text(str(window.build_log_dir), encoding='utf-8')
+
+        # 写入构建命令；之后只有序号更大的状态记录才属于本次构建
+        window.build_seq = window.status_reader.record.seq
         window.command_file.write_text("BUILD", encoding='utf-8')
         window.build_status = "running"
         window.last_build_time = time.time()
+        window.current_script = ""
+        window.script_start_time = 0
 
         task.status = ProjectStatus.BUILDING
         task.build_start_time = time.time()
@@ -913,123 +2224,970 @@ class P4VProjectManager:
             self.test_build_count[project_name] += 1
             logger.info(f"[测试模式] 项目 {project_name} 第 {self.test_build_count[project_name]} 次构建")
 
+    @timed('get_window_status')
     def get_window_status(self, window: ProjectWindow) -> str:
-        """获取窗口当前状态"""
+        """
+        获取窗口当前状态
+
+        Returns:
+            "idle"、"running"、"completed"、"failed"，状态文件无法读取时返回"unknown"
+        """
+        record = window.status_reader.read()
+        if record is None:
+            return "unknown"
+
+        # 窗口还没有处理刚写入的构建命令：记录仍是上一次构建的，或是窗口启动时的空闲记录
+        if window.build_status == "running" and (record.seq <= window.build_seq or record.state == IDLE):
+            return "running"
+
+        return {IDLE: "idle", RUNNING: "running", COMPLETED: "completed", FAILED: "failed"}[record.state]
+
+    def finish_script_timing(self, project_name: str, window: ProjectWindow,
+                             task: ProjectTask, success: bool = True):
+        """记录当前脚本的耗时并清除脚本计时"""
+        if window.current_script and window.script_start_time:
+            self.history.record(project_name, BuildHistory.script_kind(window.current_script),
+                                time.time() - window.script_start_time, task.version, success)
+        window.current_script = ""
+        window.script_start_time = 0
+
+    def sync_queue_waits(self, ordered: Optional[List[str]] = None) -> Dict[str, float]:
+        """
+        等待同步的项目开始同步前需要等待的时间
+
+        同步是串行的：需要等待当前同步及排在前面的项目。队列只排序一次，按顺序累加预估耗时。
+
+        Args:
+            ordered: 已按 order_pending 排序的等待同步项目（默认重新排序）
+
+        Returns:
+            {项目: 等待秒数}
+        """
+        if ordered is None:
+            ordered = self.order_pending(self.project_tasks.with_status(ProjectStatus.PENDING_SYNC), 'sync')
+
+        wait = 0.0
+        if self.current_sync_project:
+            current_remaining = self.estimate_remaining(self.current_sync_project)
+            current_build = self.history.estimate(self.current_sync_project, 'build')
+            if current_remaining is not None and current_build is not None:
+                wait += current_remaining - current_build
+
+        waits = {}
+        for name in ordered:
+            waits[name] = wait
+            wait += self.history.estimate(name, 'sync') or 0
+        return waits
+
+    def estimate_remaining(self, project_name: str,
+                           sync_waits: Optional[Dict[str, float]] = None) -> Optional[float]:
+        """
+        预估项目完成（同步+构建）还需要的时间
+
+        Args:
+            project_name: 项目名称
+            sync_waits: sync_queue_waits 的结果（预估多个等待同步的项目时只计算一次）
+
+        Returns:
+            剩余秒数，缺少历史数据时返回None
+        """
+        task = self.project_tasks[project_name]
+        now = time.time()
+        sync_estimate = self.history.estimate(project_name, 'sync')
+        build_estimate = self.history.estimate(project_name, 'build')
+
+        if task.status == ProjectStatus.BUILDING:
+            if build_estimate is None:
+                return None
+            return max(0.0, build_estimate - (now - task.build_start_time))
+
+        if task.status == ProjectStatus.PENDING_BUILD:
+            return build_estimate
+
+        if task.status == ProjectStatus.SYNCING:
+            if sync_estimate is None or build_estimate is None:
+                return None
+            return max(0.0, sync_estimate - (now - task.sync_start_time)) + build_estimate
+
+        if task.status == ProjectStatus.PENDING_SYNC:
+            if sync_estimate is None or build_estimate is None:
+                return None
+
+            if sync_waits is None:
+                sync_waits = self.sync_queue_waits()
+            return sync_waits.get(project_name, 0.0) + sync_estimate + build_estimate
+
+        return None
+
+    def format_eta(self, project_name: str, sync_waits: Optional[Dict[str, float]] = None) -> str:
+        """格式化预计完成时间"""
+        remaining = self.estimate_remaining(project_name, sync_waits)
+        if remaining is None:
+            return "ETA 未知"
+        eta = datetime.fromtimestamp(time.time() + remaining).strftime('%H:%M')
+        return f"ETA {eta}"
+
+    def format_priority(self, project_name: str) -> str:
+        """格式化有效优先级（为0时不显示）"""
+        priority = self.effective_priority(project_name)
+        return f"优先级 {priority}, " if priority else ""
+
+    @timed('update_build_logs')
+    def update_build_logs(self, window: ProjectWindow):
+        """增量索引正在构建的日志（只读取新增的内容）"""
+        if not window.build_log_dir or not window.build_log_dir.exists():
+            return
+        for log_path in self.log_store.list_logs(window.build_log_dir):
+            try:
+                self.log_store.update_index(log_path)
+            except OSError as e:
+                logger.debug(f"索引日志 {log_path} 时出错: {e}")
+
+    def finish_build_logs(self, project_name: str, window: ProjectWindow, failed: bool) -> Optional[Dict]:
+        """
+        构建结束：完成日志索引，失败时输出第一个错误，并在后台压缩/清理旧日志
+
+        Returns:
+            失败时第一个错误所在的日志、行号和附近的内容
+        """
+        build_dir = window.build_log_dir
+        window.build_log_dir = None
+        if not build_dir or not build_dir.exists():
+            return None
+
+        first_error = None
         try:
-            if window.status_file.exists():
-                status_text = window.status_file.read_text(encoding='utf-8').strip()
+            self.log_store.finish_build(build_dir)
+            if failed:
+                for log_path in self.log_store.list_logs(build_dir):
+                    error = self.log_store.first_error(log_path, context=2)
+                    if error:
+                        logger.error(f"  首个错误: {log_path.name} 第 {error['line']} 行")
+                        for line in error['text']:
+                            logger.error(f"    {line}")
+                        first_error = {'log': str(log_path), **error}
+                        break
+            logger.info(f"  构建日志: {build_dir}")
+        except Exception as e:
+            logger.warning(f"处理构建日志 {build_dir} 时出错: {e}")
+
+        try:
+            self.executor.submit('io', 'log_rotate', self.log_store.rotate, project_name, block=False)
+        except ExecutorBusy:
+            logger.debug(f"后台任务队列已满，项目 {project_name} 的旧日志在下次构建后再压缩")
+        return first_error
+
+    def notify(self, event: str, project_name: str, message: str, version: Optional[str] = None, **details):
+        """发送通知（只加入发送队列，不阻塞主循环）；version 默认为项目当前的版本"""
+        if not self.notifier:
+            return
+        if version is None:
+            task = self.project_tasks.get(project_name)
+            version = task.version if task else ""
+        self.notifier.notify(Notification(event, project_name, version, message, details))
+
+    def failed_script(self, window: ProjectWindow) -> str:
+        """从状态记录中读取第一个失败的脚本"""
+        record = window.status_reader.record
+        if record.state == FAILED and record.script:
+            return record.script
+        return window.current_script
+
+    def start_bisect(self, project_name: str, script: str) -> bool:
+        """
+        构建失败后开始二分定位
 
-                if status_text == "IDLE":
-                    return "idle"
-                elif status_text.startswith("RUNNING"):
-                    return "running"
-                elif status_text.startswith("ERROR"):
-                    return "failed"
-                elif status_text.startswith("COMPLETED"):
-                    return "completed"
+        Returns:
+            是否已开始（项目进入 BISECTING 状态，结束后才重置为IDLE）
+        """
+        project_config = self.projects[project_name]
+        if not self.bisector or not project_config.get('bisect', True) or not script:
+            return False
+        # 二分定位会同步工作区，预提交构建正在克隆工作区时不开始
+        if self.presubmit and self.presubmit.is_cloning(project_name):
+            return False
 
-            return "idle"
+        task = self.project_tasks[project_name]
+        bad = task.version
+        good = self.history.last_version(project_name, 'build', success=True)
+        if not (bad.isdigit() and good and good.isdigit() and int(good) < int(bad)):
+            return False
 
+        try:
+            log_dir = self.log_store.new_build_dir(project_name, f"bisect_{good}-{bad}")
+            self.bisector.start(project_name, project_config, script, good, bad,
+                                self.p4_servers.for_project(project_name), log_dir,
+                                env=self.p4_servers.env(project_name))
         except Exception as e:
-            logger.debug(f"读取状态文件出错: {e}")
-            return "idle"
+            logger.warning(f"无法开始项目 {project_name} 的二分定位: {e}")
+            return False
+
+        logger.info(f"开始二分定位项目 {project_name} 的失败: 脚本 {script}，变更 {good}(成功) ~ {bad}(失败)")
+        task.status = ProjectStatus.BISECTING
+        return True
+
+    def report_bisect(self, project_name: str, session: BisectSession):
+        """输出二分定位的结果"""
+        if session.state == "found":
+            culprit = session.culprit
+            logger.error(f"项目 {project_name} 的脚本 {session.script} 从变更 {culprit.change} 开始失败 "
+                         f"(提交者: {culprit.user}, 说明: {culprit.description})")
+            self.notify('bisect_finished', project_name,
+                        f"项目 {project_name} 的脚本 {session.script} 从变更 {culprit.change} 开始失败 "
+                        f"(提交者: {culprit.user})",
+                        script=session.script, change=culprit.change, user=culprit.user,
+                        description=culprit.description)
+        elif session.state == "inconclusive":
+            suspects = ', '.join(info.change for info in session.suspects)
+            logger.warning(f"项目 {project_name} 的二分定位达到探测次数上限，可疑变更: {suspects}")
+            self.notify('bisect_finished', project_name,
+                        f"项目 {project_name} 的脚本 {session.script} 失败，可疑变更: {suspects}",
+                        script=session.script, suspects=[info.change for info in session.suspects])
+        elif session.state == "empty":
+            logger.info(f"项目 {project_name} 在变更 {session.good} ~ {session.bad} 之间没有提交的变更，不需要二分定位")
+        elif session.state == "error":
+            logger.error(f"项目 {project_name} 的二分定位出错: {session.error}")
+        else:
+            logger.info(f"项目 {project_name} 的二分定位已取消")
+
+    def monitor_bisects(self):
+        """检查结束的二分定位，恢复项目状态"""
+        if not self.bisector:
+            return
+        for project_name, session in self.bisector.finished():
+            self.report_bisect(project_name, session)
+            task = self.project_tasks[project_name]
+            # 工作区停留在探测的版本上，下次检查时重新同步到最新版本
+            if session.probes:
+                self.last_sync_versions.pop(project_name, None)
+            if task.status == ProjectStatus.BISECTING:
+                task.status = ProjectStatus.IDLE
+
+    def process_presubmit(self):
+        """查询带标记的搁置变更，在主线构建不需要的构建槽位中执行预提交构建"""
+        if not self.presubmit:
+            return
+        for job in self.presubmit.finished():
+            self.report_presubmit(job)
+
+        # 每隔 check_interval 在各项目所在服务器的线程中查询一次
+        now = time.time()
+        if now >= self.presubmit_next_check:
+            self.presubmit_next_check = now + self.presubmit_interval
+            for project_name, project_config in self.projects.items():
+                # 只为声明了预提交构建的项目查询（脚本需要在 P4V_WORKSPACE 中构建）
+                if not project_config.get('presubmit', False) or project_name in self.presubmit_polls:
+                    continue
+                self.presubmit_polls[project_name] = self.p4_servers.for_project(project_name).submit(
+                    list_shelved_changes, project_config['depot_path'], self.presubmit_tag,
+                    self.p4_servers.env(project_name))
+
+        for project_name in [name for name, future in self.presubmit_polls.items() if future.done()]:
+            future = self.presubmit_polls.pop(project_name)
+            try:
+                changes = future.result()
+            except Exception as e:
+                logger.warning(f"查询项目 {project_name} 的搁置变更失败: {e}")
+                continue
+            queued = {job.key for job in self.presubmit_queue}
+            for change in changes:
+                if f"{project_name}@{change.change}" in queued or self.presubmit.is_known(project_name, change):
+                    continue
+                self.presubmit_queue.append(PresubmitJob(project_name, change, base_version=''))
+                logger.info(f"项目 {project_name} 有待预提交构建的搁置变更 {change.change} (提交者: {change.user})")
+
+        # 主线构建优先：还有等待构建的项目时不开始预提交构建
+        if any(name not in self.paused_projects
+               for name in self.project_tasks.with_status(ProjectStatus.PENDING_BUILD)):
+            return
+        for job in list(self.presubmit_queue):
+            if self.presubmit.running_count() >= self.presubmit_max_builds:
+                break
+            if self.max_parallel_builds and self.running_build_count() >= self.max_parallel_builds:
+                break
+            # 从已同步的工作区克隆：工作区正在变化或版本未知（启动后尚未同步、二分定位后）时等待
+            # 同一项目的主线构建或另一个预提交构建进行中时等待，避免两次构建同时执行该项目的脚本
+            base_version = self.last_sync_versions.get(job.project_name, '')
+            if (not base_version.isdigit() or self.presubmit.is_active(job.project_name) or
+                    self.project_tasks[job.project_name].status in
+                    (ProjectStatus.SYNCING, ProjectStatus.VERIFYING, ProjectStatus.BISECTING,
+                     ProjectStatus.BUILDING)):
+                continue
+            self.presubmit_queue.remove(job)
+            job.base_version = base_version
+            self.presubmit.start(job, self.projects[job.project_name], self.p4_servers.env(job.project_name),
+                                 self.p4_servers.for_project(job.project_name))
+            logger.info(f"开始预提交构建 {job.key}: 基于版本 {base_version}，说明: {job.change.description}")
+
+    def report_presubmit(self, job: PresubmitJob):
+        """输出预提交构建的结果"""
+        duration = f"耗时 {(job.end_time - job.start_time) / 60:.1f}分钟"
+        if job.state == "passed":
+            message = f"搁置变更 {job.change.change} 在项目 {job.project_name} 上构建成功 ({duration})"
+            logger.info(message)
+        elif job.state == "failed":
+            message = (f"搁置变更 {job.change.change} 在项目 {job.project_name} 上构建失败: "
+                       f"脚本 {job.failed_script} ({duration})")
+            logger.error(f"{message}，日志: {job.log_dir}")
+        elif job.state == "error":
+            message = f"搁置变更 {job.change.change} 无法在项目 {job.project_name} 上构建: {job.error}"
+            logger.error(message)
+        else:
+            logger.info(f"预提交构建 {job.key} 已取消")
+            return
+        self.notify('presubmit_finished', job.project_name, message, version=job.change.change,
+                    state=job.state, user=job.change.user, base_version=job.base_version,
+                    failed_script=job.failed_script, error=job.error, log_dir=job.log_dir)
+
+    def start_publish(self, project_name: str) -> bool:
+        """
+        本机构建成功后发布项目声明的产物
+
+        Returns:
+            是否已开始（项目进入 PUBLISHING 状态，结束后才重置为IDLE）
+        """
+        project_config = self.projects[project_name]
+        patterns = project_config.get('artifacts')
+        root = project_config.get('artifacts_root') or project_config.get('local_path')
+        if not self.artifacts or not patterns or not root:
+            return False
+
+        task = self.project_tasks[project_name]
+        # 不同步直接重新构建且版本未知时，以构建时间区分
+        changelist = task.version or datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.artifacts.start(project_name, project_config.get('platform', 'default'), changelist,
+                             Path(root), patterns)
+        task.status = ProjectStatus.PUBLISHING
+        return True
+
+    def monitor_publishes(self):
+        """检查结束的产物发布，输出结果并恢复项目状态"""
+        if not self.artifacts:
+            return
+        for project_name, session in self.artifacts.finished():
+            self.publish_results[project_name] = session.summary()
+            task = self.project_tasks[project_name]
+            if task.status == ProjectStatus.PUBLISHING:
+                task.status = ProjectStatus.IDLE
+            self.report_publish(project_name, session)
+
+    def report_publish(self, project_name: str, session: PublishSession):
+        """输出产物发布的结果"""
+        target = f"{project_name}/{session.platform}/{session.changelist}"
+        if session.state == "published":
+            saved = session.bytes - session.new_bytes
+            logger.info(f"已发布构建产物 {target}: {session.files} 个文件, {session.bytes / (1024 * 1024):.0f}MB, "
+                        f"新增 {session.new_chunks}/{session.chunks} 个块 {session.new_bytes / (1024 * 1024):.1f}MB "
+                        f"(去重和压缩节省 {saved / (1024 * 1024):.0f}MB, "
+                        f"耗时 {session.end_time - session.start_time:.1f}秒)")
+        elif session.state == "empty":
+            logger.warning(f"项目 {project_name} 没有找到需要发布的产物")
+        elif session.state == "error":
+            logger.error(f"发布构建产物 {target} 失败: {session.error}")
+        else:
+            logger.info(f"已取消发布构建产物 {target}")
+
+    def monitor_verifications(self):
+        """检查结束的工作区校验，输出结果并恢复项目状态"""
+        for project_name, session in self.verifier.finished():
+            summary = session.summary()
+            self.verify_results[project_name] = summary
+            task = self.project_tasks[project_name]
+            if task.status == ProjectStatus.VERIFYING:
+                task.status = ProjectStatus.IDLE
+
+            counts = (f"{session.files} 个文件 (重新计算 {session.hashed}, 使用索引 {session.cached}, "
+                      f"跳过 {session.skipped})，耗时 {summary['elapsed']:.1f}秒")
+            if session.state == "error":
+                logger.error(f"项目 {project_name} 的工作区校验失败: {session.error}")
+            elif session.state == "cancelled":
+                logger.info(f"项目 {project_name} 的工作区校验已取消")
+            elif not session.differences:
+                logger.info(f"项目 {project_name} 的工作区与have列表一致: {counts}")
+            else:
+                action = f"已重新同步 {session.repaired} 个文件" if session.repaired else "未修复"
+                logger.warning(f"项目 {project_name} 的工作区有 {len(session.missing)} 个文件缺失、"
+                               f"{len(session.modified)} 个文件被修改，{action}: {counts}")
+                for revision in session.differences[:10]:
+                    logger.warning(f"  {revision}")
 
     def monitor_build_windows(self):
         """监控构建窗口状态"""
-        for project_name, window in self.project_windows.items():
+        self.supervisor.refresh()
+        self.monitor_remote_builds()
+        self.monitor_bisects()
+        self.monitor_verifications()
+        self.monitor_publishes()
+
+        # 只需检查正在构建的项目，以及超时后等待回收窗口的项目（处于 FAILED 状态）
+        candidates = (self.project_tasks.with_status(ProjectStatus.BUILDING) +
+                      self.project_tasks.with_status(ProjectStatus.FAILED))
+        for project_name in candidates:
+            window = self.project_windows.get(project_name)
+            if window is None:
+                continue
             try:
                 task = self.project_tasks[project_name]
 
-                if task.status != ProjectStatus.BUILDING:
+                # 超时后进程树尚未结束：继续尝试回收，确认后才释放构建槽位
+                if window.reclaiming:
+                    if self.reclaim_project_window(project_name):
+                        task.status = ProjectStatus.IDLE
+                    continue
+
+                if task.status != ProjectStatus.BUILDING or project_name in self.remote_builds:
                     continue
 
                 old_status = window.build_status
                 new_status = self.get_window_status(window)
 
-                # 状态变化时记录日志
-                if old_status != new_status:
+                # 增量索引正在写入的构建日志
+                self.update_build_logs(window)
+
+                # 读取正在执行的脚本（脚本切换时状态仍为running）
+                record = window.status_reader.record
+                if new_status == "running" and record.state == RUNNING and record.script:
+                    if record.script != window.current_script:
+                        self.finish_script_timing(project_name, window, task)
+                        window.current_script = record.script
+                        window.script_start_time = time.time()
+                        logger.info(f"[{project_name}] 正在执行: {record.script}")
+
+                # 状态变化时记录日志（状态未知时保持原状态，只检查超时）
+                if new_status != "unknown" and old_status != new_status:
                     window.build_status = new_status
 
-                    if new_status == "idle":
+                    if new_status == "completed":
                         # 构建完成
-                        elapsed_time = (time.time() - window.last_build_time) / 60
-                        logger.info(f"项目 {project_name} 构建完成 (耗时: {elapsed_time:.1f} 分钟)")
+                        elapsed_time = time.time() - window.last_build_time
+                        logger.info(f"项目 {project_name} 构建完成 (耗时: {elapsed_time / 60:.1f} 分钟)")
+                        self.finish_script_timing(project_name, window, task)
+                        self.history.record(project_name, 'build', elapsed_time, task.version)
+                        log_dir = window.build_log_dir
+                        self.finish_build_logs(project_name, window, failed=False)
+                        self.notify('build_completed', project_name,
+                                    f"项目 {project_name} 构建完成 (版本: {task.version}, "
+                                    f"耗时: {elapsed_time / 60:.1f} 分钟)",
+                                    duration=elapsed_time, log_dir=str(log_dir) if log_dir else None)
                         task.status = ProjectStatus.COMPLETED
                         task.last_update_time = time.time()
 
-                        # 一段时间后重置为IDLE状态，允许下次更新
-                        task.status = ProjectStatus.IDLE
-
-                    elif new_status == "running":
-                        # 读取正在执行的脚本
-                        if window.status_file.exists():
-                            status_text = window.status_file.read_text(encoding='utf-8').strip()
-                            if status_text.startswith("RUNNING:"):
-                                script_name = status_text.split(":", 1)[1]
-                                if script_name != window.current_script:
-                                    window.current_script = script_name
-                                    logger.info(f"[{project_name}] 正在执行: {script_name}")
+                        # 发布产物结束后（或不需要发布时）重置为IDLE状态，允许下次更新
+                        if not self.start_publish(project_name):
+                            task.status = ProjectStatus.IDLE
 
                     elif new_status == "failed":
                         logger.error(f"项目 {project_name} 构建失败")
+                        failed_script = self.failed_script(window)
+                        self.finish_script_timing(project_name, window, task, success=False)
+                        self.history.record(project_name, 'build', time.time() - window.last_build_time,
+                                            task.version, success=False)
+                        first_error = self.finish_build_logs(project_name, window, failed=True)
+                        self.notify('build_failed', project_name,
+                                    f"项目 {project_name} 构建失败 (版本: {task.version}, 脚本: {failed_script or '未知'})",
+                                    script=failed_script, first_error=first_error)
                         task.status = ProjectStatus.FAILED
-                        # 失败后也重置为IDLE，允许重试
-                        task.status = ProjectStatus.IDLE
+                        # 失败后也重置为IDLE，允许重试；启用二分定位时先定位引入问题的变更
+                        if not self.start_bisect(project_name, failed_script):
+                            task.status = ProjectStatus.IDLE
 
                 # 检查超时
                 if window.build_status == "running":
                     elapsed_time = time.time() - window.last_build_time
                     if elapsed_time > self.build_timeout:
-                        logger.error(f"项目 {project_name} 构建超时")
+                        logger.error(f"项目 {project_name} 构建超时，结束构建进程树")
+                        self.history.record(project_name, 'build', elapsed_time,
+                                            task.version, success=False)
+                        first_error = self.finish_build_logs(project_name, window, failed=True)
+                        self.notify('build_timeout', project_name,
+                                    f"项目 {project_name} 构建超时 (版本: {task.version}, "
+                                    f"已运行 {elapsed_time / 60:.0f} 分钟, 脚本: {window.current_script or '未知'})",
+                                    script=window.current_script, first_error=first_error)
                         task.status = ProjectStatus.FAILED
-                        task.status = ProjectStatus.IDLE  # 重置状态
+                        # 确认进程树已结束并重启窗口后才重置状态
+                        if self.reclaim_project_window(project_name):
+                            task.status = ProjectStatus.IDLE
 
             except Exception as e:
                 logger.debug(f"监控窗口 {project_name} 时出错: {e}")
 
+    def process_control_commands(self):
+        """执行控制接口收到的命令（在主循环中执行，不需要与请求线程共享调度数据）"""
+        if not self.control_api:
+            return
+
+        handlers = {
+            'sync': self.force_sync,
+            'build': self.force_build,
+            'cancel': self.cancel_project,
+            'pause': self.pause_project,
+            'resume': self.resume_project,
+            'priority': self.set_project_priority,
+            'verify': self.verify_workspace
+        }
+        for command in self.control_api.pending_commands():
+            if command.project not in self.project_tasks:
+                ok, message = False, f"未知的项目: {command.project}"
+            else:
+                try:
+                    ok, message = handlers[command.action](command.project, command.args)
+                except Exception as e:
+                    ok, message = False, f"执行出错: {e}"
+            (logger.info if ok else logger.warning)(f"控制命令 {command.action} {command.project}: {message}")
+            command.result = {'ok': ok, 'message': message}
+            command.done.set()
+
+    def force_sync(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """查询最新版本后立即同步（即使版本与上次同步相同）"""
+        task = self.project_tasks[project_name]
+        leader = self.sync_leaders.get(project_name)
+        if leader:
+            return False, f"项目由 {leader} 共享同步，请对 {leader} 执行同步"
+        if project_name in self.paused_projects:
+            return False, "项目已暂停"
+        if task.status != ProjectStatus.IDLE:
+            return False, f"项目当前状态为 {task.status.value}"
+
+        if project_name in self.forced_syncs:
+            return True, "正在查询最新版本"
+
+        # 与定期检查相同，在项目所在服务器的线程中查询（受该服务器的并发和速率限制），
+        # 由 collect_polls() 在之后的周期中加入同步队列；定期检查正在进行时沿用其结果
+        self.forced_syncs.add(project_name)
+        if project_name not in self.poll_futures:
+            server = self.p4_servers.for_project(project_name)
+            self.poll_futures[project_name] = server.submit(
+                self.check_perforce_changes, self.projects[project_name].get('depot_path', ''),
+                self.p4_servers.env(project_name))
+        return True, "正在查询最新版本，完成后加入同步队列"
+
+    def force_build(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """不同步，直接以工作区当前的内容重新构建"""
+        task = self.project_tasks[project_name]
+        if project_name in self.paused_projects:
+            return False, "项目已暂停"
+        if task.status != ProjectStatus.IDLE:
+            return False, f"项目当前状态为 {task.status.value}"
+        if project_name not in self.project_windows and not self.coordinator:
+            return False, "项目没有可用的构建窗口"
+
+        task.version = self.last_sync_versions.get(project_name, task.version)
+        task.status = ProjectStatus.PENDING_BUILD
+        task.last_update_time = time.time()
+        return True, f"已加入构建队列 (版本: {task.version or '当前工作区'})"
+
+    def cancel_project(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """取消项目等待中或正在进行的同步、构建、二分定位或产物发布；指定 change 时取消该搁置变更的预提交构建"""
+        if args.get('change'):
+            return self.cancel_presubmit(project_name, str(args['change']))
+
+        task = self.project_tasks[project_name]
+        status = task.status
+
+        if status == ProjectStatus.PENDING_SYNC:
+            # 记录取消的版本，否则下次检查时会再次加入队列；有更新的变更时才重新同步
+            self.skipped_versions[project_name] = task.version
+            task.status = ProjectStatus.IDLE
+            return True, f"已移出同步队列，版本 {task.version} 不再自动同步"
+
+        if status == ProjectStatus.PENDING_BUILD:
+            task.status = ProjectStatus.IDLE
+            return True, "已移出构建队列"
+
+        if status == ProjectStatus.SYNCING and project_name in self.fanout_jobs:
+            # 分发任务在下一个文件之前停止，结束后才释放项目
+            self.fanout_jobs[project_name].cancelled.set()
+            return True, "正在取消共享同步分发"
+
+        if status == ProjectStatus.SYNCING:
+            if self.sync_process:
+                if not self.supervisor.kill_tree('sync'):
+                    return False, "同步进程未能结束，请稍后重试"
+                if self.sync_thread:
+                    self.sync_thread.join(timeout=1)
+            # 保留已完成的文件，下次同步同一版本时只续传剩余部分
+            progress = self.sync_progress
+            self.sync_retry.record_interruption(project_name, task.version,
+                                                progress.planned_files or None, progress.synced_files)
+            self.skipped_versions[project_name] = task.version
+            task.status = ProjectStatus.IDLE
+            self.current_sync_project = None
+            self.sync_process = None
+            self.sync_thread = None
+            self.abandon_prefill(project_name)
+            self.sync_progress = SyncProgress()
+            return True, f"已取消同步，版本 {task.version} 不再自动同步"
+
+        if status == ProjectStatus.BUILDING:
+            if project_name in self.remote_builds:
+                self.coordinator.cancel(self.remote_builds[project_name])
+                self.finish_remote_build(project_name)
+                task.status = ProjectStatus.IDLE
+                return True, "已取消代理上的构建"
+
+            window = self.project_windows[project_name]
+            self.history.record(project_name, 'build', time.time() - window.last_build_time,
+                                task.version, success=False)
+            self.finish_build_logs(project_name, window, failed=True)
+            # 与超时相同：确认进程树已结束并重启窗口后才释放构建槽位
+            task.status = ProjectStatus.FAILED
+            if self.reclaim_project_window(project_name):
+                task.status = ProjectStatus.IDLE
+                return True, "已取消构建"
+            return True, "正在结束构建进程"
+
+        if status == ProjectStatus.BISECTING:
+            self.bisector.cancel(project_name)
+            return True, "正在取消二分定位"
+
+        if status == ProjectStatus.VERIFYING:
+            self.verifier.cancel(project_name)
+            return True, "正在取消工作区校验"
+
+        if status == ProjectStatus.PUBLISHING:
+            self.artifacts.cancel(project_name)
+            return True, "正在取消产物发布"
+
+        return False, "没有等待中或正在进行的任务"
+
+    def cancel_presubmit(self, project_name: str, change: str) -> Tuple[bool, str]:
+        """取消等待中或正在进行的预提交构建"""
+        if not self.presubmit:
+            return False, "未启用预提交构建"
+        key = f"{project_name}@{change}"
+        for job in self.presubmit_queue:
+            if job.key == key:
+                self.presubmit_queue.remove(job)
+                return True, f"已移出预提交构建队列: 变更 {change}"
+        if key in self.presubmit.jobs:
+            self.presubmit.cancel(key)
+            return True, f"正在取消预提交构建: 变更 {change}"
+        return False, f"变更 {change} 没有等待中或正在进行的预提交构建"
+
+    def verify_workspace(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """校验项目工作区与have列表是否一致，repair（默认true）时重新同步不一致的文件"""
+        task = self.project_tasks[project_name]
+        if self.test_mode:
+            return False, "测试模式下没有工作区"
+        if task.status != ProjectStatus.IDLE:
+            return False, f"项目当前状态为 {task.status.value}"
+        leader = self.sync_leaders.get(project_name)
+        if leader and self.fanout.mode == 'shared':
+            return False, f"项目使用 {leader} 的工作区，请对 {leader} 执行校验"
+        if self.shared_followers_busy(project_name):
+            return False, "共用该工作区的项目正在构建"
+        if self.presubmit and self.presubmit.is_cloning(project_name):
+            return False, "预提交构建正在克隆该工作区"
+        project_config = self.projects[project_name]
+        if not project_config.get('local_path') or not project_config.get('depot_path'):
+            return False, "项目没有配置depot_path和local_path"
+
+        repair = args.get('repair', True)
+        if not isinstance(repair, bool):
+            return False, f"repair必须是true或false: {repair!r}"
+        self.verifier.start(project_name, project_config['depot_path'], project_config['local_path'],
+                            self.p4_servers.env(project_name), self.p4_servers.for_project(project_name), repair)
+        task.status = ProjectStatus.VERIFYING
+        return True, f"开始校验工作区{'并修复' if repair else ''}"
+
+    def pause_project(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """暂停项目：不再检查更新，也不开始新的同步或构建"""
+        if project_name in self.paused_projects:
+            return False, "项目已经暂停"
+        self.paused_projects.add(project_name)
+        self.project_tasks.mark_changed(project_name)
+        return True, "已暂停（正在进行的任务继续执行）"
+
+    def resume_project(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """恢复暂停的项目"""
+        if project_name not in self.paused_projects:
+            return False, "项目没有暂停"
+        self.paused_projects.discard(project_name)
+        self.project_tasks.mark_changed(project_name)
+        return True, "已恢复"
+
+    def set_project_priority(self, project_name: str, args: Dict) -> Tuple[bool, str]:
+        """运行时调整项目优先级（不写回配置文件）"""
+        priority = args.get('priority')
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            return False, f"priority必须是整数: {priority}"
+        old = self.projects[project_name].get('priority', 0)
+        self.projects[project_name]['priority'] = priority
+        self.project_tasks.mark_changed(project_name)
+        return True, f"优先级 {old} -> {priority}"
+
+    def project_snapshot(self, project_name: str) -> Dict:
+        """项目状态的快照（只包含可以JSON序列化的值）"""
+        task = self.project_tasks[project_name]
+        snapshot = {
+            'status': task.status.value,
+            'version': task.version,
+            'last_sync_version': self.last_sync_versions.get(project_name),
+            'skipped_version': self.skipped_versions.get(project_name),
+            'priority': self.projects[project_name].get('priority', 0),
+            'effective_priority': self.effective_priority(project_name),
+            'paused': project_name in self.paused_projects,
+            'last_update_time': task.last_update_time
+        }
+        if project_name in self.sync_leaders:
+            snapshot['sync_leader'] = self.sync_leaders[project_name]
+        if project_name in self.verify_results:
+            snapshot['last_verify'] = self.verify_results[project_name]
+        if project_name in self.publish_results:
+            snapshot['last_publish'] = self.publish_results[project_name]
+
+        if task.status == ProjectStatus.SYNCING:
+            snapshot['sync_start_time'] = task.sync_start_time
+        elif task.status == ProjectStatus.BUILDING:
+            snapshot['build_start_time'] = task.build_start_time
+            if project_name in self.remote_builds:
+                job = self.coordinator.get_job(self.remote_builds[project_name])
+                snapshot['agent'] = job.agent if job else None
+                snapshot['current_script'] = self.remote_scripts.get(project_name, "")
+            else:
+                window = self.project_windows[project_name]
+                snapshot['current_script'] = window.current_script
+                snapshot['build_log_dir'] = str(window.build_log_dir) if window.build_log_dir else None
+        elif task.status == ProjectStatus.VERIFYING:
+            session = self.verifier.sessions.get(project_name)
+            if session:
+                snapshot['verify'] = session.summary()
+        elif task.status == ProjectStatus.PUBLISHING:
+            session = self.artifacts.sessions.get(project_name)
+            if session:
+                snapshot['publish'] = session.summary()
+        elif task.status == ProjectStatus.BISECTING:
+            session = self.bisector.sessions.get(project_name)
+            if session:
+                snapshot['bisect'] = {
+                    'script': session.script,
+                    'good': session.good,
+                    'bad': session.bad,
+                    'remaining': session.remaining,
+                    'current_change': session.current_change,
+                    'probes': session.probes
+                }
+
+        # 等待同步的项目需要累加排在前面的项目，开销与队列长度成正比，只在status中显示
+        if task.status in (ProjectStatus.SYNCING, ProjectStatus.PENDING_BUILD, ProjectStatus.BUILDING):
+            snapshot['eta_seconds'] = self.estimate_remaining(project_name)
+        return snapshot
+
+    @timed('publish_snapshot')
+    def publish_snapshot(self, changed: List[str]):
+        """
+        生成状态快照并发布给控制接口
+
+        只重新生成状态变化的项目和处于活动状态的项目（耗时、有效优先级会随时间变化），
+        空闲项目沿用上次的快照，开销与活动项目数相关而不是与项目总数相关。
+        """
+        if not self.control_api:
+            return
+
+        active = set(changed)
+        for status in (ProjectStatus.PENDING_SYNC, ProjectStatus.SYNCING, ProjectStatus.PENDING_BUILD,
+                       ProjectStatus.BUILDING, ProjectStatus.BISECTING, ProjectStatus.VERIFYING,
+                       ProjectStatus.PUBLISHING):
+            active.update(self.project_tasks.with_status(status))
+        if not self.project_snapshots:
+            active.update(self.project_tasks)
+        for project_name in active:
+            if project_name in self.project_tasks:
+                self.project_snapshots[project_name] = self.project_snapshot(project_name)
+
+        sync = None
+        if self.current_sync_project:
+            progress = self.sync_progress
+            sync = {
+                'project': self.current_sync_project,
+                'total_files': progress.total_files,
+                'completed_files': progress.completed_files,
+                'bytes_transferred': progress.bytes_transferred,
+                'estimated_bytes': progress.estimated_bytes,
+                'current_file': progress.current_file,
+                'errors': len(progress.errors)
+            }
+
+        # 快照发布后不再修改：项目字典复制一份，每个项目的快照在重新生成时整体替换
+        self.control_api.publish({
+            'time': time.time(),
+            'test_mode': self.test_mode,
+            'projects': dict(self.project_snapshots),
+            'sync': sync,
+            'queues': {
+                'pending_sync': self.order_pending(
+                    self.project_tasks.with_status(ProjectStatus.PENDING_SYNC), 'sync'),
+                'pending_build': self.order_pending(
+                    self.project_tasks.with_status(ProjectStatus.PENDING_BUILD), 'build')
+            },
+            'running_builds': self.running_build_count(),
+            'max_parallel_builds': self.max_parallel_builds,
+            'bisects': self.bisector.describe() if self.bisector else [],
+            'presubmit': self.presubmit.snapshot() if self.presubmit else None,
+            'artifacts': self.artifacts.snapshot() if self.artifacts else None,
+            'agents': self.coordinator.describe() if self.coordinator else [],
+            'content_cache': self.content_cache.describe() if self.content_cache else None,
+            'host_load': self.resource_monitor.describe(),
+            'executor': self.executor.snapshot(),
+            'p4_servers': self.p4_servers.snapshot(),
+            'notifications': self.notifier.describe() if self.notifier else []
+        })
+
+    def wait_next_tick(self, seconds: float):
+        """等待下一个周期；收到控制命令时提前开始"""
+        if self.control_api:
+            self.control_api.wakeup.wait(seconds)
+            self.control_api.wakeup.clear()
+        else:
+            time.sleep(seconds)
+
+    @timed('show_status')
     def show_status(self):
         """显示当前状态"""
         status_info = []
 
-        # 统计各种状态的项目数
-        status_count = {}
-        for task in self.project_tasks.values():
-            status_count[task.status] = status_count.get(task.status, 0) + 1
-
         # 显示等待同步的项目
-        pending_sync = [name for name, task in self.project_tasks.items()
-                        if task.status == ProjectStatus.PENDING_SYNC]
+        pending_sync = self.project_tasks.with_status(ProjectStatus.PENDING_SYNC)
         if pending_sync:
+            ordered = self.order_pending(pending_sync, 'sync')
+            sync_waits = self.sync_queue_waits(ordered)
+            pending_sync = [f"{name} ({self.format_priority(name)}{self.format_eta(name, sync_waits)})"
+                            for name in ordered]
             status_info.append(f"等待同步: {', '.join(pending_sync)}")
 
+        # 显示正在同步的项目
+        if self.current_sync_project:
+            status_info.append(f"正在同步: {self.current_sync_project} "
+                               f"({self.format_eta(self.current_sync_project)})")
+
         # 显示正在构建的项目
         building = []
-        for name, task in self.project_tasks.items():
-            if task.status == ProjectStatus.BUILDING:
-                elapsed = (time.time() - task.build_start_time) / 60
-                building.append(f"{name} ({elapsed:.1f}分钟)")
+        for name in self.project_tasks.with_status(ProjectStatus.BUILDING):
+            task = self.project_tasks[name]
+            elapsed = (time.time() - task.build_start_time) / 60
+            job = self.coordinator.get_job(self.remote_builds[name]) if name in self.remote_builds else None
+            location = f"@{job.agent}" if job else ""
+            building.append(f"{name}{location} ({elapsed:.1f}分钟, {self.format_eta(name)})")
         if building:
             status_info.append(f"正在构建: {', '.join(building)}")
 
         # 显示等待构建的项目
-        pending_build = [name for name, task in self.project_tasks.items()
-                         if task.status == ProjectStatus.PENDING_BUILD]
+        pending_build = self.project_tasks.with_status(ProjectStatus.PENDING_BUILD)
         if pending_build:
+            pending_build = [f"{name} ({self.format_priority(name)}{self.format_eta(name)})"
+                             for name in self.order_pending(pending_build, 'build')]
             status_info.append(f"等待构建: {', '.join(pending_build)}")
 
+        # 显示正在进行的二分定位
+        if self.bisector:
+            bisects = self.bisector.describe()
+            if bisects:
+                status_info.append(f"二分定位: {', '.join(bisects)}")
+
+        # 显示预提交构建
+        if self.presubmit:
+            presubmits = self.presubmit.describe()
+            if self.presubmit_queue:
+                presubmits.append(f"等待 {len(self.presubmit_queue)}")
+            if presubmits:
+                status_info.append(f"预提交构建: {', '.join(presubmits)}")
+
+        # 显示正在发布的构建产物
+        if self.artifacts and self.artifacts.sessions:
+            status_info.append(f"产物发布: {', '.join(self.artifacts.describe())}")
+
+        # 显示正在进行的工作区校验
+        verifications = self.verifier.describe()
+        if verifications:
+            status_info.append(f"工作区校验: {', '.join(verifications)}")
+
+        # 显示主机负载
+        load = self.resource_monitor.describe()
+        if load and (self.current_sync_project or building):
+            status_info.append(f"主机负载: {load}")
+
+        # 显示本地文件缓存统计
+        if self.content_cache and (self.content_cache.stats['hits'] or self.content_cache.stats['misses']):
+            status_info.append(f"文件缓存: {self.content_cache.describe()}")
+
+        # 显示构建代理负载
+        if self.coordinator:
+            agents = self.coordinator.describe()
+            status_info.append(f"构建代理: {', '.join(agents) if agents else '无'}")
+
+        # 显示后台任务执行器的统计
+        if self.executor.depth['cpu'] or self.executor.depth['io']:
+            status_info.append(f"后台任务: {', '.join(self.executor.describe())}")
+
+        # 显示Perforce服务器的负载（有多个服务器时）
+        if len(self.p4_servers.in_use()) > 1:
+            status_info.append(f"P4服务器: {', '.join(self.p4_servers.describe())}")
+
+        # 显示暂停的项目
+        if self.paused_projects:
+            status_info.append(f"已暂停: {', '.join(sorted(self.paused_projects))}")
+
         # 输出状态信息
         if status_info:
             for info in status_info:
                 logger.info(f"  {info}")
 
+    def flush_history(self):
+        """有新记录且到了写入间隔时，在后台写入构建历史（每次只有一个写入任务）"""
+        if self.history_flush and not self.history_flush.done():
+            return
+        if not self.history.flush_due():
+            return
+        data = self.history.take_snapshot()
+        try:
+            self.history_flush = self.executor.submit('io', 'history_save', self.history.write, data, block=False)
+        except ExecutorBusy:
+            self.history.dirty = True
+
     def shutdown(self):
         """关闭所有窗口"""
         logger.info("关闭所有项目窗口...")
 
-        # 终止同步进程
+        # 写入尚未保存的构建历史
+        self.history.save()
+
+        # 停止控制接口
+        if self.control_api:
+            self.control_api.stop()
+
+        # 停止后台任务执行器和服务器线程
+        for job in self.fanout_jobs.values():
+            job.cancelled.set()
+        self.executor.shutdown()
+        self.p4_servers.shutdown()
+
+        # 取消代理上的构建并停止协调器
+        if self.coordinator:
+            for job_id in self.remote_builds.values():
+                self.coordinator.cancel(job_id)
+            self.coordinator.stop()
+
+        # 取消工作区校验和产物发布
+        for project_name in list(self.verifier.sessions):
+            self.verifier.cancel(project_name)
+        if self.artifacts:
+            for project_name in list(self.artifacts.sessions):
+                self.artifacts.cancel(project_name)
+
+        # 取消二分定位
+        if self.bisector:
+            for project_name in list(self.bisector.sessions):
+                self.bisector.cancel(project_name)
+
+        # 取消预提交构建（后台线程会删除临时工作区）
+        if self.presubmit:
+            for key in list(self.presubmit.jobs):
+                self.presubmit.cancel(key)
+
+        # 终止同步进程树
         if self.sync_process:
             logger.info("终止同步进程...")
-            self.sync_process.terminate()
+            self.supervisor.kill_tree('sync')
 
         for project_name, window in self.project_windows.items():
             try:
@@ -1037,12 +3195,13 @@ class P4VProjectManager:
                 window.command_file.write_text("EXIT", encoding='utf-8')
                 time.sleep(0.5)
 
-                # 终止进程
-                if window.process:
-                    window.process.terminate()
+                # 结束窗口的整个进程树（包括正在执行的构建脚本）
+                if not self.supervisor.kill_tree(self.window_key(project_name)):
+                    logger.error(f"项目 {project_name} 的构建进程未能完全结束")
 
                 # 清理文件
-                for file_path in [window.command_file, window.status_file, window.main_batch_file]:
+                for file_path in [window.command_file, window.status_file, window.status_reader.temp_file,
+                                  window.main_batch_file, window.log_dir_file]:
                     if file_path.exists():
                         try:
                             file_path.unlink()
@@ -1054,6 +3213,10 @@ class P4VProjectManager:
             except Exception as e:
                 logger.error(f"关闭项目 {project_name} 窗口时出错: {e}")
 
+        # 尽量发出已排队的通知
+        if self.notifier:
+            self.notifier.stop()
+
     def run(self):
         """主运行循环"""
         logger.info("=" * 60)
@@ -1068,57 +3231,64 @@ class P4VProjectManager:
         try:
             loop_count = 0
             while True:
-                loop_count += 1
-                current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                if self.test_mode:
-                    logger.info(f"[测试模式] 循环 #{loop_count} - 检查更新... ({current_time})")
-                else:
-                    logger.info(f"循环 #{loop_count} - 检查项目更新... ({current_time})")
-
-                # 检查所有项目并加入队列
-                for project_name, project_config in self.projects.items():
-                    if project_name in self.project_tasks:  # 确保项目已初始化
-                        self.check_and_queue_project(project_name, project_config)
+                self.profiler.begin_tick()
+
+                # 执行控制接口收到的命令
+                with self.profiler.phase('control_commands'):
+                    self.process_control_commands()
+
+                # 检查到期的项目并加入队列（每个项目按自己的检查间隔，由最小堆给出到期项目）
+                now = time.time()
+                due_projects = self.project_tasks.pop_due(now)
+                if due_projects:
+                    loop_count += 1
+                    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    if self.test_mode:
+                        logger.info(f"[测试模式] 循环 #{loop_count} - 检查 {len(due_projects)} 个项目的更新... "
+                                    f"({current_time})")
+                    else:
+                        logger.info(f"循环 #{loop_count} - 检查 {len(due_projects)} 个项目的更新... "
+                                    f"({current_time})")
+
+                    with self.profiler.phase('check_projects'):
+                        due_projects = [name for name in due_projects if name in self.projects]
+                        # 按服务器分组提交，每个服务器在自己的线程中按并发和速率限制执行
+                        for project_names in self.p4_servers.group_by_server(due_projects).values():
+                            for project_name in project_names:
+                                self.check_and_queue_project(project_name, self.projects[project_name])
+                                self.project_tasks.schedule_poll(project_name,
+                                                                 now + self.project_check_interval(project_name))
+
+                # 处理已返回的检查结果
+                with self.profiler.phase('collect_polls'):
+                    self.collect_polls()
 
                 # 处理同步队列（一次只同步一个）
-                self.process_sync_queue()
-
-                # 处理构建队列
-                self.process_build_queue()
-
-                # 监控构建窗口状态
-                self.monitor_build_windows()
-
-                # 显示当前状态
-                self.show_status()
-
-                # 计算下次检查时间
-                if self.test_mode:
-                    check_interval = 30  # 测试模式30秒
-                else:
-                    check_interval = min(
-                        project.get('check_interval', self.default_check_interval)
-                        for project in self.projects.values()
-                    )
-
-                logger.info(f"等待 {check_interval} 秒后进行下次检查...")
-                logger.info("-" * 60)
-
-                # 在等待期间继续处理队列和监控
-                wait_time = 0
-                while wait_time < check_interval:
-                    # 处理同步队列
+                with self.profiler.phase('sync_queue'):
                     self.process_sync_queue()
 
-                    # 处理构建队列
+                # 处理构建队列
+                with self.profiler.phase('build_queue'):
                     self.process_build_queue()
+                    self.process_presubmit()
 
-                    # 监控窗口状态
+                # 监控构建窗口状态
+                with self.profiler.phase('monitor_builds'):
                     self.monitor_build_windows()
 
-                    time.sleep(2)
-                    wait_time += 2
+                # 发布状态快照；有项目状态变化或完成一轮检查时显示当前状态
+                changed = self.project_tasks.drain_changed()
+                self.publish_snapshot(changed)
+                self.flush_history()
+                if changed or due_projects:
+                    self.show_status()
+                    next_due = self.project_tasks.next_due_time()
+                    if due_projects and next_due is not None:
+                        logger.info(f"下次检查: {datetime.fromtimestamp(next_due).strftime('%H:%M:%S')}")
+                        logger.info("-" * 60)
+
+                self.profiler.end_tick()
+                self.wait_next_tick(2)
 
         except KeyboardInterrupt:
             logger.info("接收到中断信号，正在关闭...")
@@ -1132,11 +3302,16 @@ class P4VProjectManager:
             raise
 
 
-def main():
-    """主函数"""
+def main(config_path: Optional[str] = None):
+    """
+    主函数
+
+    Args:
+        config_path: 配置文件（默认与本文件同目录的config.json）
+    """
     try:
         logger.info("启动 P4V Project Manager...")
-        config = r"O:\Person\Projects\interview\TestProject\P4VProjectManager\config.json"
+        config = config_path or str(Path(__file__).resolve().parent / 'config.json')
         manager = P4VProjectManager(config)
         logger.info("开始运行主循环...")
         manager.run()
@@ -1152,4 +3327,7 @@ def main():
 
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="P4V Project Manager（查询和控制正在运行的管理器请使用 manager_cli.py）")
+    parser.add_argument('--config', help="配置文件（默认与本文件同目录的config.json）")
+    sys.exit(main(parser.parse_args().config))
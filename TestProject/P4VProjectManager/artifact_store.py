@@ -0,0 +1,435 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+MB = 1024 * 1024
+# 每个压缩任务处理的块数（大文件拆成多个任务并行压缩）
+CHUNKS_PER_TASK = 16
+
+
+def store_chunks(objects_dir: str, path: str, offset: int, length: int, chunk_size: int,
+                 level: int) -> List[Tuple[str, int, int]]:
+    """
+    读取文件的一段，按 chunk_size 切块，压缩并保存仓库中还没有的块（模块级函数，可以在工作进程中执行）
+
+    块按内容的SHA-256保存在 <objects_dir>/<前两位>/<digest>，先写临时文件再改名，
+    多个进程同时写入同一个块也不会留下写了一半的文件。
+
+    Returns:
+        [(digest, 原始大小, 本次写入的压缩大小（块已存在时为0）)]
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            digest = hashlib.sha256(data).hexdigest()
+            target = os.path.join(objects_dir, digest[:2], digest)
+            written = 0
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                compressed = zlib.compress(data, level)
+                temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp, 'wb') as out:
+                    out.write(compressed)
+                os.replace(temp, target)
+                written = len(compressed)
+            chunks.append((digest, len(data), written))
+    return chunks
+
+
+@dataclass
+class PublishSession:
+    """一次构建产物的发布"""
+    project_name: str
+    platform: str
+    changelist: str
+    state: str = "queued"  # queued / running / published / empty / error / cancelled
+    files: int = 0
+    bytes: int = 0  # 产物的原始大小
+    chunks: int = 0
+    new_chunks: int = 0
+    new_bytes: int = 0  # 新写入仓库的压缩大小（其余块与之前的构建重复）
+    error: str = ""
+    start_time: float = field(default_factory=time.time)
+    end_time: float = 0
+
+    def summary(self) -> Dict:
+        """结果摘要（可以JSON序列化）"""
+        return {
+            'state': self.state,
+            'platform': self.platform,
+            'changelist': self.changelist,
+            'files': self.files,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'new_chunks': self.new_chunks,
+            'new_bytes': self.new_bytes,
+            'error': self.error,
+            'start_time': self.start_time,
+            'elapsed': (self.end_time or time.time()) - self.start_time
+        }
+
+
+class ArtifactStore:
+    """
+    构建产物仓库（按内容寻址，块级去重）
+
+    构建成功后收集项目声明的产物（相对工作区的glob），把每个文件切成固定大小的块，
+    在执行器的工作进程中并行计算SHA-256并压缩；仓库中已有的块（之前的构建产生的相同内容）不再写入。
+    每次发布的文件列表（每个文件的块）保存在 sets/<项目>/<平台>/<变更号>.json，
+    index.json 按 项目 -> 平台 -> 变更号 记录所有发布和每个块的引用计数。
+    每个项目和平台只保留最近的 keep_builds 次发布，总大小超过 max_bytes 时淘汰最早的发布，
+    块的引用计数为0时删除。发布在后台线程中依次执行，淘汰不会与正在进行的发布同时进行。
+    """
+
+    def __init__(self, root: Path, executor=None, chunk_size: int = 4 * MB, level: int = 6,
+                 keep_builds: int = 10, max_bytes: int = 0):
+        """
+        Args:
+            root: 仓库目录
+            executor: 后台任务执行器（TaskExecutor），只读取或恢复产物时可以为None
+            chunk_size: 块大小（字节）
+            level: zlib压缩级别（1-9）
+            keep_builds: 每个项目和平台保留的发布数
+            max_bytes: 仓库总大小上限（压缩后，字节），0表示不限制
+        """
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.sets_dir = self.root / 'sets'
+        self.index_file = self.root / 'index.json'
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.level = level
+        self.keep_builds = keep_builds
+        self.max_bytes = max_bytes
+        # {项目: {平台: {变更号: 摘要}}}
+        self.sets: Dict[str, Dict[str, Dict[str, Dict]]] = {}
+        # {digest: [引用计数, 压缩大小]}
+        self.chunks: Dict[str, List[int]] = {}
+        self.total_bytes = 0
+        self.sessions: Dict[str, PublishSession] = {}
+        self.lock = threading.Lock()  # 保护索引
+        self.publish_lock = threading.Lock()  # 发布和淘汰依次执行
+        self.load()
+
+    def load(self):
+        if not self.index_file.exists():
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载产物仓库索引失败: {e}")
+            return
+        self.sets = data.get('sets', {})
+        self.chunks = data.get('chunks', {})
+        self.total_bytes = sum(size for _, size in self.chunks.values())
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'sets': self.sets, 'chunks': self.chunks})
+        self.root.mkdir(parents=True, exist_ok=True)
+        temp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_file, self.index_file)
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+
+    def manifest_path(self, project_name: str, platform: str, changelist: str) -> Path:
+        return self.sets_dir / project_name / platform / f"{changelist}.json"
+
+    @staticmethod
+    def collect(root: Path, patterns: List[str]) -> List[Tuple[str, Path]]:
+        """按glob收集产物文件，返回 (相对root的路径, 文件) 列表"""
+        files: Dict[str, Path] = {}
+        for pattern in patterns:
+            for path in sorted(root.glob(pattern)):
+                if path.is_file():
+                    files.setdefault(path.relative_to(root).as_posix(), path)
+        return sorted(files.items())
+
+    def start(self, project_name: str, platform: str, changelist: str, root: Path,
+              patterns: List[str]) -> PublishSession:
+        """
+        开始发布（在后台线程中执行）
+
+        Args:
+            project_name: 项目名称
+            platform: 平台
+            changelist: 构建的变更号
+            root: 产物路径的根目录（项目工作区）
+            patterns: 产物的glob（相对root）
+        """
+        session = PublishSession(project_name, platform, changelist)
+        self.sessions[project_name] = session
+        thread = threading.Thread(target=self.run, args=(session, Path(root), patterns),
+                                  name=f"publish-{project_name}", daemon=True)
+        thread.start()
+        return session
+
+    def run(self, session: PublishSession, root: Path, patterns: List[str]):
+        with self.publish_lock:
+            try:
+                if session.state == "queued":
+                    session.state = "running"
+                    self.publish(session, root, patterns)
+            except Exception as e:
+                session.state = "error"
+                session.error = str(e)
+            finally:
+                session.end_time = time.time()
+
+    def publish(self, session: PublishSession, root: Path, patterns: List[str]):
+        files = self.collect(root, patterns)
+        if not files:
+            session.state = "empty"
+            return
+        session.files = len(files)
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+
+        # 大文件拆成多段，每段在工作进程中切块、哈希和压缩（队列满时等待）
+        segment = self.chunk_size * CHUNKS_PER_TASK
+        tasks = []
+        manifest_files = {}
+        for relative, path in files:
+            stat_result = path.stat()
+            session.bytes += stat_result.st_size
+            manifest_files[relative] = {'size': stat_result.st_size, 'mode': stat_result.st_mode & 0o777,
+                                        'mtime': stat_result.st_mtime, 'chunks': []}
+            for offset in range(0, max(stat_result.st_size, 1), segment):
+                length = min(segment, stat_result.st_size - offset)
+                future = self.executor.submit('cpu', 'artifact_chunks', store_chunks, str(self.objects_dir),
+                                              str(path), offset, length, self.chunk_size, self.level)
+                tasks.append((relative, future))
+
+        # 取消或出错后仍等待已开始的任务，记录它们写入的块以便删除
+        new_chunks: Dict[str, int] = {}
+        error = None
+        for relative, future in tasks:
+            if (session.state != "running" or error) and future.cancel():
+                continue
+            try:
+                chunks = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            for digest, size, written in chunks:
+                manifest_files[relative]['chunks'].append(digest)
+                session.chunks += 1
+                if written and digest not in new_chunks:
+                    new_chunks[digest] = written
+        if error or session.state != "running":
+            self.discard(new_chunks)
+            if error:
+                raise error
+            return
+
+        manifest = {
+            'project': session.project_name,
+            'platform': session.platform,
+            'changelist': session.changelist,
+            'time': time.time(),
+            'chunk_size': self.chunk_size,
+            'files': manifest_files
+        }
+        manifest_path = self.manifest_path(session.project_name, session.platform, session.changelist)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+
+        with self.lock:
+            previous = self.sets.get(session.project_name, {}).get(session.platform, {}).get(session.changelist)
+            # 同一变更重新构建时替换之前的发布：先增加新引用再释放旧引用，共用的块不会被删除
+            for file_info in manifest_files.values():
+                for digest in file_info['chunks']:
+                    entry = self.chunks.get(digest)
+                    if entry is None:
+                        size = new_chunks.get(digest) or self.chunk_path(digest).stat().st_size
+                        entry = self.chunks[digest] = [0, size]
+                        self.total_bytes += size
+                        session.new_chunks += 1
+                        session.new_bytes += size
+                    entry[0] += 1
+            old_chunks = self.read_chunks(session.project_name, session.platform, session.changelist) \
+                if previous else []
+            os.replace(temp_file, manifest_path)
+            self.release_chunks(old_chunks)
+            self.sets.setdefault(session.project_name, {}).setdefault(session.platform, {})[session.changelist] = {
+                'time': manifest['time'],
+                'files': session.files,
+                'bytes': session.bytes,
+                'new_bytes': session.new_bytes
+            }
+            self.evict(session.project_name, session.platform, session.changelist)
+        self.save()
+        session.state = "published"
+
+    def discard(self, digests: Dict[str, int]):
+        """删除未完成的发布写入的、没有被任何发布引用的块"""
+        with self.lock:
+            unreferenced = [digest for digest in digests if digest not in self.chunks]
+        for digest in unreferenced:
+            try:
+                self.chunk_path(digest).unlink()
+            except OSError:
+                pass
+
+    def read_manifest(self, project_name: str, platform: str, changelist: str) -> Dict:
+        with open(self.manifest_path(project_name, platform, changelist), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def read_chunks(self, project_name: str, platform: str, changelist: str) -> List[str]:
+        """一次发布引用的所有块（清单无法读取时返回空列表）"""
+        try:
+            manifest = self.read_manifest(project_name, platform, changelist)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取产物清单 {project_name}/{platform}/{changelist} 失败: {e}")
+            return []
+        return [digest for file_info in manifest['files'].values() for digest in file_info['chunks']]
+
+    def release_chunks(self, digests: List[str]):
+        """释放块的引用，引用计数为0时删除（调用者持有锁）"""
+        for digest in digests:
+            entry = self.chunks.get(digest)
+            if entry is None:
+                continue
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self.chunks[digest]
+                self.total_bytes -= entry[1]
+                try:
+                    self.chunk_path(digest).unlink()
+                except OSError as e:
+                    logger.debug(f"删除产物块 {digest} 失败: {e}")
+
+    def remove_set(self, project_name: str, platform: str, changelist: str):
+        """删除一次发布（调用者持有锁）"""
+        self.release_chunks(self.read_chunks(project_name, platform, changelist))
+        platforms = self.sets.get(project_name, {})
+        platforms.get(platform, {}).pop(changelist, None)
+        if not platforms.get(platform):
+            platforms.pop(platform, None)
+        if not platforms:
+            self.sets.pop(project_name, None)
+        try:
+            self.manifest_path(project_name, platform, changelist).unlink()
+        except OSError:
+            pass
+
+    def evict(self, project_name: str, platform: str, keep: str):
+        """
+        按保留策略淘汰发布（调用者持有锁）
+
+        先只保留该项目和平台最近的 keep_builds 次发布，总大小仍超过上限时按发布时间淘汰所有项目中最早的发布，
+        刚发布的 keep 不会被淘汰。
+        """
+        builds = self.sets.get(project_name, {}).get(platform, {})
+        ordered = sorted(builds, key=lambda name: builds[name]['time'])
+        for changelist in ordered[:max(0, len(ordered) - self.keep_builds)]:
+            if changelist != keep:
+                self.remove_set(project_name, platform, changelist)
+                logger.info(f"淘汰构建产物 {project_name}/{platform}/{changelist}（超过保留数 {self.keep_builds}）")
+
+        if not self.max_bytes or self.total_bytes <= self.max_bytes:
+            return
+        candidates = sorted(((info['time'], project, plat, changelist)
+                             for project, platforms in self.sets.items()
+                             for plat, changelists in platforms.items()
+                             for changelist, info in changelists.items()
+                             if (project, plat, changelist) != (project_name, platform, keep)))
+        for _, project, plat, changelist in candidates:
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.remove_set(project, plat, changelist)
+            logger.info(f"淘汰构建产物 {project}/{plat}/{changelist}（仓库超过 {self.max_bytes / MB:.0f}MB）")
+
+    def find(self, project_name: str, platform: Optional[str] = None,
+             changelist: Optional[str] = None) -> Optional[Tuple[str, str, Dict]]:
+        """
+        查找发布
+
+        Args:
+            platform: 平台，None表示任意平台
+            changelist: 变更号，None表示最近的发布
+
+        Returns:
+            (平台, 变更号, 摘要)，没有时返回None
+        """
+        with self.lock:
+            platforms = self.sets.get(project_name, {})
+            matches = [(info['time'], plat, change, info)
+                       for plat, changelists in platforms.items() if platform in (None, plat)
+                       for change, info in changelists.items() if changelist in (None, change)]
+        if not matches:
+            return None
+        _, plat, change, info = max(matches, key=lambda item: item[0])
+        return plat, change, info
+
+    def restore(self, project_name: str, platform: str, changelist: str, target: Path) -> int:
+        """
+        把一次发布的文件恢复到目录中
+
+        Returns:
+            恢复的文件数
+        """
+        manifest = self.read_manifest(project_name, platform, changelist)
+        target = Path(target)
+        for relative, file_info in manifest['files'].items():
+            path = target / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = path.with_name(path.name + '.tmp')
+            with open(temp, 'wb') as out:
+                for digest in file_info['chunks']:
+                    out.write(zlib.decompress(self.chunk_path(digest).read_bytes()))
+            if temp.stat().st_size != file_info['size']:
+                temp.unlink()
+                raise RuntimeError(f"恢复的文件大小不一致: {relative}")
+            os.chmod(temp, file_info['mode'] or 0o644)
+            os.replace(temp, path)
+        return len(manifest['files'])
+
+    def cancel(self, project_name: str):
+        session = self.sessions.get(project_name)
+        if session and session.state in ("queued", "running"):
+            session.state = "cancelled"
+
+    def finished(self) -> List[Tuple[str, PublishSession]]:
+        """取出已结束的发布"""
+        done = [(name, session) for name, session in self.sessions.items() if session.end_time]
+        for name, _ in done:
+            del self.sessions[name]
+        return done
+
+    def describe(self) -> List[str]:
+        """正在进行的发布的文字描述"""
+        descriptions = []
+        for name, session in self.sessions.items():
+            if session.state == "queued":
+                descriptions.append(f"{name} (等待)")
+            else:
+                descriptions.append(f"{name} ({session.files} 个文件, {session.bytes / MB:.0f}MB)")
+        return descriptions
+
+    def snapshot(self) -> Dict:
+        """仓库统计（可以JSON序列化）"""
+        with self.lock:
+            builds = sum(len(changelists) for platforms in self.sets.values() for changelists in platforms.values())
+            return {'builds': builds, 'chunks': len(self.chunks), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
@@ -0,0 +1,106 @@
+"""
+任务表调度开销基准测试
+
+模拟主循环每个周期的调度查询（等待同步、等待构建、正在构建、构建计数、到期检查），
+对比逐个扫描全部项目与使用按状态索引的任务表的耗时。每个周期随机改变少量项目的状态。
+
+用法: python bench_task_table.py [--projects 1000 2000 5000 10000] [--ticks 500] [--changes 5]
+"""
+import time
+import random
+import argparse
+from typing import Dict, List
+
+from task_table import ProjectStatus, ProjectTask, TaskTable
+
+# 模拟的状态流转
+NEXT_STATUS = {
+    ProjectStatus.IDLE: ProjectStatus.PENDING_SYNC,
+    ProjectStatus.PENDING_SYNC: ProjectStatus.SYNCING,
+    ProjectStatus.SYNCING: ProjectStatus.PENDING_BUILD,
+    ProjectStatus.PENDING_BUILD: ProjectStatus.BUILDING,
+    ProjectStatus.BUILDING: ProjectStatus.IDLE,
+}
+
+
+def make_tasks(count: int) -> List[ProjectTask]:
+    return [ProjectTask(project_name=f"project_{i:05d}", depot_path=f"//depot/p{i}/...",
+                        local_path=f"D:/p{i}", version="") for i in range(count)]
+
+
+def scan_tick(tasks: Dict[str, ProjectTask], intervals: Dict[str, float]):
+    """原先的做法：每次查询都扫描全部项目"""
+    pending_sync = [name for name, task in tasks.items() if task.status == ProjectStatus.PENDING_SYNC]
+    pending_build = [name for name, task in tasks.items() if task.status == ProjectStatus.PENDING_BUILD]
+    building = [name for name, task in tasks.items() if task.status == ProjectStatus.BUILDING]
+    running = sum(1 for task in tasks.values() if task.status == ProjectStatus.BUILDING)
+    check_interval = min(intervals.values())
+    return pending_sync, pending_build, building, running, check_interval
+
+
+def table_tick(table: TaskTable, now: float):
+    """任务表：只访问相关状态的项目"""
+    pending_sync = table.with_status(ProjectStatus.PENDING_SYNC)
+    pending_build = table.with_status(ProjectStatus.PENDING_BUILD)
+    building = table.with_status(ProjectStatus.BUILDING)
+    running = table.count(ProjectStatus.BUILDING)
+    for name in table.pop_due(now):
+        table.schedule_poll(name, now + 300)
+    table.drain_changed()
+    return pending_sync, pending_build, building, running
+
+
+def mutate(tasks: List[ProjectTask], rng: random.Random, changes: int):
+    for task in rng.sample(tasks, changes):
+        task.status = NEXT_STATUS.get(task.status, ProjectStatus.IDLE)
+
+
+def run(count: int, ticks: int, changes: int) -> Dict[str, float]:
+    rng = random.Random(count)
+
+    # 逐个扫描
+    tasks = make_tasks(count)
+    by_name = {task.project_name: task for task in tasks}
+    intervals = {task.project_name: 300.0 for task in tasks}
+    elapsed_scan = 0.0
+    for _ in range(ticks):
+        mutate(tasks, rng, changes)
+        start = time.perf_counter()
+        scan_tick(by_name, intervals)
+        elapsed_scan += time.perf_counter() - start
+
+    # 任务表
+    rng = random.Random(count)
+    tasks = make_tasks(count)
+    table = TaskTable()
+    now = 0.0
+    for i, task in enumerate(tasks):
+        table.add(task)
+        table.schedule_poll(task.project_name, now + 300 * i / count)
+    elapsed_table = 0.0
+    for _ in range(ticks):
+        mutate(tasks, rng, changes)
+        now += 2
+        start = time.perf_counter()
+        table_tick(table, now)
+        elapsed_table += time.perf_counter() - start
+
+    return {'scan': elapsed_scan / ticks * 1000, 'table': elapsed_table / ticks * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="任务表调度开销基准测试")
+    parser.add_argument('--projects', type=int, nargs='+', default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--ticks', type=int, default=500, help="模拟的周期数")
+    parser.add_argument('--changes', type=int, default=5, help="每个周期状态变化的项目数")
+    args = parser.parse_args()
+
+    print(f"{'项目数':>8} {'扫描(ms/周期)':>14} {'任务表(ms/周期)':>16} {'加速':>8}")
+    for count in args.projects:
+        result = run(count, args.ticks, min(args.changes, count))
+        speedup = result['scan'] / result['table'] if result['table'] else float('inf')
+        print(f"{count:>8} {result['scan']:>14.3f} {result['table']:>16.3f} {speedup:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
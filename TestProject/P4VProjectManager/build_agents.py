@@ -0,0 +1,503 @@
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+import socketserver
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+from process_supervisor import ProcessSupervisor
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 协议: TCP 上每行一个 JSON 消息
+#   代理 -> 协调器: register / heartbeat / status，每条消息都带共享令牌 token
+#   协调器 -> 代理: build / cancel
+
+# 代理从该环境变量读取共享令牌（避免令牌出现在命令行中）
+TOKEN_ENV = 'P4V_AGENT_TOKEN'
+
+
+def send_message(sock: socket.socket, lock: threading.Lock, message: Dict):
+    """发送一条消息"""
+    data = (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+    with lock:
+        sock.sendall(data)
+
+
+@dataclass
+class AgentInfo:
+    """已注册的构建代理"""
+    name: str
+    capacity: int
+    platforms: List[str]
+    sock: socket.socket
+    send_lock: threading.Lock = field(default_factory=threading.Lock)
+    last_seen: float = field(default_factory=time.time)
+    jobs: Set[str] = field(default_factory=set)
+
+    @property
+    def load(self) -> float:
+        return len(self.jobs) / self.capacity
+
+    def supports(self, platform: str) -> bool:
+        return not platform or platform in self.platforms
+
+
+@dataclass
+class RemoteJob:
+    """分派到代理的构建任务"""
+    job_id: str
+    project_name: str
+    platform: str
+    agent: str
+    state: str = "dispatched"  # dispatched / running / completed / failed / lost
+    current_script: str = ""
+    detail: str = ""
+    start_time: float = field(default_factory=time.time)
+    finish_time: float = 0
+    cancelled: bool = False  # 已发出取消，不再接受代理回传的状态
+
+
+class AgentCoordinator:
+    """
+    构建协调器
+
+    代理主动连接协调器并注册自己的并行能力(capacity)和支持的平台。协调器把等待构建的项目
+    分派给支持该平台且负载最低的代理，代理通过同一连接回传构建状态。
+    代理超过 heartbeat_timeout 没有消息时视为离线，其上的任务标记为 lost，由管理器重新分派；
+    同名代理重新注册（如重连）时，上一个连接的任务同样标记为 lost，代理断开时也会结束这些任务。
+    取消的任务在代理确认（回传结束状态）之前仍占用代理的名额。
+
+    任务内容包含depot路径和p4连接设置，代理会执行其中的脚本，因此代理的每条消息都必须带有
+    与协调器相同的共享令牌，令牌不符时断开连接。默认只监听本机地址。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 7010, heartbeat_timeout: float = 30,
+                 token: str = ''):
+        if not token:
+            raise ValueError("构建协调器需要配置共享令牌(token)")
+        self.token = token.encode('utf-8')
+        self.host = host
+        self.port = port
+        self.heartbeat_timeout = heartbeat_timeout
+        self.agents: Dict[str, AgentInfo] = {}
+        self.jobs: Dict[str, RemoteJob] = {}
+        self.lock = threading.Lock()
+        self.server: Optional[socketserver.ThreadingTCPServer] = None
+        self.job_counter = 0
+
+    def start(self):
+        """在后台线程中开始监听代理连接"""
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator.handle_connection(self.request, self.rfile)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"构建协调器已启动，监听 {self.host}:{self.port}")
+
+    def stop(self):
+        """停止监听并断开所有代理"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self.lock:
+            for agent in self.agents.values():
+                try:
+                    agent.sock.close()
+                except OSError:
+                    pass
+            self.agents.clear()
+
+    def authenticated(self, message: Dict) -> bool:
+        """消息是否带有正确的共享令牌"""
+        return hmac.compare_digest(str(message.get('token', '')).encode('utf-8'), self.token)
+
+    def handle_connection(self, sock: socket.socket, rfile):
+        """处理一个代理连接（在服务器线程中运行）"""
+        agent_name = None
+        try:
+            for raw in rfile:
+                message = json.loads(raw.decode('utf-8'))
+                message_type = message.get('type')
+
+                if not self.authenticated(message):
+                    peer = sock.getpeername()
+                    logger.warning(f"拒绝来自 {peer[0]}:{peer[1]} 的未认证代理消息 ({message_type})")
+                    break
+
+                if message_type == 'register':
+                    agent_name = message['name']
+                    with self.lock:
+                        previous = self.agents.get(agent_name)
+                        lost = self.lose_jobs(previous) if previous else 0
+                        if previous:
+                            try:
+                                previous.sock.close()
+                            except OSError:
+                                pass
+                        self.agents[agent_name] = AgentInfo(
+                            name=agent_name,
+                            capacity=max(1, int(message.get('capacity', 1))),
+                            platforms=list(message.get('platforms', [])),
+                            sock=sock
+                        )
+                    if previous:
+                        logger.warning(f"构建代理 {agent_name} 重新注册，上一个连接的 {lost} 个任务需要重新分派")
+                    logger.info(f"构建代理已注册: {agent_name} (并行: {message.get('capacity', 1)}, "
+                                f"平台: {', '.join(message.get('platforms', [])) or '任意'})")
+                    continue
+
+                if agent_name is None:
+                    continue
+
+                with self.lock:
+                    agent = self.agents.get(agent_name)
+                    if agent is None or agent.sock is not sock:
+                        break
+                    agent.last_seen = time.time()
+
+                    if message_type == 'status':
+                        self.update_job(agent, message)
+
+        except (OSError, ValueError) as e:
+            logger.debug(f"代理连接出错: {e}")
+        finally:
+            if agent_name:
+                self.remove_agent(agent_name, sock, "连接断开")
+
+    def update_job(self, agent: AgentInfo, message: Dict):
+        """根据代理回传的状态更新任务（调用方持有锁）"""
+        job_id = message.get('job_id')
+        if job_id not in agent.jobs:
+            # 已结束的任务，或代理上一个连接的任务（已标记为lost）
+            return
+
+        state = message.get('state', '')
+        if state in ('completed', 'failed'):
+            # 取消的任务在此时才释放名额（管理器可能已删除任务记录）
+            agent.jobs.discard(job_id)
+
+        job = self.jobs.get(job_id)
+        if job is None or job.cancelled:
+            return
+        job.state = state or job.state
+        job.current_script = message.get('script', job.current_script)
+        job.detail = message.get('detail', job.detail)
+        if job.state in ('completed', 'failed'):
+            job.finish_time = time.time()
+
+    def lose_jobs(self, agent: AgentInfo) -> int:
+        """把代理上未完成的任务标记为lost（调用方持有锁）"""
+        lost = 0
+        for job_id in agent.jobs:
+            job = self.jobs.get(job_id)
+            if job and job.state in ('dispatched', 'running'):
+                job.state = 'lost'
+                job.finish_time = time.time()
+                lost += 1
+        agent.jobs.clear()
+        return lost
+
+    def remove_agent(self, agent_name: str, sock: Optional[socket.socket], reason: str):
+        """移除代理，其上未完成的任务标记为lost"""
+        with self.lock:
+            agent = self.agents.get(agent_name)
+            if agent is None or (sock is not None and agent.sock is not sock):
+                return
+            del self.agents[agent_name]
+            self.lose_jobs(agent)
+            try:
+                agent.sock.close()
+            except OSError:
+                pass
+        logger.warning(f"构建代理 {agent_name} 已离线: {reason}")
+
+    def check_agents(self):
+        """移除心跳超时的代理"""
+        now = time.time()
+        with self.lock:
+            expired = [name for name, agent in self.agents.items()
+                       if now - agent.last_seen > self.heartbeat_timeout]
+        for name in expired:
+            self.remove_agent(name, None, "心跳超时")
+
+    def has_agent(self, platform: str = "") -> bool:
+        """是否有支持该平台的在线代理"""
+        with self.lock:
+            return any(agent.supports(platform) for agent in self.agents.values())
+
+    def dispatch(self, project_name: str, platform: str, payload: Dict) -> Optional[str]:
+        """
+        分派构建任务给支持该平台且负载最低的代理
+
+        Returns:
+            任务ID，没有可用代理时返回None
+        """
+        with self.lock:
+            candidates = [agent for agent in self.agents.values()
+                          if agent.supports(platform) and len(agent.jobs) < agent.capacity]
+            if not candidates:
+                return None
+            agent = min(candidates, key=lambda a: (a.load, len(a.jobs)))
+
+            self.job_counter += 1
+            job_id = f"{project_name}-{int(time.time())}-{self.job_counter}"
+            message = dict(payload, type='build', job_id=job_id, project=project_name)
+            try:
+                send_message(agent.sock, agent.send_lock, message)
+            except OSError as e:
+                logger.warning(f"向代理 {agent.name} 分派任务失败: {e}")
+                return None
+
+            agent.jobs.add(job_id)
+            self.jobs[job_id] = RemoteJob(job_id=job_id, project_name=project_name,
+                                          platform=platform, agent=agent.name)
+        logger.info(f"项目 {project_name} 的构建已分派到代理 {agent.name} (任务: {job_id})")
+        return job_id
+
+    def cancel(self, job_id: str):
+        """
+        取消任务
+
+        任务立即标记为失败，但在代理确认（回传结束状态）之前仍占用代理的名额，
+        避免在脚本还没有结束时向该代理分派新的任务；代理断开时名额随之释放。
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.cancelled:
+                return
+            job.cancelled = True
+            job.state = 'failed'
+            job.detail = 'cancelled'
+            job.finish_time = time.time()
+
+            agent = self.agents.get(job.agent)
+            if agent is None or job_id not in agent.jobs:
+                return
+            try:
+                send_message(agent.sock, agent.send_lock, {'type': 'cancel', 'job_id': job_id})
+            except OSError as e:
+                logger.warning(f"向代理 {agent.name} 发送取消失败: {e}")
+
+    def get_job(self, job_id: str) -> Optional[RemoteJob]:
+        """获取任务状态"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_job(self, job_id: str):
+        """任务处理完毕后删除记录"""
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def describe(self) -> List[str]:
+        """各代理负载的文字描述"""
+        with self.lock:
+            return [f"{agent.name} {len(agent.jobs)}/{agent.capacity}" for agent in self.agents.values()]
+
+
+class BuildAgent:
+    """
+    构建代理
+
+    连接协调器并注册，按收到的任务在本机依次执行项目的构建脚本，通过同一连接回传状态。
+    连接断开后自动重连；重连后协调器会重新分派断开前的任务，因此断开时结束正在执行的任务。
+    可以在其他机器上运行，也可以在本机以独立进程运行用于测试。
+    """
+
+    def __init__(self, coordinator: str, name: str, capacity: int = 1,
+                 platforms: Optional[List[str]] = None, path_map: Optional[Dict[str, str]] = None,
+                 sync: bool = False, heartbeat_interval: float = 5, token: str = ''):
+        host, _, port = coordinator.rpartition(':')
+        self.token = token
+        self.address = (host or '127.0.0.1', int(port))
+        self.name = name
+        self.capacity = capacity
+        self.platforms = platforms or []
+        self.path_map = path_map or {}
+        self.sync = sync
+        self.heartbeat_interval = heartbeat_interval
+        self.sock: Optional[socket.socket] = None
+        self.send_lock = threading.Lock()
+        self.supervisor = ProcessSupervisor()
+        self.active: Set[str] = set()  # 正在执行的任务
+        self.cancelled: Set[str] = set()
+        self.jobs_lock = threading.Lock()
+        self.running = True
+
+    def map_path(self, path: str) -> str:
+        """把协调器上的路径映射到本机路径"""
+        for source, target in self.path_map.items():
+            if path.lower().startswith(source.lower()):
+                return target + path[len(source):]
+        return path
+
+    def send(self, message: Dict):
+        try:
+            if self.sock:
+                send_message(self.sock, self.send_lock, dict(message, token=self.token))
+        except OSError as e:
+            logger.debug(f"发送消息失败: {e}")
+
+    def run(self):
+        """连接协调器并处理任务，断开后重连"""
+        while self.running:
+            try:
+                self.sock = socket.create_connection(self.address, timeout=10)
+                self.sock.settimeout(None)
+                self.send({'type': 'register', 'name': self.name, 'capacity': self.capacity,
+                           'platforms': self.platforms})
+                logger.info(f"已连接协调器 {self.address[0]}:{self.address[1]}")
+
+                threading.Thread(target=self.heartbeat_loop, args=(self.sock,), daemon=True).start()
+
+                for raw in self.sock.makefile('rb'):
+                    message = json.loads(raw.decode('utf-8'))
+                    if message.get('type') == 'build':
+                        threading.Thread(target=self.run_job, args=(message,), daemon=True).start()
+                    elif message.get('type') == 'cancel':
+                        self.cancel_job(message['job_id'])
+            except (OSError, ValueError) as e:
+                logger.warning(f"与协调器的连接出错: {e}")
+            finally:
+                if self.sock:
+                    self.sock.close()
+                    self.sock = None
+                # 协调器已把这些任务标记为lost并会重新分派
+                with self.jobs_lock:
+                    orphaned = list(self.active)
+                for job_id in orphaned:
+                    logger.warning(f"与协调器的连接已断开，结束任务 {job_id}")
+                    self.cancel_job(job_id)
+
+            if self.running:
+                time.sleep(5)
+
+    def heartbeat_loop(self, sock: socket.socket):
+        """定期发送心跳（连接更换后退出）"""
+        while self.running and self.sock is sock:
+            self.send({'type': 'heartbeat'})
+            time.sleep(self.heartbeat_interval)
+
+    def cancel_job(self, job_id: str):
+        """取消任务：结束正在执行的脚本进程树，任务线程在开始下一个脚本前检查取消标记"""
+        with self.jobs_lock:
+            if job_id not in self.active:
+                # 任务已经结束：再次回传结束状态，协调器据此释放名额
+                self.send({'type': 'status', 'job_id': job_id, 'state': 'failed', 'detail': 'cancelled'})
+                return
+            self.cancelled.add(job_id)
+        self.supervisor.kill_tree(job_id)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self.jobs_lock:
+            return job_id in self.cancelled
+
+    def run_job(self, job: Dict):
+        """依次执行构建脚本并回传状态"""
+        job_id = job['job_id']
+        scripts_path = Path(self.map_path(job['scripts_path']))
+        local_path = self.map_path(job.get('local_path', '')) or None
+
+        def report(state: str, script: str = "", detail: str = ""):
+            self.send({'type': 'status', 'job_id': job_id, 'state': state,
+                       'script': script, 'detail': detail})
+
+        with self.jobs_lock:
+            self.active.add(job_id)
+        report('running')
+        try:
+            if self.sync and job.get('depot_path'):
+                target = job['depot_path'] + (f"@{job['version']}" if job.get('version', '').isdigit() else '')
+                # 项目所在的服务器（协调器上配置了p4_servers时），工作区沿用本机的设置
+                env = None
+                if job.get('p4port'):
+                    env = dict(os.environ, P4PORT=job['p4port'])
+                    if job.get('p4user'):
+                        env['P4USER'] = job['p4user']
+                result = subprocess.run(f'p4 sync -q "{target}"', shell=True, cwd=local_path,
+                                        capture_output=True, text=True, env=env)
+                if result.returncode != 0:
+                    report('failed', detail=f"同步失败: {result.stderr.strip()}")
+                    return
+
+            for script in job.get('build_scripts', []):
+                # 在两个脚本之间收到的取消没有可结束的进程，在这里停止
+                if self.is_cancelled(job_id):
+                    report('failed', script, 'cancelled')
+                    return
+                report('running', script)
+                process = subprocess.Popen(
+                    f'"{scripts_path / script}" "{job["project"]}"',
+                    shell=True,
+                    cwd=str(scripts_path),
+                    **self.supervisor.group_options()
+                )
+                self.supervisor.track(job_id, process)
+                if self.is_cancelled(job_id):
+                    # 取消在启动脚本和登记进程之间到达
+                    self.supervisor.kill_tree(job_id)
+                returncode = process.wait()
+                self.supervisor.untrack(job_id)
+
+                if self.is_cancelled(job_id):
+                    report('failed', script, 'cancelled')
+                    return
+                if returncode != 0:
+                    report('failed', script, f"错误码 {returncode}")
+                    return
+
+            report('completed')
+        except Exception as e:
+            report('failed', detail=str(e))
+        finally:
+            with self.jobs_lock:
+                self.active.discard(job_id)
+                self.cancelled.discard(job_id)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """构建代理入口"""
+    parser = argparse.ArgumentParser(description='P4V Project Manager 构建代理')
+    parser.add_argument('--coordinator', required=True, help='协调器地址 host:port')
+    parser.add_argument('--name', default=socket.gethostname(), help='代理名称')
+    parser.add_argument('--capacity', type=int, default=1, help='最大并行构建数')
+    parser.add_argument('--platforms', default='', help='支持的平台，逗号分隔（为空表示任意）')
+    parser.add_argument('--path-map', action='append', default=[],
+                        help='路径映射 协调器路径=本机路径，可重复')
+    parser.add_argument('--sync', action='store_true', help='构建前在本机同步到目标版本')
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENV, ''),
+                        help=f'与协调器相同的共享令牌（默认读取环境变量 {TOKEN_ENV}）')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error(f"需要共享令牌：设置环境变量 {TOKEN_ENV} 或使用 --token")
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    path_map = dict(item.split('=', 1) for item in args.path_map)
+    agent = BuildAgent(args.coordinator, args.name, args.capacity,
+                       [p for p in args.platforms.split(',') if p], path_map, args.sync, token=args.token)
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        agent.running = False
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import subprocess
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from process_supervisor import ProcessSupervisor
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 示例: Change 12345 on 2024/01/01 by user@client 'fix crash in loader'
+CHANGE_PATTERN = re.compile(r"^Change (\d+) on \S+ by (\S+?)@\S+ '(.*)'$")
+
+
+@dataclass
+class ChangeInfo:
+    """变更信息"""
+    change: str
+    user: str = ""
+    description: str = ""
+
+
+@dataclass
+class BisectSession:
+    """
+    一次二分定位
+
+    changes 是 (good, bad] 范围内按时间升序的变更，最后一个就是构建失败的版本；
+    good 对应下标 -1（已知成功），lo/hi 分别是当前已知成功/失败的位置。
+    """
+    project_name: str
+    script: str
+    good: str
+    bad: str
+    changes: List[ChangeInfo]
+    lo: int = -1
+    hi: int = 0
+    state: str = "running"  # running / found / inconclusive / empty / error / cancelled
+    current_change: str = ""
+    probes: int = 0
+    error: str = ""
+    start_time: float = field(default_factory=time.time)
+
+    @property
+    def remaining(self) -> int:
+        """尚待排除的变更数"""
+        return self.hi - self.lo
+
+    @property
+    def culprit(self) -> Optional[ChangeInfo]:
+        """定位到的第一个失败的变更"""
+        return self.changes[self.hi] if self.state == "found" else None
+
+    @property
+    def suspects(self) -> List[ChangeInfo]:
+        """仍可能引入问题的变更"""
+        return self.changes[self.lo + 1:self.hi + 1]
+
+
+class BuildBisector:
+    """
+    构建失败二分定位
+
+    构建失败后，在上次成功构建的版本和失败的版本之间二分：每次把项目工作区增量同步到中间的变更
+    （只传输与当前工作区不同的文件），再单独执行失败的脚本，直到找到第一个失败的变更。
+    每个 (项目, 脚本, 变更) 的结果会保存下来，之后的二分可以直接复用。
+    """
+
+    def __init__(self, supervisor: ProcessSupervisor, results_file: Path,
+                 max_probes: int = 12, probe_timeout: float = 10800):
+        """
+        Args:
+            supervisor: 进程树监管（用于超时和取消时结束脚本）
+            results_file: 探测结果文件
+            max_probes: 每次二分最多探测的次数
+            probe_timeout: 每次探测（同步+脚本）的超时时间（秒）
+        """
+        self.supervisor = supervisor
+        self.results_file = Path(results_file)
+        self.max_probes = max_probes
+        self.probe_timeout = probe_timeout
+        # {项目: {脚本: {变更: 是否成功}}}
+        self.results: Dict[str, Dict[str, Dict[str, bool]]] = {}
+        self.sessions: Dict[str, BisectSession] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.results_file.exists():
+            return
+        try:
+            with open(self.results_file, 'r', encoding='utf-8') as f:
+                self.results = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载二分结果失败: {e}")
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.results, ensure_ascii=False)
+        temp_file = self.results_file.with_name(self.results_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_file, self.results_file)
+
+    @staticmethod
+    def process_key(project_name: str) -> str:
+        return f"bisect:{project_name}"
+
+    @staticmethod
+    def list_changes(depot_path: str, good: str, bad: str, cwd: Optional[str] = None,
+                     env: Optional[Dict[str, str]] = None) -> List[ChangeInfo]:
+        """列出 (good, bad] 范围内提交的变更（按时间升序）"""
+        result = subprocess.run(f'p4 changes -s submitted "{depot_path}@{good},@{bad}"', shell=True,
+                                capture_output=True, text=True, encoding='utf-8', cwd=cwd, env=env, timeout=60)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip())
+
+        changes = []
+        for line in result.stdout.splitlines():
+            match = CHANGE_PATTERN.match(line.strip())
+            if match and match.group(1) != good:
+                changes.append(ChangeInfo(*match.groups()))
+        changes.sort(key=lambda info: int(info.change))
+        return changes
+
+    def get_result(self, project_name: str, script: str, change: str) -> Optional[bool]:
+        with self.lock:
+            return self.results.get(project_name, {}).get(script, {}).get(change)
+
+    def set_result(self, project_name: str, script: str, change: str, passed: bool):
+        with self.lock:
+            self.results.setdefault(project_name, {}).setdefault(script, {})[change] = passed
+        self.save()
+
+    def start(self, project_name: str, project_config: Dict, script: str,
+              good: str, bad: str, server, log_dir: Optional[Path] = None,
+              env: Optional[Dict[str, str]] = None) -> BisectSession:
+        """
+        开始二分定位（列出变更和探测都在后台线程中执行）
+
+        Args:
+            project_name: 项目名称
+            project_config: 项目配置（depot_path、local_path、scripts_path）
+            script: 失败的构建脚本
+            good: 上次构建成功的变更号
+            bad: 构建失败的变更号
+            server: 项目所在的服务器（P4Server），p4命令计入其并发和速率限制
+            log_dir: 探测输出的日志目录
+            env: p4命令的环境变量（项目的服务器和工作区）
+
+        Returns:
+            二分会话；范围内没有变更时结束为 empty，只有一个变更时直接得出结果，不需要探测
+        """
+        session = BisectSession(project_name, script, good, bad, [])
+        self.sessions[project_name] = session
+        thread = threading.Thread(target=self.run, args=(session, project_config, log_dir, env, server),
+                                  daemon=True)
+        thread.start()
+        return session
+
+    def run(self, session: BisectSession, project_config: Dict, log_dir: Optional[Path],
+            env: Optional[Dict[str, str]], server):
+        """列出变更后进入二分循环"""
+        try:
+            changes = server.call(self.list_changes, project_config['depot_path'], session.good, session.bad,
+                                  project_config.get('local_path') or None, env)
+            if session.state != "running":
+                return
+            if not changes:
+                session.state = "empty"
+                return
+            session.changes = changes
+            session.hi = len(changes) - 1
+            logger.info(f"[二分 {session.project_name}] 变更 {session.good}(成功) ~ {session.bad}(失败) "
+                        f"之间共 {len(changes)} 个变更")
+            while session.remaining > 1 and session.state == "running":
+                if session.probes >= self.max_probes:
+                    session.state = "inconclusive"
+                    return
+                middle = (session.lo + session.hi) // 2
+                passed = self.probe(session, project_config, session.changes[middle].change, log_dir, env, server)
+                if session.state != "running":
+                    return
+                if passed:
+                    session.lo = middle
+                else:
+                    session.hi = middle
+                logger.info(f"[二分 {session.project_name}] 剩余 {session.remaining} 个可疑变更")
+            if session.state == "running":
+                session.state = "found"
+        except Exception as e:
+            session.state = "error"
+            session.error = str(e)
+        finally:
+            session.current_change = ""
+
+    def probe(self, session: BisectSession, project_config: Dict, change: str,
+              log_dir: Optional[Path], env: Optional[Dict[str, str]], server) -> bool:
+        """探测一个变更：增量同步后执行失败的脚本（有保存的结果时直接使用）"""
+        cached = self.get_result(session.project_name, session.script, change)
+        if cached is not None:
+            logger.info(f"[二分 {session.project_name}] 变更 {change}: {'成功' if cached else '失败'} (已有结果)")
+            return cached
+
+        session.current_change = change
+        session.probes += 1
+        deadline = time.time() + self.probe_timeout
+        local_path = project_config.get('local_path') or None
+
+        # 增量同步：p4只传输与工作区当前版本不同的文件
+        result = server.call(subprocess.run, f'p4 sync -q "{project_config["depot_path"]}@{change}"',
+                             shell=True, capture_output=True, text=True, cwd=local_path, env=env,
+                             timeout=self.probe_timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"同步到变更 {change} 失败: {result.stderr.strip()}")
+
+        scripts_path = Path(project_config['scripts_path'])
+        log_file = (log_dir / f"{change}_{Path(session.script).stem}.log") if log_dir else None
+        output = open(log_file, 'wb') if log_file else subprocess.DEVNULL
+        try:
+            process = subprocess.Popen(
+                f'"{scripts_path / session.script}" "{session.project_name}"',
+                shell=True,
+                cwd=str(scripts_path),
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                **self.supervisor.group_options()
+            )
+            key = self.process_key(session.project_name)
+            self.supervisor.track(key, process)
+            try:
+                returncode = process.wait(timeout=max(1.0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                self.supervisor.kill_tree(key)
+                raise RuntimeError(f"变更 {change} 的探测超时")
+            self.supervisor.untrack(key)
+        finally:
+            if log_file:
+                output.close()
+
+        if session.state != "running":
+            return False
+
+        passed = returncode == 0
+        self.set_result(session.project_name, session.script, change, passed)
+        logger.info(f"[二分 {session.project_name}] 变更 {change}: {'成功' if passed else '失败'}")
+        return passed
+
+    def cancel(self, project_name: str):
+        """取消二分并结束正在执行的脚本"""
+        session = self.sessions.get(project_name)
+        if session and session.state == "running":
+            session.state = "cancelled"
+            self.supervisor.kill_tree(self.process_key(project_name))
+
+    def finished(self) -> List[Tuple[str, BisectSession]]:
+        """取出已结束的二分会话"""
+        done = [(name, session) for name, session in self.sessions.items() if session.state != "running"]
+        for name, _ in done:
+            del self.sessions[name]
+        return done
+
+    def describe(self) -> List[str]:
+        """正在进行的二分的文字描述"""
+        return [f"{name} ({session.remaining} 个可疑变更"
+                f"{f', 探测 {session.current_change}' if session.current_change else ''})"
+                for name, session in self.sessions.items() if session.state == "running"]
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+
+class BuildHistory:
+    """
+    构建历史存储
+
+    按项目持久化同步、整体构建以及每个构建脚本的耗时记录，
+    每类记录只保留最近 max_samples 条，用于计算滚动分位数并预估耗时。
+
+    记录的类别(kind):
+        - "sync": 同步耗时
+        - "build": 整体构建耗时
+        - "script:<脚本名>": 单个构建脚本耗时
+
+    record() 只修改内存中的记录并标记为未保存，由调用方定期用 flush_due()/take_snapshot()
+    取出序列化后的内容在后台写入（write），退出时调用 save() 同步写入。
+    分位数按 (项目, 类别) 缓存，直到该类别有新记录。
+    """
+
+    def __init__(self, history_file: Path, max_samples: int = 50, flush_interval: float = 30):
+        """
+        Args:
+            history_file: 历史记录文件路径(JSON)
+            max_samples: 每类记录保留的最大样本数
+            flush_interval: 有新记录时写入文件的最小间隔（秒）
+        """
+        self.history_file = Path(history_file)
+        self.max_samples = max(1, max_samples)
+        self.flush_interval = flush_interval
+        # {project_name: {kind: [{"t": 结束时间, "d": 耗时, "v": 版本, "ok": 是否成功}, ...]}}
+        self.records: Dict[str, Dict[str, List[Dict]]] = {}
+        # 分位数缓存 {(project_name, kind): {pct: 分位数}}
+        self.percentiles: Dict[Tuple[str, str], Dict[float, Optional[float]]] = {}
+        self.dirty = False  # 有尚未写入文件的记录
+        self.last_flush = time.time()
+        self.write_lock = threading.Lock()  # 后台写入和退出时的写入使用同一个临时文件
+        self.load()
+
+    @staticmethod
+    def script_kind(script: str) -> str:
+        """单个脚本对应的记录类别"""
+        return f"script:{script}"
+
+    def load(self):
+        """从文件加载历史记录"""
+        if not self.history_file.exists():
+            return
+
+        try:
+            with open(self.history_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.records = data.get('projects', {})
+            logger.info(f"已加载构建历史: {self.history_file} ({len(self.records)} 个项目)")
+        except Exception as e:
+            logger.warning(f"无法加载构建历史 {self.history_file}: {e}")
+            self.records = {}
+
+    def serialize(self) -> str:
+        """序列化全部记录（在修改记录的线程中调用，得到一致的快照）"""
+        return json.dumps({'projects': self.records}, ensure_ascii=False, separators=(',', ':'))
+
+    def write(self, data: str):
+        """写入序列化后的记录（先写临时文件再替换，避免写入中断损坏文件；可以在后台线程中调用）"""
+        temp_file = self.history_file.with_name(self.history_file.name + '.tmp')
+        with self.write_lock:
+            try:
+                self.history_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(temp_file, self.history_file)
+            except Exception as e:
+                logger.warning(f"无法保存构建历史 {self.history_file}: {e}")
+
+    def flush_due(self) -> bool:
+        """是否有未保存的记录且距离上次写入已超过 flush_interval"""
+        return self.dirty and time.time() - self.last_flush >= self.flush_interval
+
+    def take_snapshot(self) -> str:
+        """取出要写入的内容并清除未保存标记"""
+        self.dirty = False
+        self.last_flush = time.time()
+        return self.serialize()
+
+    def save(self):
+        """立即保存未写入的记录（退出时调用）"""
+        if self.dirty:
+            self.write(self.take_snapshot())
+
+    def record(self, project_name: str, kind: str, duration: float,
+               version: str = "", success: bool = True):
+        """
+        记录一次耗时（只修改内存中的记录，稍后由 flush 写入文件）
+
+        Args:
+            project_name: 项目名称
+            kind: 记录类别
+            duration: 耗时（秒）
+            version: 对应的版本号
+            success: 是否成功
+        """
+        if duration < 0:
+            return
+
+        samples = self.records.setdefault(project_name, {}).setdefault(kind, [])
+        samples.append({
+            't': time.time(),
+            'd': round(duration, 3),
+            'v': version,
+            'ok': success
+        })
+        if len(samples) > self.max_samples:
+            del samples[:len(samples) - self.max_samples]
+
+        self.percentiles.pop((project_name, kind), None)
+        self.dirty = True
+
+    def get_records(self, project_name: str, kind: str) -> List[Dict]:
+        """获取某类的全部记录（按时间先后）"""
+        return self.records.get(project_name, {}).get(kind, [])
+
+    def durations(self, project_name: str, kind: str, successful_only: bool = True) -> List[float]:
+        """获取某类记录的耗时列表"""
+        return [r['d'] for r in self.get_records(project_name, kind)
+                if r.get('ok', True) or not successful_only]
+
+    @staticmethod
+    def compute_percentile(values: List[float], pct: float) -> Optional[float]:
+        """计算分位数（线性插值）"""
+        if not values:
+            return None
+
+        ordered = sorted(values)
+        if len(ordered) == 1:
+            return ordered[0]
+
+        rank = (len(ordered) - 1) * min(max(pct, 0), 100) / 100.0
+        lower = int(rank)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+    def percentile(self, project_name: str, kind: str, pct: float) -> Optional[float]:
+        """获取某类成功记录耗时的分位数（缓存到该类别有新记录为止）"""
+        cached = self.percentiles.setdefault((project_name, kind), {})
+        if pct not in cached:
+            cached[pct] = self.compute_percentile(self.durations(project_name, kind), pct)
+        return cached[pct]
+
+    def estimate(self, project_name: str, kind: str, pct: float = 50) -> Optional[float]:
+        """
+        预估耗时
+
+        Returns:
+            预估耗时（秒），没有历史样本时返回None
+        """
+        return self.percentile(project_name, kind, pct)
+
+    def last_version(self, project_name: str, kind: str, success: bool = True) -> Optional[str]:
+        """获取最近一次指定结果记录的版本号"""
+        for r in reversed(self.get_records(project_name, kind)):
+            if r.get('ok', True) == success and r.get('v'):
+                return r['v']
+        return None
+
+    def summary(self, project_name: str) -> Dict[str, Dict]:
+        """获取项目各类记录的统计摘要"""
+        result = {}
+        for kind, samples in self.records.get(project_name, {}).items():
+            values = [r['d'] for r in samples if r.get('ok', True)]
+            result[kind] = {
+                'samples': len(samples),
+                'failures': sum(1 for r in samples if not r.get('ok', True)),
+                'p50': self.compute_percentile(values, 50),
+                'p90': self.compute_percentile(values, 90),
+            }
+        return result
@@ -0,0 +1,371 @@
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 错误行匹配（排除 "0 error(s)" 这类汇总行）
+DEFAULT_ERROR_PATTERN = r'(?i)(?<!0 )\b(?:error|fatal|failed)\b'
+
+
+@dataclass
+class LogIndex:
+    """
+    日志偏移索引（保存在日志旁的 .idx 文件中）
+
+    每隔 stride 行记录一次行首的字节偏移，用于快速定位到任意行；
+    同时记录第一个错误行的位置。索引只覆盖完整的行，日志继续增长时可以增量更新。
+    """
+    stride: int = 1000
+    size: int = 0  # 已索引的字节数（最后一个完整行之后）
+    lines: int = 0  # 已索引的行数
+    offsets: List[int] = field(default_factory=lambda: [0])  # 第 i*stride 行的字节偏移
+    first_error_line: int = -1
+    first_error_offset: int = -1
+
+    @classmethod
+    def load(cls, index_file: Path) -> Optional['LogIndex']:
+        try:
+            with open(index_file, 'r', encoding='utf-8') as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, index_file: Path):
+        temp_file = index_file.with_name(index_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(asdict(self), f)
+        os.replace(temp_file, index_file)
+
+
+class BuildLogStore:
+    """
+    构建日志存储
+
+    目录结构: <root>/<项目>/<时间>_<版本>/<序号>_<脚本名>.log
+    构建脚本的输出由监控批处理直接重定向到日志文件；管理器按块增量读取新写入的内容建立索引，
+    内存占用与日志大小无关。较旧的构建日志会被压缩(gzip)，超过保留数量的构建会被删除。
+    """
+
+    def __init__(self, root: Path, keep_uncompressed: int = 5, retention_builds: int = 50,
+                 index_stride: int = 1000, error_pattern: str = DEFAULT_ERROR_PATTERN,
+                 chunk_size: int = 1024 * 1024):
+        """
+        Args:
+            root: 日志根目录
+            keep_uncompressed: 每个项目保留不压缩的最近构建数
+            retention_builds: 每个项目保留的构建数
+            index_stride: 索引中每隔多少行记录一次偏移
+            error_pattern: 识别错误行的正则表达式
+            chunk_size: 读取日志的块大小
+        """
+        self.root = Path(root)
+        self.keep_uncompressed = max(1, keep_uncompressed)
+        self.retention_builds = max(self.keep_uncompressed, retention_builds)
+        self.index_stride = max(1, index_stride)
+        self.error_regex = re.compile(error_pattern.encode('utf-8'))
+        self.chunk_size = chunk_size
+        self.max_line_length = 64 * 1024  # 超长的行按此长度截断识别，避免无限缓存
+        self.indexes: Dict[Path, LogIndex] = {}
+        self.rotate_lock = threading.Lock()
+
+    @staticmethod
+    def index_path(log_path: Path) -> Path:
+        """日志对应的索引文件（压缩后仍使用原名）"""
+        name = log_path.name[:-3] if log_path.name.endswith('.gz') else log_path.name
+        return log_path.with_name(name + '.idx')
+
+    def new_build_dir(self, project_name: str, version: str) -> Path:
+        """为一次构建创建日志目录"""
+        safe_version = re.sub(r'[^\w.-]', '_', version or 'unknown')
+        build_dir = self.root / project_name / f"{time.strftime('%Y%m%d-%H%M%S')}_{safe_version}"
+        build_dir.mkdir(parents=True, exist_ok=True)
+        return build_dir
+
+    @staticmethod
+    def script_log_name(index: int, script: str) -> str:
+        """构建脚本的日志文件名"""
+        return f"{index:02d}_{Path(script).stem}.log"
+
+    def list_builds(self, project_name: str) -> List[Path]:
+        """项目的全部构建日志目录（按时间先后）"""
+        project_dir = self.root / project_name
+        if not project_dir.exists():
+            return []
+        return sorted(p for p in project_dir.iterdir() if p.is_dir())
+
+    @staticmethod
+    def list_logs(build_dir: Path) -> List[Path]:
+        """构建目录中的日志文件（按脚本顺序）"""
+        return sorted(p for p in build_dir.iterdir() if p.name.endswith(('.log', '.log.gz')))
+
+    def get_index(self, log_path: Path) -> LogIndex:
+        """获取日志的索引（内存中没有时从 .idx 加载）"""
+        index = self.indexes.get(log_path)
+        if index is None:
+            index = LogIndex.load(self.index_path(log_path)) or LogIndex(stride=self.index_stride)
+            self.indexes[log_path] = index
+        return index
+
+    def update_index(self, log_path: Path, save: bool = True) -> LogIndex:
+        """
+        增量更新日志索引：只读取上次索引之后新增的内容
+
+        Returns:
+            更新后的索引
+        """
+        index = self.get_index(log_path)
+        if log_path.name.endswith('.gz') or not log_path.exists():
+            return index
+
+        size = log_path.stat().st_size
+        if size < index.size:
+            # 日志被截断或重写，重新建立索引
+            index = LogIndex(stride=self.index_stride)
+            self.indexes[log_path] = index
+        if size == index.size:
+            return index
+
+        with open(log_path, 'rb') as f:
+            f.seek(index.size)
+            buffer = b''
+            buffer_offset = index.size  # buffer[0] 在文件中的偏移
+            long_line_head = None  # 超长行的开头部分（只用它识别错误）
+            long_line_offset = 0
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                buffer += chunk
+                position = 0
+                while True:
+                    newline = buffer.find(b'\n', position)
+                    if newline < 0:
+                        break
+                    if long_line_head is not None:
+                        self._index_line(index, long_line_head, long_line_offset)
+                        long_line_head = None
+                    else:
+                        self._index_line(index, buffer[position:newline], buffer_offset + position)
+                    position = newline + 1
+                    index.size = buffer_offset + position
+
+                buffer = buffer[position:]
+                buffer_offset += position
+                if len(buffer) > self.max_line_length:
+                    # 超长行：保留开头部分，丢弃其余内容后继续查找行尾，保证内存有界
+                    if long_line_head is None:
+                        long_line_head = buffer[:self.max_line_length]
+                        long_line_offset = buffer_offset
+                    buffer_offset += len(buffer)
+                    buffer = b''
+
+        if save:
+            index.save(self.index_path(log_path))
+        return index
+
+    def _index_line(self, index: LogIndex, line: bytes, offset: int):
+        """记录一行到索引"""
+        if index.lines and index.lines % index.stride == 0:
+            index.offsets.append(offset)
+        if index.first_error_line < 0 and self.error_regex.search(line):
+            index.first_error_line = index.lines
+            index.first_error_offset = offset
+        index.lines += 1
+
+    @staticmethod
+    def open_log(log_path: Path):
+        """以二进制方式打开日志（支持压缩日志）"""
+        if log_path.name.endswith('.gz'):
+            return gzip.open(log_path, 'rb')
+        return open(log_path, 'rb')
+
+    def load_index(self, log_path: Path) -> LogIndex:
+        """
+        从 .idx 文件读取索引（不使用也不修改内存中的索引，可以在其他线程中调用）
+
+        日志被截断或重写后旧索引无效，返回空索引
+        """
+        index = LogIndex.load(self.index_path(log_path)) or LogIndex(stride=self.index_stride)
+        if not log_path.name.endswith('.gz') and log_path.stat().st_size < index.size:
+            return LogIndex(stride=self.index_stride)
+        return index
+
+    def count_lines(self, log_path: Path, index: LogIndex) -> int:
+        """日志的完整行数：已索引的行数加上索引之后新写入的行数"""
+        if log_path.name.endswith('.gz'):
+            return index.lines
+
+        count = index.lines
+        with open(log_path, 'rb') as f:
+            f.seek(index.size)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                count += chunk.count(b'\n')
+        return count
+
+    def read_lines(self, log_path: Path, start_line: int, count: int,
+                   index: Optional[LogIndex] = None) -> List[str]:
+        """
+        借助索引从指定行开始读取若干行
+
+        未压缩的日志可能还在写入，只返回完整的行（最后一行没有换行符时不返回）
+        """
+        index = index or self.get_index(log_path)
+        slot = min(start_line // index.stride, len(index.offsets) - 1)
+        current_line = slot * index.stride
+        growing = not log_path.name.endswith('.gz')
+
+        result = []
+        with self.open_log(log_path) as f:
+            f.seek(index.offsets[slot])
+            for raw in f:
+                if growing and not raw.endswith(b'\n'):
+                    break
+                if current_line >= start_line:
+                    result.append(raw.decode('utf-8', errors='replace').rstrip('\r\n'))
+                    if len(result) >= count:
+                        break
+                current_line += 1
+        return result
+
+    def tail(self, log_path: Path, lines: int = 50,
+             index: Optional[LogIndex] = None) -> Tuple[int, List[str]]:
+        """
+        读取日志最后若干行
+
+        借助索引定位，只需要读取索引之后新写入的内容和最后几行，不扫描整个文件
+
+        Returns:
+            (第一行的行号(从0开始), 内容)
+        """
+        index = index or self.get_index(log_path)
+        start = max(0, self.count_lines(log_path, index) - lines)
+        return start, self.read_lines(log_path, start, lines, index)
+
+    def first_error(self, log_path: Path, context: int = 5) -> Optional[Dict]:
+        """
+        定位第一个错误行
+
+        Returns:
+            {"line": 行号(从1开始), "text": 错误行附近的内容}，没有错误时返回None
+        """
+        index = self.update_index(log_path)
+        if index.first_error_line < 0:
+            return None
+
+        start = max(0, index.first_error_line - context)
+        return {
+            'line': index.first_error_line + 1,
+            'text': self.read_lines(log_path, start, context * 2 + 1)
+        }
+
+    def read_log(self, project_name: str, build: Optional[str] = None, log: Optional[str] = None,
+                 lines: int = 50, start: Optional[int] = None, error: bool = False) -> Dict:
+        """
+        读取构建日志（只从 .idx 文件读取索引，可以在控制接口的请求线程中调用）
+
+        Args:
+            project_name: 项目名称
+            build: 构建目录名（默认最近一次构建）
+            log: 日志文件名或脚本名（默认为第一个有错误的日志(error)或最后一个日志）
+            lines: 读取的行数
+            start: 从该行(从0开始)开始读取，None表示读取末尾
+            error: 读取第一个错误行附近的内容
+
+        Returns:
+            {"build", "log", "logs", "start", "next", "first_error_line", "text"}，
+            next 是下一次继续读取的起始行，first_error_line 从0开始，没有错误时为-1
+
+        Raises:
+            FileNotFoundError: 没有找到构建或日志
+        """
+        builds = self.list_builds(project_name)
+        if build:
+            builds = [path for path in builds if path.name == build]
+        if not builds:
+            raise FileNotFoundError(f"项目 {project_name} 没有构建日志{f' {build}' if build else ''}")
+        build_dir = builds[-1]
+
+        logs = self.list_logs(build_dir)
+        if log:
+            # 可以是完整的文件名、不带扩展名的文件名(01_compile)或脚本名(compile.bat)
+            names = {log, Path(log).stem}
+            logs = [path for path in logs
+                    if path.name in names or path.name.split('.')[0] in names
+                    or path.name.split('.')[0].split('_', 1)[-1] in names]
+        if not logs:
+            raise FileNotFoundError(f"构建 {build_dir.name} 中没有日志{f' {log}' if log else ''}")
+
+        log_path = logs[-1]
+        index = self.load_index(log_path)
+        if error and not log:
+            for path in logs:
+                path_index = self.load_index(path)
+                if path_index.first_error_line >= 0:
+                    log_path, index = path, path_index
+                    break
+
+        lines = max(1, lines)
+        if error and index.first_error_line >= 0:
+            start = max(0, index.first_error_line - lines // 2)
+            text = self.read_lines(log_path, start, lines, index)
+        elif start is None:
+            start, text = self.tail(log_path, lines, index)
+        else:
+            text = self.read_lines(log_path, start, lines, index)
+
+        return {
+            'build': build_dir.name,
+            'log': log_path.name,
+            'logs': [path.name for path in self.list_logs(build_dir)],
+            'start': start,
+            'next': start + len(text),
+            'first_error_line': index.first_error_line,
+            'text': text
+        }
+
+    def finish_build(self, build_dir: Path):
+        """构建结束：完成所有日志的索引并释放内存中的索引"""
+        for log_path in self.list_logs(build_dir):
+            self.update_index(log_path)
+            self.indexes.pop(log_path, None)
+
+    def rotate(self, project_name: str):
+        """压缩较旧的构建日志，删除超过保留数量的构建"""
+        with self.rotate_lock:
+            builds = self.list_builds(project_name)
+
+            for build_dir in builds[:-self.retention_builds]:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                logger.debug(f"已删除过期构建日志: {build_dir}")
+
+            for build_dir in builds[-self.retention_builds:-self.keep_uncompressed]:
+                for log_path in self.list_logs(build_dir):
+                    if not log_path.name.endswith('.log'):
+                        continue
+                    try:
+                        self.compress_log(log_path)
+                    except OSError as e:
+                        logger.warning(f"压缩日志 {log_path} 失败: {e}")
+
+    def compress_log(self, log_path: Path):
+        """压缩单个日志（先写临时文件，完成后替换）"""
+        self.update_index(log_path)
+        gz_path = log_path.with_name(log_path.name + '.gz')
+        temp_path = gz_path.with_name(gz_path.name + '.tmp')
+        with open(log_path, 'rb') as src, gzip.open(temp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, self.chunk_size)
+        os.replace(temp_path, gz_path)
+        log_path.unlink()
+        self.indexes.pop(log_path, None)
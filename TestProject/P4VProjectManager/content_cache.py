@@ -0,0 +1,318 @@
+import os
+import json
+import stat
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import fcntl  # Linux上用于写时复制(reflink)
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('P4VProjectManager')
+
+MB = 1024 * 1024
+LINK_MODES = ('hardlink', 'reflink', 'copy')
+FICLONE = 0x40049409  # Linux ioctl: 克隆文件数据块（btrfs/xfs等支持写时复制的文件系统）
+
+
+def clone_file(source: Path, target: Path) -> bool:
+    """写时复制克隆文件，文件系统不支持时返回False"""
+    if fcntl is None:
+        return False
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, target)
+        return True
+    except OSError:
+        if target.exists():
+            target.unlink()
+        return False
+
+
+def file_digest(path: Path, chunk_size: int = MB) -> str:
+    """计算文件内容的MD5（与p4 fstat -Ol 的digest相同算法）"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest().upper()
+
+
+def workspace_digest(path: str, text: bool, chunk_size: int = MB) -> str:
+    """计算工作区文件与服务器digest可比的MD5：Windows上的文本文件按LF换行计算"""
+    if not text or os.name != 'nt':
+        return file_digest(Path(path))
+    md5 = hashlib.md5()
+    carry = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            data = carry + chunk
+            # 块末尾的\r可能与下一块开头的\n组成CRLF
+            carry = b'\r' if data.endswith(b'\r') else b''
+            md5.update(data[:len(data) - len(carry)].replace(b'\r\n', b'\n'))
+    md5.update(carry)
+    return md5.hexdigest().upper()
+
+
+class ContentCache:
+    """
+    本地文件内容缓存（按内容寻址）
+
+    文件内容按MD5保存在 <root>/objects/<前两位>/<digest>，"//depot/file#rev" 映射到内容digest，
+    相同内容的不同版本或不同项目只保存一份。总大小超过上限时按最近使用时间(LRU)淘汰。
+    同步前把已缓存的版本直接放到工作区（写时复制、复制或硬链接），只有未命中的文件才从服务器下载。
+
+    加入缓存时总是写时复制或复制，内容文件不与工作区共用inode，并校验副本与服务器上该版本的digest一致
+    （同步结束后构建脚本可能已修改工作区文件）；查找时检查大小和修改时间，
+    内容文件被修改过就丢弃。硬链接放置时工作区文件与内容文件是同一个inode，
+    p4 edit 后原地写入会同时改变缓存及其他从缓存放置的工作区，只适合不会原地修改已同步文件的工作区。
+    """
+
+    def __init__(self, root: Path, max_bytes: int, link_mode: str = 'reflink'):
+        """
+        Args:
+            root: 缓存目录
+            max_bytes: 缓存总大小上限（字节）
+            link_mode: 放置文件的方式 reflink / copy / hardlink，不支持时退回复制
+        """
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.index_file = self.root / 'index.json'
+        self.max_bytes = max_bytes
+        self.link_mode = link_mode
+        self.revisions: Dict[str, str] = {}  # {"//depot/file#rev": digest}
+        self.digest_revisions: Dict[str, Set[str]] = {}  # {digest: 映射到它的版本}
+        self.blobs: 'OrderedDict[str, int]' = OrderedDict()  # {digest: 大小}，最早使用的在前
+        self.blob_mtimes: Dict[str, int] = {}  # {digest: 内容文件的修改时间(ns)}
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+        self.load()
+
+    def blob_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+
+    def load(self):
+        """加载缓存索引"""
+        if not self.index_file.exists():
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载文件缓存索引失败，将重新建立: {e}")
+            return
+
+        for digest, size in data.get('blobs', []):
+            self.blobs[digest] = size
+            self.total_bytes += size
+        self.blob_mtimes = {digest: mtime for digest, mtime in data.get('mtimes', {}).items()
+                            if digest in self.blobs}
+        for revision, digest in data.get('revisions', {}).items():
+            if digest in self.blobs:
+                self.revisions[revision] = digest
+                self.digest_revisions.setdefault(digest, set()).add(revision)
+        self.stats.update(data.get('stats', {}))
+        logger.info(f"已加载文件缓存: {len(self.blobs)} 个文件, {self.total_bytes / MB:.0f}MB")
+
+    def save(self):
+        """保存缓存索引（先写临时文件再替换）"""
+        with self.lock:
+            data = {
+                'blobs': list(self.blobs.items()),
+                'mtimes': dict(self.blob_mtimes),
+                'revisions': dict(self.revisions),
+                'stats': dict(self.stats)
+            }
+        self.root.mkdir(parents=True, exist_ok=True)
+        temp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_file, self.index_file)
+
+    def lookup(self, revision: str) -> Optional[Path]:
+        """查找已缓存的版本，返回内容文件；内容文件丢失或被修改过时丢弃该条目"""
+        with self.lock:
+            digest = self.revisions.get(revision)
+            if digest is None:
+                return None
+            size, mtime = self.blobs[digest], self.blob_mtimes.get(digest)
+        path = self.blob_path(digest)
+        try:
+            st = path.stat()
+            if st.st_size != size:
+                raise OSError("大小不一致")
+            if mtime is None:
+                # 索引中没有修改时间（旧版本的缓存），校验一次内容
+                if file_digest(path) != digest:
+                    raise OSError("内容不一致")
+            elif st.st_mtime_ns != mtime:
+                raise OSError("修改时间不一致")
+        except OSError as e:
+            logger.debug(f"缓存的 {revision} 无效，已丢弃: {e}")
+            with self.lock:
+                self._remove_blob(digest)
+            return None
+        with self.lock:
+            if digest not in self.blobs:
+                return None
+            self.blob_mtimes[digest] = st.st_mtime_ns
+            self.blobs.move_to_end(digest)
+        return path
+
+    def place(self, source: Path, target: Path, link_mode: Optional[str] = None):
+        """按指定（默认为配置）的方式把文件放到目标位置（先写临时文件再替换）"""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(target.name + '.cache.tmp')
+        if temp.exists():
+            temp.unlink()
+        if os.name == 'nt' and target.exists() and not os.access(target, os.W_OK):
+            # Windows上无法替换只读文件（其他系统不修改，避免影响硬链接到同一内容的文件）
+            os.chmod(target, target.stat().st_mode | stat.S_IWRITE)
+
+        link_mode = link_mode or self.link_mode
+        placed = False
+        if link_mode == 'hardlink':
+            try:
+                os.link(source, temp)
+                placed = True
+            except OSError:
+                pass
+        elif link_mode == 'reflink':
+            placed = clone_file(source, temp)
+        if not placed:
+            shutil.copy2(source, temp)
+        os.replace(temp, target)
+
+    def materialize(self, files: Iterable[Tuple[str, str]],
+                    cancelled: Optional[threading.Event] = None) -> List[str]:
+        """
+        把已缓存的版本放到工作区
+
+        Args:
+            files: (版本 "//depot/file#rev", 本地路径) 列表
+            cancelled: 设置后在下一个文件之前停止
+
+        Returns:
+            命中并已放到工作区的版本
+        """
+        placed = []
+        for revision, local_path in files:
+            if cancelled is not None and cancelled.is_set():
+                break
+            blob = self.lookup(revision)
+            if blob is None:
+                self.stats['misses'] += 1
+                continue
+            try:
+                self.place(blob, Path(local_path))
+            except OSError as e:
+                logger.debug(f"从缓存放置 {revision} 失败: {e}")
+                self.stats['misses'] += 1
+                continue
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += blob.stat().st_size
+            placed.append(revision)
+        return placed
+
+    def ingest(self, files: Iterable[Tuple[str, str, str, bool]]) -> Tuple[int, int]:
+        """
+        把同步下来的文件加入缓存
+
+        先复制到缓存目录再校验副本，与服务器digest不一致的文件（同步后被修改过）不加入缓存
+
+        Args:
+            files: (版本 "//depot/file#rev", 本地路径, 服务器上该版本的digest, 是否文本文件) 列表
+
+        Returns:
+            (新增的内容文件数, 与服务器digest不一致而未加入的文件数)
+        """
+        added = rejected = 0
+        temp = self.objects_dir / f"ingest_{threading.get_ident()}.tmp"
+        for revision, local_path, expected, text in files:
+            source = Path(local_path)
+            if revision in self.revisions or not source.is_file():
+                continue
+            try:
+                self.objects_dir.mkdir(parents=True, exist_ok=True)
+                # 不能硬链接工作区文件：p4 edit 后原地写入会改变缓存的内容
+                self.place(source, temp, link_mode='reflink')
+                if workspace_digest(str(temp), text) != expected:
+                    logger.debug(f"{revision} 的本地内容与服务器digest不一致，不加入缓存")
+                    temp.unlink()
+                    rejected += 1
+                    continue
+                # 内容按实际字节寻址：Windows上的文本文件是CRLF换行，与服务器digest不同
+                digest = file_digest(temp) if text and os.name == 'nt' else expected
+                blob = self.blob_path(digest)
+                with self.lock:
+                    known = digest in self.blobs
+                mtime = None
+                if known:
+                    temp.unlink()
+                else:
+                    blob.parent.mkdir(parents=True, exist_ok=True)
+                    # 内容文件只读，避免通过硬链接放置的工作区文件被意外修改
+                    os.chmod(temp, temp.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                    os.replace(temp, blob)
+                    mtime = blob.stat().st_mtime_ns
+            except OSError as e:
+                logger.debug(f"缓存 {revision} 失败: {e}")
+                if temp.exists():
+                    temp.unlink()
+                continue
+
+            with self.lock:
+                if digest not in self.blobs:
+                    if mtime is None:
+                        continue  # 内容刚被淘汰，下次同步时再加入
+                    size = blob.stat().st_size
+                    self.blobs[digest] = size
+                    self.blob_mtimes[digest] = mtime
+                    self.total_bytes += size
+                    added += 1
+                self.blobs.move_to_end(digest)
+                self.revisions[revision] = digest
+                self.digest_revisions.setdefault(digest, set()).add(revision)
+                self._evict()
+        return added, rejected
+
+    def _evict(self):
+        """淘汰最久未使用的内容，直到总大小不超过上限（调用者持有锁）"""
+        while self.total_bytes > self.max_bytes and len(self.blobs) > 1:
+            digest = next(iter(self.blobs))
+            self._remove_blob(digest)
+            self.stats['evictions'] += 1
+
+    def _remove_blob(self, digest: str):
+        """删除内容文件及映射到它的版本（调用者持有锁）"""
+        self.total_bytes -= self.blobs.pop(digest, 0)
+        self.blob_mtimes.pop(digest, None)
+        for revision in self.digest_revisions.pop(digest, set()):
+            self.revisions.pop(revision, None)
+        path = self.blob_path(digest)
+        try:
+            if path.exists():
+                if os.name == 'nt':
+                    os.chmod(path, stat.S_IWRITE | stat.S_IREAD)  # Windows上不能删除只读文件
+                path.unlink()
+        except OSError as e:
+            logger.debug(f"删除缓存文件 {path} 失败: {e}")
+
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def describe(self) -> str:
+        """缓存统计的文字描述"""
+        return (f"命中率 {self.hit_rate() * 100:.1f}% ({self.stats['hits']}/"
+                f"{self.stats['hits'] + self.stats['misses']}), "
+                f"节省 {self.stats['bytes_saved'] / MB:.0f}MB, "
+                f"占用 {self.total_bytes / MB:.0f}/{self.max_bytes / MB:.0f}MB")
@@ -0,0 +1,246 @@
+import hmac
+import json
+import queue
+import logging
+import threading
+from urllib.parse import parse_qs, unquote, urlparse
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 支持的操作: POST /api/projects/<项目>/<操作>
+ACTIONS = ('sync', 'build', 'cancel', 'pause', 'resume', 'priority', 'verify')
+
+
+@dataclass
+class ControlCommand:
+    """等待主循环执行的控制命令"""
+    action: str
+    project: str
+    args: Dict = field(default_factory=dict)
+    result: Optional[Dict] = None
+    done: threading.Event = field(default_factory=threading.Event)
+
+
+class ControlServer:
+    """
+    本地HTTP控制接口
+
+    读取: 主循环每个周期发布一份只读的状态快照，请求线程直接返回快照（序列化结果按快照缓存），
+    不访问主循环的数据，也不会阻塞主循环。
+    控制: 请求线程把命令放入队列，由主循环在下一个周期执行，请求线程等待执行结果（超时返回202）。
+    控制请求必须是JSON（Content-Type: application/json），带Origin时必须是接口自身的地址，
+    浏览器中的跨站表单和脚本无法发出这样的请求；配置了token时还需要 Authorization: Bearer <token>。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 7020, command_timeout: float = 10,
+                 profiler=None, log_store=None, token: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.command_timeout = command_timeout
+        self.token = token
+        self.commands: 'queue.Queue[ControlCommand]' = queue.Queue()
+        self.wakeup = threading.Event()  # 有新命令时唤醒主循环，不必等到下一个周期
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.snapshot: Dict = {}
+        self.snapshot_json: Optional[bytes] = None
+        self.snapshot_lock = threading.Lock()
+        self.profiler = profiler  # 主循环性能分析（TickProfiler），统计和采集请求本身是线程安全的
+        self.log_store = log_store  # 构建日志（BuildLogStore），请求线程只通过 read_log 读取日志文件和 .idx
+
+    def start(self):
+        """在后台线程中启动HTTP服务"""
+        handler = type('Handler', (ControlRequestHandler,), {'control': self})
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"控制接口已启动: http://{self.host}:{self.port}/api/status")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def publish(self, snapshot: Dict):
+        """发布新的状态快照（整体替换引用，发布后不再修改）"""
+        with self.snapshot_lock:
+            self.snapshot = snapshot
+            self.snapshot_json = None
+
+    def snapshot_bytes(self) -> bytes:
+        """当前快照的JSON（每份快照只序列化一次）"""
+        with self.snapshot_lock:
+            if self.snapshot_json is None:
+                self.snapshot_json = json.dumps(self.snapshot, ensure_ascii=False).encode('utf-8')
+            return self.snapshot_json
+
+    def submit(self, action: str, project: str, args: Dict) -> Tuple[int, Dict]:
+        """
+        提交命令并等待主循环执行
+
+        Returns:
+            (HTTP状态码, 响应内容)
+        """
+        command = ControlCommand(action, project, args)
+        self.commands.put(command)
+        self.wakeup.set()
+        if not command.done.wait(self.command_timeout):
+            return 202, {'ok': True, 'message': '命令已排队，等待执行'}
+        return (200 if command.result.get('ok') else 409), command.result
+
+    def pending_commands(self) -> List[ControlCommand]:
+        """取出所有等待执行的命令（由主循环调用）"""
+        commands = []
+        while True:
+            try:
+                commands.append(self.commands.get_nowait())
+            except queue.Empty:
+                return commands
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /api/status                   全部状态
+    GET  /api/projects/<项目>           单个项目的状态
+    GET  /api/projects/<项目>/logs      构建日志 ?build=<构建>&log=<日志或脚本>&lines=50&start=<行>&error=1
+    POST /api/projects/<项目>/<操作>     sync / build / cancel / pause / resume / priority({"priority": n})
+                                       / verify({"repair": true})
+    GET  /api/profile                  主循环各阶段的耗时统计
+    POST /api/profile                  开始采集 {"mode": "cprofile" | "sample", "seconds": 30}
+    """
+    control: ControlServer = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"控制接口 {self.address_string()} - {format % args}")
+
+    def send_json(self, status: int, body):
+        data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def path_parts(self) -> List[str]:
+        return [unquote(part) for part in urlparse(self.path).path.strip('/').split('/') if part]
+
+    def do_GET(self):
+        parts = self.path_parts()
+        if parts == ['api', 'status']:
+            self.send_json(200, self.control.snapshot_bytes())
+            return
+
+        if parts == ['api', 'profile'] and self.control.profiler:
+            self.send_json(200, {'enabled': self.control.profiler.enabled,
+                                 'capturing': self.control.profiler.capture_mode,
+                                 'phases': self.control.profiler.report()})
+            return
+
+        if len(parts) == 3 and parts[:2] == ['api', 'projects']:
+            project = self.control.snapshot.get('projects', {}).get(parts[2])
+            if project is None:
+                self.send_json(404, {'ok': False, 'message': f"未知的项目: {parts[2]}"})
+            else:
+                self.send_json(200, project)
+            return
+
+        if len(parts) == 4 and parts[:2] == ['api', 'projects'] and parts[3] == 'logs' and self.control.log_store:
+            self.send_logs(parts[2])
+            return
+
+        self.send_json(404, {'ok': False, 'message': '未知的路径'})
+
+    def send_logs(self, project: str):
+        """读取项目的构建日志（末尾、指定行或第一个错误附近）"""
+        if project not in self.control.snapshot.get('projects', {}):
+            self.send_json(404, {'ok': False, 'message': f"未知的项目: {project}"})
+            return
+
+        query = {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+        try:
+            lines = int(query.get('lines', 50))
+            start = int(query['start']) if 'start' in query else None
+        except ValueError:
+            self.send_json(400, {'ok': False, 'message': 'lines和start必须是整数'})
+            return
+        if not 0 < lines <= 10000 or (start is not None and start < 0):
+            self.send_json(400, {'ok': False, 'message': 'lines必须是1-10000，start不能为负数'})
+            return
+
+        try:
+            result = self.control.log_store.read_log(
+                project, query.get('build'), query.get('log'), lines, start,
+                error=query.get('error', '').lower() in ('1', 'true'))
+        except FileNotFoundError as e:
+            self.send_json(404, {'ok': False, 'message': str(e)})
+            return
+        except OSError as e:
+            self.send_json(500, {'ok': False, 'message': f"读取日志失败: {e}"})
+            return
+        self.send_json(200, result)
+
+    def read_args(self) -> Optional[Dict]:
+        """读取请求内容中的JSON对象，无效时返回400并返回None"""
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            args = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self.send_json(400, {'ok': False, 'message': '请求内容不是有效的JSON'})
+            return None
+        if not isinstance(args, dict):
+            self.send_json(400, {'ok': False, 'message': '请求内容必须是JSON对象'})
+            return None
+        return args
+
+    def authorize_post(self) -> bool:
+        """检查控制请求的来源、内容类型和token，不通过时返回403/415并返回False"""
+        origin = self.headers.get('Origin')
+        port = self.control.port
+        if origin and origin.rstrip('/') not in (f"http://{self.control.host}:{port}",
+                                                 f"http://127.0.0.1:{port}", f"http://localhost:{port}"):
+            self.send_json(403, {'ok': False, 'message': f"不接受来自 {origin} 的控制请求"})
+            return False
+        if self.control.token:
+            scheme, _, token = (self.headers.get('Authorization') or '').partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode('utf-8'),
+                                                                     self.control.token.encode('utf-8')):
+                self.send_json(403, {'ok': False, 'message': '缺少或错误的token'})
+                return False
+        content_type = (self.headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+        if content_type != 'application/json':
+            self.send_json(415, {'ok': False, 'message': '控制请求的Content-Type必须是application/json'})
+            return False
+        return True
+
+    def do_POST(self):
+        if not self.authorize_post():
+            return
+        parts = self.path_parts()
+        if parts == ['api', 'profile'] and self.control.profiler:
+            args = self.read_args()
+            if args is None:
+                return
+            seconds = args.get('seconds', 30)
+            if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds <= 0:
+                self.send_json(400, {'ok': False, 'message': f"seconds必须是正数: {seconds}"})
+                return
+            ok, message = self.control.profiler.request_capture(args.get('mode', 'sample'), seconds)
+            self.send_json(200 if ok else 409, {'ok': ok, 'message': message})
+            return
+
+        if len(parts) != 4 or parts[:2] != ['api', 'projects'] or parts[3] not in ACTIONS:
+            self.send_json(404, {'ok': False, 'message': '未知的路径'})
+            return
+
+        args = self.read_args()
+        if args is None:
+            return
+
+        status, body = self.control.submit(parts[3], parts[2], args)
+        self.send_json(status, body)
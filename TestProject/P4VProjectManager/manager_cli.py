@@ -0,0 +1,387 @@
+"""
+P4V Project Manager 命令行
+
+用法:
+    python manager_cli.py [--config config.json] run                 启动管理器
+    python manager_cli.py [--config config.json] status [项目 ...]   查询正在运行的管理器
+    python manager_cli.py [--config config.json] trigger 项目 [...]  立即同步并构建（--build-only 只构建）
+    python manager_cli.py [--config config.json] cancel 项目 [--change 变更号]
+    python manager_cli.py [--config config.json] pause|resume 项目 [...]
+    python manager_cli.py [--config config.json] logs 项目 [--build 构建] [--log 脚本] [-n 行数] [--error] [--follow]
+    python manager_cli.py [--config config.json] artifacts 项目 [--platform 平台] [--change 变更号] [--restore 目录]
+
+查询和控制命令通过管理器的控制接口（control_api）执行，不加载管理器本身（不读取项目、不连接Perforce、
+不创建日志文件）。为了启动快，只导入少量标准库模块：请求直接通过socket发送（http.client 会导入email和ssl），
+类型注解不在运行时求值（不导入typing）。
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+from urllib.parse import quote, urlencode, urlparse
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+# 连接失败的退出码（与命令被拒绝区分）
+EXIT_UNREACHABLE = 3
+
+
+def load_config(config_path: str) -> dict:
+    """读取配置文件（不存在时返回空配置）"""
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class ControlUnavailable(Exception):
+    """无法连接到控制接口，或控制接口的响应无效"""
+
+
+class ControlClient:
+    """控制接口的客户端"""
+
+    def __init__(self, url: str, timeout: float = 5, command_timeout: float = 10, token: str | None = None):
+        parsed = urlparse(url if '://' in url else f"http://{url}")
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 7020
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.token = token
+
+    @classmethod
+    def from_config(cls, config_path: str) -> 'ControlClient':
+        """按配置文件中的 control_api 连接（配置文件不存在时使用默认地址）"""
+        api_config = load_config(config_path).get('control_api', {})
+        host = api_config.get('host', '127.0.0.1')
+        if host in ('0.0.0.0', '::', ''):
+            host = '127.0.0.1'
+        return cls(f"{host}:{api_config.get('port', 7020)}",
+                   command_timeout=api_config.get('command_timeout', 10), token=api_config.get('token'))
+
+    @property
+    def address(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def request(self, method: str, path: str, args: dict | None = None,
+                query: dict | None = None) -> tuple[int, dict]:
+        """
+        发送请求（HTTP/1.0，控制接口在响应后关闭连接）
+
+        Returns:
+            (HTTP状态码, 响应内容)
+
+        Raises:
+            ControlUnavailable: 无法连接或响应无效
+        """
+        body = json.dumps(args).encode('utf-8') if args is not None else b''
+        target = quote(path) + (f"?{urlencode(query)}" if query else '')
+        authorization = f"Authorization: Bearer {self.token}\r\n" if self.token else ''
+        header = (f"{method} {target} HTTP/1.0\r\nHost: {self.host}:{self.port}\r\n{authorization}"
+                  f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+        # 控制命令由主循环执行，服务端最多等待 command_timeout 秒
+        timeout = self.timeout + (self.command_timeout if method == 'POST' else 0)
+        chunks = []
+        try:
+            with socket.create_connection((self.host, self.port), timeout=timeout) as connection:
+                connection.sendall(header.encode('ascii') + body)
+                while True:
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+        except OSError as e:
+            raise ControlUnavailable(f"无法连接到管理器的控制接口 {self.address}（需要在配置中启用control_api）: {e}")
+
+        head, _, content = b''.join(chunks).partition(b'\r\n\r\n')
+        try:
+            status = int(head.split(b' ', 2)[1])
+            return status, json.loads(content.decode('utf-8'))
+        except (IndexError, ValueError) as e:
+            raise ControlUnavailable(f"控制接口 {self.address} 返回了无效的响应: {e}")
+
+    def status(self, project: str | None = None) -> tuple[int, dict]:
+        return self.request('GET', f"/api/projects/{project}" if project else '/api/status')
+
+    def command(self, project: str, action: str, args: dict | None = None) -> tuple[int, dict]:
+        return self.request('POST', f"/api/projects/{project}/{action}", args or {})
+
+    def logs(self, project: str, query: dict) -> tuple[int, dict]:
+        return self.request('GET', f"/api/projects/{project}/logs", query=query)
+
+
+def format_time(timestamp: float | None) -> str:
+    return time.strftime('%H:%M:%S', time.localtime(timestamp)) if timestamp else '-'
+
+
+def format_eta(seconds: float | None) -> str:
+    if seconds is None:
+        return ''
+    return f"ETA {time.strftime('%H:%M', time.localtime(time.time() + seconds))}"
+
+
+def format_names(names: list[str], limit: int = 20) -> str:
+    """项目列表（很长时只显示前 limit 个）"""
+    if len(names) <= limit:
+        return ', '.join(names)
+    return f"{', '.join(names[:limit])} 等 {len(names)} 个"
+
+
+def describe_project(name: str, project: dict) -> str:
+    """一个项目的状态行"""
+    parts = [f"{name:<24} {project.get('status', '?'):<14} {project.get('version') or '-':<10}"]
+    if project.get('paused'):
+        parts.append("已暂停")
+    if project.get('current_script'):
+        parts.append(project['current_script'])
+    if project.get('agent'):
+        parts.append(f"代理 {project['agent']}")
+    bisect = project.get('bisect')
+    if bisect:
+        parts.append(f"二分 {bisect['good']}~{bisect['bad']} 剩余 {bisect['remaining']}")
+    if project.get('sync_leader'):
+        parts.append(f"共享 {project['sync_leader']}")
+    if project.get('effective_priority'):
+        parts.append(f"优先级 {project['effective_priority']}")
+    eta = format_eta(project.get('eta_seconds'))
+    if eta:
+        parts.append(eta)
+    return '  '.join(parts)
+
+
+def print_status(snapshot: dict, names: list[str]):
+    """按控制接口的状态快照输出概要和项目列表"""
+    projects = snapshot.get('projects', {})
+    if not names:
+        counts: dict[str, int] = {}
+        for project in projects.values():
+            counts[project.get('status', '?')] = counts.get(project.get('status', '?'), 0) + 1
+        summary = ', '.join(f"{status} {count}" for status, count in sorted(counts.items()))
+        limit = snapshot.get('max_parallel_builds') or '不限制'
+        print(f"快照时间 {format_time(snapshot.get('time'))}  项目 {len(projects)} ({summary})  "
+              f"本机构建 {snapshot.get('running_builds', 0)}/{limit}")
+
+        sync = snapshot.get('sync')
+        if sync:
+            print(f"正在同步 {sync['project']}: {sync['completed_files']}/{sync['total_files']} 个文件, "
+                  f"{sync['bytes_transferred'] // (1024 * 1024)} MB")
+        queues = snapshot.get('queues', {})
+        for key, label in (('pending_sync', '等待同步'), ('pending_build', '等待构建')):
+            if queues.get(key):
+                print(f"{label}: {format_names(queues[key])}")
+        for key, label in (('bisects', '二分定位'), ('agents', '构建代理')):
+            if snapshot.get(key):
+                print(f"{label}: {', '.join(snapshot[key])}")
+        presubmit = snapshot.get('presubmit')
+        if presubmit and presubmit.get('running'):
+            print(f"预提交构建: {format_names(list(presubmit['running']))}")
+        print()
+        names = sorted(projects)
+
+    for name in names:
+        print(describe_project(name, projects[name]))
+
+
+def command_run(args) -> int:
+    # 只有启动管理器时才加载管理器（及其依赖和日志配置）
+    from P4VProjectManager import main as run_manager
+    return run_manager(args.config)
+
+
+def command_status(args, client: ControlClient) -> int:
+    # 指定项目时只获取这些项目的状态，不传输全部项目的快照
+    if args.projects:
+        snapshot = {'projects': {}}
+        for name in args.projects:
+            status, project = client.status(name)
+            if status != 200:
+                print(project.get('message', f"HTTP {status}"), file=sys.stderr)
+                return 1
+            snapshot['projects'][name] = project
+    else:
+        status, snapshot = client.status()
+        if status != 200:
+            print(snapshot.get('message', f"HTTP {status}"), file=sys.stderr)
+            return 1
+
+    if args.json:
+        print(json.dumps(snapshot['projects'] if args.projects else snapshot, ensure_ascii=False, indent=2))
+    else:
+        print_status(snapshot, args.projects)
+    return 0
+
+
+def command_project_action(args, client: ControlClient) -> int:
+    """对每个项目执行控制命令，任一项目被拒绝时返回1"""
+    if args.command == 'trigger':
+        action = 'build' if args.build_only else 'sync'
+    else:
+        action = args.command
+    request_args = {'change': args.change} if getattr(args, 'change', None) else {}
+
+    exit_code = 0
+    for project in args.projects:
+        status, result = client.command(project, action, request_args)
+        print(f"{project}: {result.get('message', '')}")
+        if status not in (200, 202):
+            exit_code = 1
+    return exit_code
+
+
+def command_logs(args, client: ControlClient) -> int:
+    """输出构建日志的末尾或第一个错误附近的内容；--follow 时持续输出新写入的行"""
+    query = {'lines': args.lines}
+    for key in ('build', 'log'):
+        if getattr(args, key):
+            query[key] = getattr(args, key)
+    if args.error:
+        query['error'] = 1
+
+    status, result = client.logs(args.project, query)
+    if status != 200:
+        print(result.get('message', f"HTTP {status}"), file=sys.stderr)
+        return 1
+    print(f"== {result['build']}/{result['log']} (第 {result['start'] + 1} 行起"
+          + (f", 第一个错误在第 {result['first_error_line'] + 1} 行" if result['first_error_line'] >= 0 else '')
+          + ") ==", file=sys.stderr)
+    for line in result['text']:
+        print(line)
+    if not args.follow:
+        return 0
+
+    # 继续读取同一个构建；当前日志读完且下一个脚本已开始时切换到下一个日志
+    query.pop('error', None)
+    query.update(build=result['build'], log=result['log'], lines=1000)
+    position = result['next']
+    try:
+        while True:
+            status, result = client.logs(args.project, dict(query, start=position))
+            if status != 200:
+                print(result.get('message', f"HTTP {status}"), file=sys.stderr)
+                return 1
+            for line in result['text']:
+                print(line, flush=True)
+            position = result['next']
+
+            logs = result['logs']
+            if not result['text'] and query['log'] in logs and logs.index(query['log']) + 1 < len(logs):
+                query['log'] = logs[logs.index(query['log']) + 1]
+                position = 0
+                print(f"== {result['build']}/{query['log']} ==", file=sys.stderr)
+                continue
+            time.sleep(1)
+    except KeyboardInterrupt:
+        return 0
+
+
+def command_artifacts(args) -> int:
+    """列出或恢复已发布的构建产物（直接读取产物仓库，不需要管理器运行）"""
+    from artifact_store import ArtifactStore
+
+    config = load_config(args.config)
+    root = config.get('artifacts', {}).get('dir') or os.path.join(
+        os.path.dirname(os.path.abspath(args.config)), 'artifacts')
+    store = ArtifactStore(root)
+
+    if args.restore:
+        found = store.find(args.project, args.platform, args.change)
+        if found is None:
+            print(f"没有找到项目 {args.project} 的构建产物", file=sys.stderr)
+            return 1
+        platform, changelist, _ = found
+        try:
+            count = store.restore(args.project, platform, changelist, args.restore)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"恢复 {args.project}/{platform}/{changelist} 失败: {e}", file=sys.stderr)
+            return 1
+        print(f"已恢复 {args.project}/{platform}/{changelist}: {count} 个文件 -> {args.restore}")
+        return 0
+
+    builds = [(info['time'], platform, changelist, info)
+              for platform, changelists in store.sets.get(args.project, {}).items()
+              if args.platform in (None, platform)
+              for changelist, info in changelists.items() if args.change in (None, changelist)]
+    if not builds:
+        print(f"没有找到项目 {args.project} 的构建产物", file=sys.stderr)
+        return 1
+    for published, platform, changelist, info in sorted(builds, reverse=True):
+        print(f"{platform:<12} {changelist:<16} {time.strftime('%Y-%m-%d %H:%M', time.localtime(published))}  "
+              f"{info['files']} 个文件  {info['bytes'] / (1024 * 1024):.1f}MB  "
+              f"新增 {info['new_bytes'] / (1024 * 1024):.1f}MB")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='manager_cli', description='P4V Project Manager')
+    parser.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='配置文件（默认与本文件同目录的config.json）')
+    parser.add_argument('--url', help='控制接口地址（默认按配置文件中的control_api）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('run', help='启动管理器')
+
+    status_parser = subparsers.add_parser('status', help='查询项目状态')
+    status_parser.add_argument('projects', nargs='*', help='项目（默认全部）')
+    status_parser.add_argument('--json', action='store_true', help='输出JSON')
+
+    trigger_parser = subparsers.add_parser('trigger', help='立即同步到最新版本并构建')
+    trigger_parser.add_argument('projects', nargs='+')
+    trigger_parser.add_argument('--build-only', action='store_true', help='不同步，以工作区当前内容构建')
+
+    cancel_parser = subparsers.add_parser('cancel', help='取消等待中或正在进行的任务')
+    cancel_parser.add_argument('projects', nargs='+')
+    cancel_parser.add_argument('--change', help='取消该搁置变更的预提交构建')
+
+    for name, text in (('pause', '暂停项目'), ('resume', '恢复项目')):
+        subparsers.add_parser(name, help=text).add_argument('projects', nargs='+')
+
+    logs_parser = subparsers.add_parser('logs', help='查看构建日志（末尾、第一个错误或持续输出）')
+    logs_parser.add_argument('project')
+    logs_parser.add_argument('--build', help='构建日志目录名（默认最近一次构建）')
+    logs_parser.add_argument('--log', help='日志文件名或脚本名（默认最后一个日志，--error时为第一个有错误的日志）')
+    logs_parser.add_argument('-n', '--lines', type=int, default=50, help='输出的行数（默认50）')
+    logs_parser.add_argument('--error', action='store_true', help='输出第一个错误行附近的内容')
+    logs_parser.add_argument('-f', '--follow', action='store_true', help='持续输出新写入的行（Ctrl+C结束）')
+
+    artifacts_parser = subparsers.add_parser('artifacts', help='列出或恢复已发布的构建产物')
+    artifacts_parser.add_argument('project')
+    artifacts_parser.add_argument('--platform', help='只查找该平台的产物')
+    artifacts_parser.add_argument('--change', help='只查找该变更号的产物（恢复时默认最近的一次）')
+    artifacts_parser.add_argument('--restore', metavar='DIR', help='把找到的产物恢复到目录中')
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.command == 'run':
+        return command_run(args)
+    if args.command == 'artifacts':
+        return command_artifacts(args)
+
+    try:
+        if args.url:
+            # 指定地址时仍使用配置文件中的token
+            token = load_config(args.config).get('control_api', {}).get('token')
+            client = ControlClient(args.url, token=token)
+        else:
+            client = ControlClient.from_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"无法读取配置文件 {args.config}: {e}", file=sys.stderr)
+        return 1
+    try:
+        if args.command == 'status':
+            return command_status(args, client)
+        if args.command == 'logs':
+            return command_logs(args, client)
+        return command_project_action(args, client)
+    except ControlUnavailable as e:
+        print(e, file=sys.stderr)
+        return EXIT_UNREACHABLE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
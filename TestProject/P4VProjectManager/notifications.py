@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import smtplib
+import logging
+import threading
+import urllib.request
+from pathlib import Path
+from collections import deque
+from datetime import datetime
+from email.message import EmailMessage
+from dataclasses import asdict, dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+EVENTS = ('build_completed', 'build_failed', 'build_timeout', 'sync_failed', 'bisect_finished',
+          'presubmit_finished')
+
+
+@dataclass
+class Notification:
+    """一条通知"""
+    event: str  # EVENTS 之一
+    project: str
+    version: str
+    message: str
+    details: Dict = field(default_factory=dict)
+    time: float = field(default_factory=time.time)
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        """去重键：同一项目同一版本的同一事件只通知一次"""
+        return self.event, self.project, self.version
+
+
+class NotificationSink:
+    """
+    通知渠道的基类
+
+    子类实现 send()，一次发送一批通知，失败时抛出异常（由调用者重试）。
+    """
+    type_name = ''
+
+    def __init__(self, config: Dict):
+        self.name = config.get('name', self.type_name)
+        self.events = set(config.get('events', EVENTS))  # 订阅的事件
+        self.timeout = config.get('timeout', 10)
+
+    def accepts(self, notification: Notification) -> bool:
+        return notification.event in self.events
+
+    def send(self, batch: List[Notification]):
+        raise NotImplementedError
+
+
+class WebhookSink(NotificationSink):
+    """以JSON POST到webhook地址: {"notifications": [...]}"""
+    type_name = 'webhook'
+
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.url = config['url']
+        self.headers = config.get('headers', {})
+
+    def send(self, batch: List[Notification]):
+        data = json.dumps({'notifications': [asdict(item) for item in batch]}, ensure_ascii=False).encode('utf-8')
+        request = urllib.request.Request(self.url, data=data, method='POST',
+                                         headers={'Content-Type': 'application/json; charset=utf-8',
+                                                  **self.headers})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class SmtpSink(NotificationSink):
+    """每批通知发送一封邮件"""
+    type_name = 'smtp'
+
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.host = config.get('host', 'localhost')
+        self.port = config.get('port', 25)
+        self.sender = config.get('from', 'p4v-project-manager@localhost')
+        self.recipients = config['to']
+        self.username = config.get('username')
+        self.password = config.get('password')
+        self.starttls = config.get('starttls', False)
+        self.subject_prefix = config.get('subject_prefix', '[P4V构建]')
+
+    def send(self, batch: List[Notification]):
+        message = EmailMessage()
+        failures = sum(1 for item in batch if item.event in ('build_failed', 'build_timeout', 'sync_failed') or
+                       item.details.get('state') in ('failed', 'error'))
+        summary = batch[0].message if len(batch) == 1 else f"{len(batch)} 条通知，其中 {failures} 条失败"
+        message['Subject'] = f"{self.subject_prefix} {summary}"
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message.set_content('\n'.join(
+            f"[{datetime.fromtimestamp(item.time).strftime('%Y-%m-%d %H:%M:%S')}] {item.message}"
+            for item in batch))
+
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+
+
+class FileSink(NotificationSink):
+    """每批通知写入目录中的一个JSON文件（先写临时文件再改名，读取方不会读到写了一半的文件）"""
+    type_name = 'file'
+
+    def __init__(self, config: Dict):
+        super().__init__(config)
+        self.directory = Path(config['dir'])
+
+    def send(self, batch: List[Notification]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{batch[0].project}.json"
+        temp_file = self.directory / (name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump([asdict(item) for item in batch], f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.directory / name)
+
+
+SINK_CLASSES = {cls.type_name: cls for cls in (WebhookSink, SmtpSink, FileSink)}
+
+
+class SinkWorker:
+    """
+    单个渠道的发送线程
+
+    通知先进入有界队列（满时丢弃最早的），线程等待 batch_window 秒收集更多通知后一起发送；
+    发送失败时整批按指数退避重试，超过 max_retries 次后丢弃。每个渠道独立发送，慢或不可用的渠道不影响其他渠道。
+    """
+
+    def __init__(self, sink: NotificationSink, batch_window: float, max_batch: int,
+                 max_retries: int, retry_delay: float, max_queue: int):
+        self.sink = sink
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue: Deque[Notification] = deque(maxlen=max_queue)
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.stats = {'sent': 0, 'failed': 0, 'dropped': 0, 'retries': 0}
+        self.thread = threading.Thread(target=self.run, name=f"notify-{sink.name}", daemon=True)
+        self.thread.start()
+
+    def put(self, notification: Notification):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.stats['dropped'] += 1
+                logger.warning(f"通知渠道 {self.sink.name} 的队列已满，丢弃最早的通知")
+            self.queue.append(notification)
+            self.condition.notify()
+
+    def next_batch(self) -> Optional[List[Notification]]:
+        """等待并取出下一批通知；停止且队列为空时返回None"""
+        with self.condition:
+            while not self.queue and not self.stopping:
+                self.condition.wait()
+            if not self.queue:
+                return None
+            # 收集窗口：等待同一时间段内的其他通知一起发送（停止时立即发送）
+            deadline = time.time() + self.batch_window
+            while len(self.queue) < self.max_batch and not self.stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.sink.send(batch)
+                    self.stats['sent'] += len(batch)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries or self.stopping:
+                        self.stats['failed'] += len(batch)
+                        logger.error(f"通知渠道 {self.sink.name} 发送失败，丢弃 {len(batch)} 条通知: {e}")
+                        break
+                    delay = self.retry_delay * (2 ** attempt)
+                    self.stats['retries'] += 1
+                    logger.warning(f"通知渠道 {self.sink.name} 发送失败，{delay:.0f} 秒后重试: {e}")
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.stopping, timeout=delay)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+
+class NotificationManager:
+    """
+    构建通知
+
+    notify() 只做去重和入队，不会阻塞调度；每个渠道在自己的线程中批量发送和重试。
+    """
+
+    def __init__(self, sinks: List[NotificationSink], batch_window: float = 10, max_batch: int = 50,
+                 dedup_window: float = 600, max_retries: int = 5, retry_delay: float = 30,
+                 max_queue: int = 1000):
+        """
+        Args:
+            sinks: 通知渠道
+            batch_window: 收集一批通知的时间（秒）
+            max_batch: 每批最多的通知数
+            dedup_window: 同一事件在该时间内（秒）只通知一次
+            max_retries: 发送失败后的重试次数
+            retry_delay: 第一次重试的等待时间（秒），之后每次加倍
+            max_queue: 每个渠道排队的通知数上限
+        """
+        self.dedup_window = dedup_window
+        self.recent: Dict[Tuple[str, str, str], float] = {}
+        self.suppressed = 0
+        self.workers = [SinkWorker(sink, batch_window, max_batch, max_retries, retry_delay, max_queue)
+                        for sink in sinks]
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'NotificationManager':
+        sinks = []
+        for sink_config in config.get('sinks', []):
+            sinks.append(SINK_CLASSES[sink_config['type']](sink_config))
+        return cls(sinks,
+                   batch_window=config.get('batch_window', 10),
+                   max_batch=config.get('max_batch', 50),
+                   dedup_window=config.get('dedup_window', 600),
+                   max_retries=config.get('max_retries', 5),
+                   retry_delay=config.get('retry_delay', 30),
+                   max_queue=config.get('max_queue', 1000))
+
+    def notify(self, notification: Notification) -> bool:
+        """
+        发送通知（立即返回）
+
+        Returns:
+            是否已加入发送队列（重复的通知返回False）
+        """
+        now = notification.time
+        if len(self.recent) > 1000:
+            self.recent = {key: sent for key, sent in self.recent.items() if now - sent < self.dedup_window}
+        last = self.recent.get(notification.key)
+        if last is not None and now - last < self.dedup_window:
+            self.suppressed += 1
+            return False
+        self.recent[notification.key] = now
+
+        for worker in self.workers:
+            if worker.sink.accepts(notification):
+                worker.put(notification)
+        return True
+
+    def describe(self) -> List[str]:
+        """每个渠道的发送统计"""
+        descriptions = []
+        for worker in self.workers:
+            parts = [f"{worker.sink.name} 已发送 {worker.stats['sent']}"]
+            if worker.queue:
+                parts.append(f"排队 {len(worker.queue)}")
+            if worker.stats['failed']:
+                parts.append(f"失败 {worker.stats['failed']}")
+            descriptions.append(', '.join(parts))
+        return descriptions
+
+    def stop(self, timeout: float = 5):
+        """停止发送线程，已排队的通知尽量在超时前发出"""
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.thread.join(max(0.0, deadline - time.time()))
@@ -0,0 +1,264 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 未指定 server 的项目使用的服务器（沿用环境中的 P4PORT/P4USER/P4CLIENT 等设置）
+DEFAULT_SERVER = 'default'
+
+
+class TokenBucket:
+    """
+    令牌桶限速
+
+    每秒补充 rate 个令牌，最多积累 burst 个；rate 为0表示不限速。
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        """取一个令牌（不等待）"""
+        if not self.rate:
+            return True
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """距下一个令牌可用的时间（秒）"""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self.refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class P4Server:
+    """
+    一个Perforce服务器
+
+    同时访问该服务器的p4命令数不超过 max_concurrent（检查更新、同步预估和正在进行的同步都计入），
+    命令的发起速率由令牌桶限制。检查更新在服务器自己的线程中排队执行，慢的服务器只会让自己的队列变长，
+    不影响其他服务器上的项目。
+    """
+
+    def __init__(self, name: str, port: str = '', user: str = '', max_concurrent: int = 4,
+                 rate: float = 0, burst: int = 0):
+        """
+        Args:
+            name: 服务器名称（配置中的键）
+            port: P4PORT，为空时沿用环境中的设置
+            user: P4USER，为空时沿用环境中的设置
+            max_concurrent: 同时执行的p4命令数上限
+            rate: 每秒最多发起的p4命令数，0表示不限速
+            burst: 允许的突发命令数，0表示与 max_concurrent 相同
+        """
+        self.name = name
+        self.port = port
+        self.user = user
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(rate, burst or max_concurrent)
+        self.in_flight = 0
+        self.queued = 0  # 在服务器线程中等待执行的命令数
+        self.condition = threading.Condition()
+        self.stats = {'commands': 0, 'failed': 0, 'throttled': 0}
+        self.latencies: Deque[float] = deque(maxlen=200)
+        self.pool: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def from_config(cls, name: str, config: Dict) -> 'P4Server':
+        return cls(name,
+                   port=config.get('port', ''),
+                   user=config.get('user', ''),
+                   max_concurrent=config.get('max_concurrent', 4),
+                   rate=config.get('rate', 0),
+                   burst=config.get('burst', 0))
+
+    def saturated(self) -> bool:
+        """并发数已满"""
+        return self.in_flight >= self.max_concurrent
+
+    def try_acquire(self) -> bool:
+        """占用一个并发名额和一个令牌（不等待，用于主循环）"""
+        with self.condition:
+            if self.saturated():
+                return False
+            if not self.bucket.try_take():
+                self.stats['throttled'] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        """等待并发名额和令牌（用于服务器线程）"""
+        with self.condition:
+            while True:
+                if not self.saturated():
+                    if self.bucket.try_take():
+                        self.in_flight += 1
+                        return
+                    self.stats['throttled'] += 1
+                    self.condition.wait(self.bucket.wait_time())
+                else:
+                    self.condition.wait()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """在并发和速率限制内执行一个p4命令，并记录耗时"""
+        self.acquire()
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            self.latencies.append(time.time() - start)
+            self.stats['commands'] += 1
+            self.release()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """在服务器自己的线程中执行p4命令（立即返回）"""
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.max_concurrent, thread_name_prefix=f"p4-{self.name}")
+        with self.condition:
+            self.queued += 1
+
+        def run():
+            with self.condition:
+                self.queued -= 1
+            return self.call(fn, *args, **kwargs)
+
+        return self.pool.submit(run)
+
+    def track(self, future: Future):
+        """主循环提交到其他执行器的命令已通过 try_acquire 占用名额，完成后释放"""
+        start = time.time()
+
+        def on_done(_):
+            self.latencies.append(time.time() - start)
+            self.stats['commands'] += 1
+            self.release()
+
+        future.add_done_callback(on_done)
+
+    def snapshot(self) -> Dict:
+        """统计信息（可以JSON序列化）"""
+        ordered = sorted(self.latencies)
+        return {
+            'port': self.port,
+            'max_concurrent': self.max_concurrent,
+            'rate': self.bucket.rate,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'commands': self.stats['commands'],
+            'failed': self.stats['failed'],
+            'throttled': self.stats['throttled'],
+            'latency_p50': ordered[len(ordered) // 2] if ordered else None
+        }
+
+    def describe(self) -> str:
+        parts = [f"{self.name} {self.in_flight}/{self.max_concurrent}"]
+        if self.queued:
+            parts.append(f"排队 {self.queued}")
+        if self.stats['failed']:
+            parts.append(f"失败 {self.stats['failed']}")
+        return ' '.join(parts)
+
+    def shutdown(self):
+        if self.pool:
+            try:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+            except TypeError:  # Python 3.8 不支持 cancel_futures
+                self.pool.shutdown(wait=False)
+
+
+class P4ServerPool:
+    """
+    项目到Perforce服务器和工作区的映射
+
+    项目通过 server 指定 p4_servers 中的服务器，通过 p4client/p4user 指定工作区和用户；
+    p4命令通过环境变量 P4PORT/P4USER/P4CLIENT 指定连接，不需要修改各处的命令行。
+    """
+
+    def __init__(self, servers_config: Dict, projects: Dict[str, Dict]):
+        self.servers: Dict[str, P4Server] = {
+            name: P4Server.from_config(name, config) for name, config in servers_config.items()}
+        if DEFAULT_SERVER not in self.servers:
+            self.servers[DEFAULT_SERVER] = P4Server(DEFAULT_SERVER)
+        self.projects = projects
+        self.envs: Dict[str, Optional[Dict[str, str]]] = {}
+
+    def server_name(self, project_name: str) -> str:
+        return self.projects[project_name].get('server', DEFAULT_SERVER)
+
+    def for_project(self, project_name: str) -> P4Server:
+        return self.servers[self.server_name(project_name)]
+
+    def env(self, project_name: str) -> Optional[Dict[str, str]]:
+        """
+        项目p4命令的环境变量（按项目缓存）
+
+        Returns:
+            环境变量；没有任何设置时返回None（沿用当前进程的环境）
+        """
+        if project_name not in self.envs:
+            server = self.for_project(project_name)
+            project_config = self.projects[project_name]
+            settings = {
+                'P4PORT': server.port,
+                'P4USER': project_config.get('p4user') or server.user,
+                'P4CLIENT': project_config.get('p4client', '')
+            }
+            settings = {key: value for key, value in settings.items() if value}
+            self.envs[project_name] = dict(os.environ, **settings) if settings else None
+        return self.envs[project_name]
+
+    def server_env(self, name: str) -> Optional[Dict[str, str]]:
+        """服务器级命令（如 p4 info）的环境变量"""
+        server = self.servers[name]
+        settings = {key: value for key, value in (('P4PORT', server.port), ('P4USER', server.user)) if value}
+        return dict(os.environ, **settings) if settings else None
+
+    def group_by_server(self, project_names: List[str]) -> Dict[str, List[str]]:
+        """按服务器分组"""
+        groups: Dict[str, List[str]] = {}
+        for project_name in project_names:
+            groups.setdefault(self.server_name(project_name), []).append(project_name)
+        return groups
+
+    def in_use(self) -> List[P4Server]:
+        """有项目使用的服务器"""
+        names = {self.server_name(project_name) for project_name in self.projects}
+        return [server for name, server in self.servers.items() if name in names]
+
+    def describe(self) -> List[str]:
+        return [server.describe() for server in self.in_use()]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {server.name: server.snapshot() for server in self.in_use()}
+
+    def shutdown(self):
+        for server in self.servers.values():
+            server.shutdown()
@@ -0,0 +1,370 @@
+import os
+import json
+import stat
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from pathlib import Path
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from build_logs import BuildLogStore
+from process_supervisor import ProcessSupervisor
+from sync_sharing import WorkspaceFanout
+
+logger = logging.getLogger('P4VProjectManager')
+
+CLONE_MODES = ('copy', 'hardlink')
+
+
+@dataclass
+class ShelvedChange:
+    """带有预提交标记的搁置变更"""
+    change: str
+    user: str = ""
+    description: str = ""
+    time: str = ""  # 变更的更新时间，重新搁置后会变化
+
+
+@dataclass
+class PresubmitJob:
+    """一个搁置变更的预提交构建"""
+    project_name: str
+    change: ShelvedChange
+    base_version: str  # 克隆的工作区所在的版本
+    state: str = "queued"  # queued / preparing / building / passed / failed / error / cancelled
+    current_script: str = ""
+    failed_script: str = ""
+    error: str = ""
+    workspace: str = ""
+    log_dir: str = ""
+    start_time: float = 0
+    end_time: float = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.project_name}@{self.change.change}"
+
+    def result(self) -> Dict:
+        """结果记录（可以JSON序列化）"""
+        return {
+            'state': self.state,
+            'user': self.change.user,
+            'shelf_time': self.change.time,
+            'base_version': self.base_version,
+            'failed_script': self.failed_script,
+            'error': self.error,
+            'log_dir': self.log_dir,
+            'start_time': self.start_time,
+            'duration': (self.end_time or time.time()) - self.start_time if self.start_time else 0
+        }
+
+
+def parse_shelved_changes(output: str) -> List[ShelvedChange]:
+    """解析 p4 -ztag changes -l 的输出（每条记录以 change 字段开始，desc 是最后一个字段，可以有多行）"""
+    records: List[Dict[str, str]] = []
+    key = None
+    for line in output.splitlines():
+        if line.startswith('... change '):
+            records.append({})
+        if line.startswith('... ') and records:
+            key, _, value = line[4:].partition(' ')
+            records[-1][key] = value
+        elif key == 'desc':
+            records[-1]['desc'] += '\n' + line
+    return [ShelvedChange(record['change'], record.get('user', ''), record.get('desc', '').strip(),
+                          record.get('time', '')) for record in records]
+
+
+def list_shelved_changes(depot_path: str, tag: str, env: Optional[Dict[str, str]],
+                         timeout: float = 60) -> List[ShelvedChange]:
+    """列出depot路径下描述中包含 tag 的搁置变更"""
+    result = subprocess.run(f'p4 -ztag changes -s shelved -l "{depot_path}"', shell=True, capture_output=True,
+                            text=True, encoding='utf-8', env=env, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return [change for change in parse_shelved_changes(result.stdout) if tag in change.description]
+
+
+class PresubmitRunner:
+    """
+    搁置变更的预提交构建
+
+    每个构建使用一次性的临时工作区：从项目已同步的工作区克隆（复制或硬链接），
+    创建以项目工作区为模板的临时p4工作区并把have列表设为克隆的版本（p4 flush，不传输文件），
+    再unshelve变更、自动合并，然后以低优先级、以临时工作区为当前目录执行项目的预提交脚本
+    （presubmit_scripts，默认build_scripts）。结束后撤销打开的文件，删除临时工作区。
+    结果按 项目 -> 变更 保存在结果文件中。
+    """
+
+    def __init__(self, supervisor: ProcessSupervisor, log_store: BuildLogStore, scratch_dir: Path,
+                 results_file: Path, clone_mode: str = 'copy', build_timeout: float = 10800,
+                 keep_results: int = 200):
+        """
+        Args:
+            supervisor: 进程树监管（用于超时和取消时结束脚本）
+            log_store: 构建日志
+            scratch_dir: 临时工作区的根目录
+            results_file: 结果文件
+            clone_mode: 克隆工作区的方式（copy / hardlink）
+            build_timeout: 每个预提交构建的超时时间（秒）
+            keep_results: 每个项目保留的结果数
+        """
+        self.supervisor = supervisor
+        self.log_store = log_store
+        self.scratch_dir = Path(scratch_dir)
+        self.results_file = Path(results_file)
+        self.fanout = WorkspaceFanout(clone_mode)
+        self.build_timeout = build_timeout
+        self.keep_results = keep_results
+        # {项目: {变更号: 结果}}
+        self.results: Dict[str, Dict[str, Dict]] = {}
+        self.jobs: Dict[str, PresubmitJob] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.results_file.exists():
+            return
+        try:
+            with open(self.results_file, 'r', encoding='utf-8') as f:
+                self.results = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载预提交构建结果失败: {e}")
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.results, ensure_ascii=False)
+        temp_file = self.results_file.with_name(self.results_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_file, self.results_file)
+
+    @staticmethod
+    def process_key(job: PresubmitJob) -> str:
+        return f"presubmit:{job.key}"
+
+    def is_known(self, project_name: str, change: ShelvedChange) -> bool:
+        """变更（同一次搁置）是否已构建过或正在构建"""
+        if f"{project_name}@{change.change}" in self.jobs:
+            return True
+        with self.lock:
+            result = self.results.get(project_name, {}).get(change.change)
+        return result is not None and result.get('shelf_time') == change.time
+
+    def running_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.state in ("preparing", "building"))
+
+    def is_active(self, project_name: str) -> bool:
+        """项目是否有正在进行的预提交构建（期间不开始该项目的主线构建）"""
+        return any(job.project_name == project_name and job.state in ("preparing", "building")
+                   for job in self.jobs.values())
+
+    def is_cloning(self, project_name: str) -> bool:
+        """是否正在克隆项目的工作区（期间不能同步该工作区）"""
+        return any(job.project_name == project_name and job.state == "preparing" and not job.workspace
+                   for job in self.jobs.values())
+
+    def start(self, job: PresubmitJob, project_config: Dict, env: Optional[Dict[str, str]], server):
+        """
+        开始预提交构建（在后台线程中执行）
+
+        Args:
+            job: 预提交构建
+            project_config: 项目配置（depot_path、local_path、scripts_path、build_scripts）
+            env: 项目p4命令的环境变量
+            server: 项目所在的服务器（P4Server），p4命令计入其并发和速率限制
+        """
+        job.state = "preparing"
+        job.start_time = time.time()
+        self.jobs[job.key] = job
+        thread = threading.Thread(target=self.run, args=(job, project_config, env, server),
+                                  name=f"presubmit-{job.key}", daemon=True)
+        thread.start()
+
+    def p4(self, server, command: str, env: Optional[Dict[str, str]], cwd: Optional[str] = None,
+           input_text: Optional[str] = None) -> str:
+        result = server.call(subprocess.run, f'p4 {command}', shell=True, capture_output=True, text=True,
+                             encoding='utf-8', input=input_text, cwd=cwd, env=env, timeout=self.build_timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"p4 {command.split()[0]} 失败: {(result.stderr or result.stdout).strip()}")
+        return result.stdout
+
+    def run(self, job: PresubmitJob, project_config: Dict, env: Optional[Dict[str, str]], server):
+        env = dict(env or os.environ)
+        scratch = self.scratch_dir / f"{job.project_name}_{job.change.change}"
+        scratch_client = ''
+        scratch_env = env
+        client_created = False
+        try:
+            template = env.get('P4CLIENT') or self.client_name(env, server)
+            scratch_client = f"{template}_presubmit_{job.change.change}"
+            scratch_env = dict(env, P4CLIENT=scratch_client)
+            # 克隆已同步的工作区，并创建指向克隆目录的临时p4工作区
+            if scratch.exists():
+                self.remove_scratch(scratch, Path(project_config['local_path']))
+            start = time.time()
+            updated, _, copied = self.fanout.mirror(Path(project_config['local_path']), scratch)
+            job.workspace = str(scratch)
+            logger.info(f"[预提交 {job.key}] 已克隆工作区: {updated} 个文件, 复制 {copied // (1024 * 1024)} MB "
+                        f"(耗时 {time.time() - start:.1f}秒)")
+
+            spec = self.p4(server, f'client -o -t "{template}" "{scratch_client}"', env)
+            spec = '\n'.join(f"Root:\t{scratch}" if line.startswith('Root:') else line
+                             for line in spec.splitlines()) + '\n'
+            self.p4(server, 'client -i', env, input_text=spec)
+            client_created = True
+            target = project_config['depot_path'] + (f"@{job.base_version}" if job.base_version.isdigit() else '')
+            self.p4(server, f'flush -q "{target}"', scratch_env, cwd=str(scratch))
+
+            # unshelve 并自动合并（搁置时的基础版本与克隆的版本不同时需要合并）
+            self.p4(server, f'unshelve -s {job.change.change} -f', scratch_env, cwd=str(scratch))
+            self.p4(server, 'resolve -am', scratch_env, cwd=str(scratch))
+            if self.p4(server, 'resolve -n', scratch_env, cwd=str(scratch)).strip():
+                raise RuntimeError("存在需要手动解决的冲突")
+
+            if job.state == "preparing":
+                job.state = "building"
+                self.build(job, project_config, scratch_env, scratch)
+        except Exception as e:
+            if job.state in ("preparing", "building"):
+                job.state = "error"
+                job.error = str(e)
+        finally:
+            job.current_script = ""
+            self.cleanup(job, scratch, scratch_client, scratch_env, client_created,
+                         Path(project_config['local_path']), server)
+            self.record(job)
+            job.end_time = time.time()
+
+    def client_name(self, env: Dict[str, str], server) -> str:
+        """当前环境的p4工作区名（没有设置P4CLIENT时）"""
+        for line in self.p4(server, '-ztag info', env).splitlines():
+            if line.startswith('... clientName '):
+                return line[len('... clientName '):].strip()
+        raise RuntimeError("无法确定项目的p4工作区")
+
+    def build(self, job: PresubmitJob, project_config: Dict, env: Dict[str, str], scratch: Path):
+        """
+        以低优先级依次执行预提交脚本
+
+        当前目录为临时工作区，脚本通过 P4V_WORKSPACE 等环境变量获取临时工作区，
+        输出不会写到项目的 scripts_path 或工作区中
+        """
+        scripts_path = Path(project_config['scripts_path'])
+        log_dir = self.log_store.new_build_dir(job.project_name, f"presubmit_{job.change.change}")
+        job.log_dir = str(log_dir)
+        deadline = job.start_time + self.build_timeout
+        env = dict(env, P4V_WORKSPACE=str(scratch), P4V_SHELVED_CHANGE=job.change.change,
+                   P4V_BASE_VERSION=job.base_version)
+        popen_options = {}
+        priority_flags = 0
+        if os.name == 'nt':
+            priority_flags = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        else:
+            popen_options['preexec_fn'] = lambda: os.nice(10)
+        popen_options.update(self.supervisor.group_options(priority_flags))
+
+        scripts = project_config.get('presubmit_scripts') or project_config.get('build_scripts', [])
+        for index, script in enumerate(scripts, 1):
+            job.current_script = script
+            with open(log_dir / BuildLogStore.script_log_name(index, script), 'wb') as output:
+                process = subprocess.Popen(
+                    f'"{scripts_path / script}" "{job.project_name}"',
+                    shell=True,
+                    cwd=str(scratch),
+                    env=env,
+                    stdout=output,
+                    stderr=subprocess.STDOUT,
+                    **popen_options
+                )
+                key = self.process_key(job)
+                self.supervisor.track(key, process)
+                try:
+                    returncode = process.wait(timeout=max(1.0, deadline - time.time()))
+                except subprocess.TimeoutExpired:
+                    self.supervisor.kill_tree(key)
+                    raise RuntimeError(f"构建超时 ({script})")
+                finally:
+                    self.supervisor.untrack(key)
+            if job.state != "building":
+                return
+            if returncode != 0:
+                job.state = "failed"
+                job.failed_script = script
+                return
+        job.state = "passed"
+
+    def cleanup(self, job: PresubmitJob, scratch: Path, scratch_client: str, scratch_env: Dict[str, str],
+                client_created: bool, source_root: Path, server):
+        """撤销打开的文件并删除临时p4工作区和目录"""
+        if client_created:
+            try:
+                self.p4(server, 'revert -k //...', scratch_env, cwd=str(scratch))
+                self.p4(server, f'client -d "{scratch_client}"', scratch_env)
+            except Exception as e:
+                logger.warning(f"[预提交 {job.key}] 删除临时p4工作区 {scratch_client} 失败: {e}")
+        if scratch.exists():
+            self.remove_scratch(scratch, source_root)
+
+    def remove_scratch(self, scratch: Path, source_root: Path):
+        """删除临时目录（不影响通过硬链接共享内容的项目工作区）"""
+        def on_error(func, path, _):
+            # Windows上只读文件无法删除；只读属性属于文件内容（硬链接共享），删除后恢复项目工作区中文件的只读属性
+            os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+            func(path)
+            if self.fanout.mode == 'hardlink':
+                original = source_root / Path(path).relative_to(scratch)
+                if original.is_file():
+                    os.chmod(original, original.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+        shutil.rmtree(scratch, onerror=on_error)
+
+    def record(self, job: PresubmitJob):
+        """保存结果（每个项目只保留最近的 keep_results 个）"""
+        with self.lock:
+            project_results = self.results.setdefault(job.project_name, {})
+            project_results[job.change.change] = job.result()
+            if len(project_results) > self.keep_results:
+                for change in sorted(project_results, key=int)[:len(project_results) - self.keep_results]:
+                    del project_results[change]
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning(f"保存预提交构建结果失败: {e}")
+
+    def cancel(self, key: str):
+        """取消预提交构建并结束正在执行的脚本"""
+        job = self.jobs.get(key)
+        if job and job.state in ("preparing", "building"):
+            job.state = "cancelled"
+            self.supervisor.kill_tree(self.process_key(job))
+
+    def finished(self) -> List[PresubmitJob]:
+        """取出已结束的预提交构建"""
+        done = [job for job in self.jobs.values() if job.end_time]
+        for job in done:
+            del self.jobs[job.key]
+        return done
+
+    def describe(self) -> List[str]:
+        """正在进行的预提交构建的文字描述"""
+        descriptions = []
+        for job in self.jobs.values():
+            if job.state == "building":
+                descriptions.append(f"{job.key} ({job.current_script}, {(time.time() - job.start_time) / 60:.1f}分钟)")
+            else:
+                descriptions.append(f"{job.key} (准备工作区)")
+        return descriptions
+
+    def snapshot(self) -> Dict:
+        """进行中的构建和最近的结果（可以JSON序列化）"""
+        with self.lock:
+            recent = {project: dict(sorted(results.items(), key=lambda item: -int(item[0]))[:20])
+                      for project, results in self.results.items()}
+        return {
+            'running': {key: asdict(job) for key, job in self.jobs.items()},
+            'results': recent
+        }
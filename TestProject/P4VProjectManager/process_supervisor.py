@@ -0,0 +1,173 @@
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+from typing import Dict, Set
+
+try:
+    import psutil  # 可选依赖，用于记录和确认子进程
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger('P4VProjectManager')
+
+
+class ProcessSupervisor:
+    """
+    进程树监管
+
+    被监管的进程在独立的进程组中启动（Windows: CREATE_NEW_PROCESS_GROUP，
+    其他系统: 新会话），结束时连同全部子进程一起结束，并确认进程确实已退出。
+    安装了psutil时会定期记录每个进程树的子进程，父进程先退出时也能结束遗留的子进程。
+    二分定位、预提交构建等后台线程也会登记进程，登记表的读写都持有锁。
+    """
+
+    def __init__(self, kill_timeout: float = 10):
+        """
+        Args:
+            kill_timeout: 等待进程树退出的最长时间（秒）
+        """
+        self.kill_timeout = kill_timeout
+        self.processes: Dict[str, subprocess.Popen] = {}
+        # 每个进程树已知的子进程PID
+        self.descendants: Dict[str, Set[int]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def group_options(creationflags: int = 0) -> Dict:
+        """Popen参数：在独立的进程组中启动"""
+        if os.name == 'nt':
+            return {'creationflags': creationflags | subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {'start_new_session': True}
+
+    def track(self, key: str, process: subprocess.Popen):
+        """开始监管进程"""
+        with self.lock:
+            self.processes[key] = process
+            self.descendants[key] = set()
+
+    def untrack(self, key: str):
+        """停止监管进程"""
+        with self.lock:
+            self.processes.pop(key, None)
+            self.descendants.pop(key, None)
+
+    def refresh(self):
+        """记录每个进程树当前的子进程（需要psutil）"""
+        if psutil is None:
+            return
+
+        with self.lock:
+            tracked = list(self.processes.items())
+        for key, process in tracked:
+            if process.poll() is not None:
+                continue
+            try:
+                pids = {child.pid for child in psutil.Process(process.pid).children(recursive=True)}
+            except psutil.Error:
+                continue
+            with self.lock:
+                # 查询期间可能已停止监管
+                known = self.descendants.get(key)
+                if known is not None:
+                    known.update(pids)
+
+    def live_descendants(self, key: str) -> Set[int]:
+        """已知子进程中仍在运行的PID"""
+        if psutil is None:
+            return set()
+
+        with self.lock:
+            pids = set(self.descendants.get(key, set()))
+        alive = set()
+        for pid in pids:
+            try:
+                if psutil.Process(pid).status() != psutil.STATUS_ZOMBIE:
+                    alive.add(pid)
+            except psutil.Error:
+                pass
+        return alive
+
+    def is_tree_alive(self, key: str) -> bool:
+        """进程树中是否还有进程在运行"""
+        with self.lock:
+            process = self.processes.get(key)
+        if process is None:
+            return False
+
+        if process.poll() is None:
+            return True
+
+        if os.name != 'nt':
+            try:
+                os.killpg(process.pid, 0)
+                return True
+            except (ProcessLookupError, PermissionError):
+                pass
+
+        return bool(self.live_descendants(key))
+
+    def kill_tree(self, key: str) -> bool:
+        """
+        结束进程及其全部子进程
+
+        Returns:
+            进程树是否已确认全部退出；确认后停止监管
+        """
+        with self.lock:
+            process = self.processes.get(key)
+        if process is None:
+            return True
+
+        self.refresh()
+
+        if os.name == 'nt':
+            if process.poll() is None:
+                subprocess.run(f'taskkill /T /F /PID {process.pid}', shell=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            try:
+                # 先礼后兵：SIGTERM 给进程组机会清理，超时后再 SIGKILL
+                os.killpg(process.pid, signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+        self.wait_tree(key, process, self.kill_timeout / 2)
+
+        if self.is_tree_alive(key):
+            if os.name != 'nt':
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+            elif process.poll() is None:
+                process.kill()
+
+            if psutil is not None:
+                for pid in self.live_descendants(key):
+                    try:
+                        psutil.Process(pid).kill()
+                    except psutil.Error:
+                        pass
+
+            self.wait_tree(key, process, self.kill_timeout / 2)
+
+        if self.is_tree_alive(key):
+            logger.error(f"进程树 {key} (PID: {process.pid}) 未能完全结束")
+            return False
+
+        self.untrack(key)
+        return True
+
+    def wait_tree(self, key: str, process: subprocess.Popen, timeout: float):
+        """等待进程树退出"""
+        deadline = time.time() + timeout
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return
+
+        while self.is_tree_alive(key) and time.time() < deadline:
+            time.sleep(0.1)
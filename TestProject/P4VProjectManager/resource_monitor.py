@@ -0,0 +1,306 @@
+import os
+import re
+import time
+import shutil
+import subprocess
+import logging
+from collections import deque
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional, Tuple
+
+try:
+    import psutil  # 可选依赖，未安装时在Linux上读取/proc
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger('P4VProjectManager')
+
+MB = 1024 * 1024
+
+
+@dataclass
+class ResourceLimits:
+    """资源限制配置"""
+    min_free_space: int = 0  # 同步后至少保留的磁盘空间（字节），0表示只要求放得下预估的同步大小
+    free_space_margin: float = 0.1  # 预估同步大小的额外余量比例
+    free_space_warning_interval: float = 600  # 因磁盘空间不足推迟同步时重复警告的间隔（秒）
+    disk_busy_rate: float = 100 * MB  # 磁盘读写超过该速率（字节/秒）视为繁忙
+    network_busy_rate: float = 50 * MB  # 网络收发超过该速率（字节/秒）视为繁忙
+    max_sync_defer: float = 1800  # 因主机繁忙推迟同步的最长时间（秒），磁盘空间不足不受此限制
+    sync_parallel_threads: int = 0  # p4 sync 并行传输线程数，0表示不指定
+    throttled_sync_threads: int = 1  # 主机繁忙时的并行传输线程数
+    sample_interval: float = 5  # 采样间隔（秒）
+    sample_window: int = 12  # 计算平均速率使用的样本数
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'ResourceLimits':
+        """从配置项(resource_limits)创建，大小以MB、速率以MB/s为单位"""
+        limits = cls()
+        if 'min_free_space_mb' in config:
+            limits.min_free_space = int(config['min_free_space_mb'] * MB)
+        if 'free_space_margin' in config:
+            limits.free_space_margin = float(config['free_space_margin'])
+        if 'free_space_warning_interval' in config:
+            limits.free_space_warning_interval = float(config['free_space_warning_interval'])
+        if 'disk_busy_mbps' in config:
+            limits.disk_busy_rate = float(config['disk_busy_mbps']) * MB
+        if 'network_busy_mbps' in config:
+            limits.network_busy_rate = float(config['network_busy_mbps']) * MB
+        if 'max_sync_defer' in config:
+            limits.max_sync_defer = float(config['max_sync_defer'])
+        if 'sync_parallel_threads' in config:
+            limits.sync_parallel_threads = int(config['sync_parallel_threads'])
+        if 'throttled_sync_threads' in config:
+            limits.throttled_sync_threads = int(config['throttled_sync_threads'])
+        if 'sample_interval' in config:
+            limits.sample_interval = float(config['sample_interval'])
+        if 'sample_window' in config:
+            limits.sample_window = max(2, int(config['sample_window']))
+        return limits
+
+
+@dataclass
+class SyncEstimate:
+    """同步预估（来自 p4 sync -N 或 p4 -ztag sync -n）"""
+    files_added: int = 0
+    files_updated: int = 0
+    files_deleted: int = 0
+    bytes_added: int = 0
+    bytes_updated: int = 0
+    # 同步计划 {"//depot/file#rev": 文件大小}，只有 -n 预览才有
+    files: Dict[str, int] = field(default_factory=dict)
+    # 需要写入本地的文件 {"//depot/file#rev": 本地路径}（不包括删除的文件），只有 -n 预览才有
+    client_files: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def total_files(self) -> int:
+        return self.files_added + self.files_updated + self.files_deleted
+
+    @property
+    def total_bytes(self) -> int:
+        return self.bytes_added + self.bytes_updated
+
+
+# 示例: Server network estimates: files added/updated/deleted=1/2/3, bytes added/updated=1000/2000
+SYNC_ESTIMATE_PATTERN = re.compile(
+    r'files added/updated/deleted=(\d+)/(\d+)/(\d+),\s*bytes added/updated=(\d+)/(\d+)')
+
+
+def parse_sync_estimate(output: str) -> Optional[SyncEstimate]:
+    """解析 p4 sync -N 的输出"""
+    match = SYNC_ESTIMATE_PATTERN.search(output)
+    if not match:
+        return None
+    return SyncEstimate(*(int(value) for value in match.groups()))
+
+
+def parse_sync_preview(output: str) -> SyncEstimate:
+    """
+    解析 p4 -ztag sync -n 的输出
+
+    每个文件是一组以空行分隔的 "... key value" 记录，包含 depotFile、clientFile、rev、action 和 fileSize
+    """
+    estimate = SyncEstimate()
+
+    def add_record(record: Dict[str, str]):
+        if 'depotFile' not in record or 'rev' not in record:
+            return
+        action = record.get('action', '')
+        size = int(record.get('fileSize', 0) or 0)
+        revision = f"{record['depotFile']}#{record['rev']}"
+        estimate.files[revision] = size
+        if action != 'deleted' and 'clientFile' in record:
+            estimate.client_files[revision] = record['clientFile']
+        if action == 'added':
+            estimate.files_added += 1
+            estimate.bytes_added += size
+        elif action == 'deleted':
+            estimate.files_deleted += 1
+        else:
+            estimate.files_updated += 1
+            estimate.bytes_updated += size
+
+    record: Dict[str, str] = {}
+    for line in output.splitlines():
+        if not line.startswith('... '):
+            if record:
+                add_record(record)
+                record = {}
+            continue
+        key, _, value = line[4:].partition(' ')
+        record[key] = value.strip()
+    if record:
+        add_record(record)
+
+    return estimate
+
+
+def preview_sync(command: str, cwd: Optional[str], with_plan: bool, timeout: float = 60,
+                 env: Optional[Dict[str, str]] = None) -> Optional[SyncEstimate]:
+    """
+    执行同步预估命令并解析输出（模块级函数，可以在工作进程中执行）
+
+    Args:
+        command: p4 -ztag sync -n（with_plan）或 p4 sync -N 命令
+        cwd: 工作目录
+        with_plan: 是否解析完整的同步计划
+        env: p4命令的环境变量（项目的服务器和工作区）
+    """
+    result = subprocess.run(command, shell=True, capture_output=True, text=True, cwd=cwd, env=env,
+                            timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    if with_plan:
+        return parse_sync_preview(result.stdout)
+    return parse_sync_estimate(result.stdout)
+
+
+class ResourceMonitor:
+    """
+    主机资源监控
+
+    定期采样磁盘读写和网络收发的累计计数，计算滑动窗口内的平均速率，
+    并据此决定同步是否可以开始、以及以多少并行线程开始。
+    """
+
+    def __init__(self, limits: ResourceLimits):
+        self.limits = limits
+        # (时间戳, 磁盘读, 磁盘写, 网络收, 网络发)
+        self.samples: Deque[Tuple[float, int, int, int, int]] = deque(maxlen=limits.sample_window)
+        self.last_sample_time = 0.0
+        self.counters_available = True
+
+    def read_counters(self) -> Optional[Tuple[int, int, int, int]]:
+        """读取磁盘和网络的累计字节数"""
+        if psutil is not None:
+            disk = psutil.disk_io_counters()
+            net = psutil.net_io_counters()
+            if disk is None or net is None:
+                return None
+            return disk.read_bytes, disk.write_bytes, net.bytes_recv, net.bytes_sent
+
+        if not os.path.exists('/proc/diskstats'):
+            return None
+
+        disk_read = disk_write = 0
+        with open('/proc/diskstats', 'r') as f:
+            for line in f:
+                fields = line.split()
+                # 只统计整块磁盘，跳过分区和虚拟设备，避免重复计数
+                if len(fields) < 10 or not os.path.exists(f'/sys/block/{fields[2]}/device'):
+                    continue
+                disk_read += int(fields[5]) * 512
+                disk_write += int(fields[9]) * 512
+
+        net_recv = net_sent = 0
+        with open('/proc/net/dev', 'r') as f:
+            for line in f.readlines()[2:]:
+                interface, data = line.split(':', 1)
+                if interface.strip() == 'lo':
+                    continue
+                fields = data.split()
+                net_recv += int(fields[0])
+                net_sent += int(fields[8])
+
+        return disk_read, disk_write, net_recv, net_sent
+
+    def sample(self):
+        """采样一次（调用频率高于采样间隔时直接返回）"""
+        now = time.time()
+        if not self.counters_available or now - self.last_sample_time < self.limits.sample_interval:
+            return
+        self.last_sample_time = now
+
+        try:
+            counters = self.read_counters()
+        except Exception as e:
+            logger.debug(f"读取资源计数失败: {e}")
+            counters = None
+
+        if counters is None:
+            logger.info("无法获取磁盘/网络计数，吞吐量监控已禁用（可安装psutil）")
+            self.counters_available = False
+            return
+
+        self.samples.append((now,) + counters)
+
+    def rates(self) -> Optional[Tuple[float, float, float, float]]:
+        """
+        计算滑动窗口内的平均速率
+
+        Returns:
+            (磁盘读, 磁盘写, 网络收, 网络发) 字节/秒，样本不足时返回None
+        """
+        if len(self.samples) < 2:
+            return None
+
+        first, last = self.samples[0], self.samples[-1]
+        elapsed = last[0] - first[0]
+        if elapsed <= 0:
+            return None
+        return tuple(max(0, last[i] - first[i]) / elapsed for i in range(1, 5))
+
+    def disk_rate(self) -> Optional[float]:
+        """磁盘读写总速率（字节/秒）"""
+        rates = self.rates()
+        return rates[0] + rates[1] if rates else None
+
+    def network_rate(self) -> Optional[float]:
+        """网络收发总速率（字节/秒）"""
+        rates = self.rates()
+        return rates[2] + rates[3] if rates else None
+
+    def is_busy(self) -> bool:
+        """主机磁盘或网络是否繁忙"""
+        disk_rate = self.disk_rate()
+        network_rate = self.network_rate()
+        return ((disk_rate is not None and disk_rate >= self.limits.disk_busy_rate) or
+                (network_rate is not None and network_rate >= self.limits.network_busy_rate))
+
+    @staticmethod
+    def free_space(path: str) -> Optional[int]:
+        """获取路径所在磁盘的剩余空间（路径不存在时向上查找已存在的父目录）"""
+        if not path:
+            return None
+
+        path_obj = Path(path)
+        while not path_obj.exists() and path_obj.parent != path_obj:
+            path_obj = path_obj.parent
+
+        try:
+            return shutil.disk_usage(str(path_obj)).free
+        except OSError:
+            return None
+
+    def check_free_space(self, path: str, estimated_bytes: int) -> Tuple[bool, str]:
+        """
+        检查同步后是否还能保留足够的磁盘空间
+
+        Returns:
+            (是否足够, 说明)
+        """
+        free = self.free_space(path)
+        if free is None:
+            return True, ""
+
+        required = int(estimated_bytes * (1 + self.limits.free_space_margin)) + self.limits.min_free_space
+        if free < required:
+            return False, f"磁盘空间不足 (剩余 {free / MB:.0f}MB, 需要 {required / MB:.0f}MB)"
+        return True, ""
+
+    def sync_threads(self, builds_running: int) -> int:
+        """根据主机负载决定同步的并行传输线程数"""
+        if not self.limits.sync_parallel_threads:
+            return 0
+        if builds_running or self.is_busy():
+            return min(self.limits.throttled_sync_threads, self.limits.sync_parallel_threads)
+        return self.limits.sync_parallel_threads
+
+    def describe(self) -> str:
+        """当前负载的文字描述"""
+        rates = self.rates()
+        if not rates:
+            return ""
+        return (f"磁盘 读{rates[0] / MB:.1f}/写{rates[1] / MB:.1f} MB/s, "
+                f"网络 收{rates[2] / MB:.1f}/发{rates[3] / MB:.1f} MB/s")
@@ -0,0 +1,154 @@
+import time
+import random
+import logging
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('P4VProjectManager')
+
+
+@dataclass
+class RetryPolicy:
+    """同步重试策略（指数退避 + 随机抖动）"""
+    max_retries: int = 5  # 连续失败达到该次数后进入冷却
+    base_delay: float = 30  # 第一次重试的等待时间（秒）
+    max_delay: float = 1800  # 最长等待时间（秒），也是冷却时间
+    jitter: float = 0.2  # 随机抖动比例，避免多个项目同时重试
+    resume: bool = True  # 是否只续传未完成的文件
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'RetryPolicy':
+        """从配置项(sync_retry)创建"""
+        policy = cls()
+        for key in ('max_retries', 'base_delay', 'max_delay', 'jitter', 'resume'):
+            if key not in config:
+                continue
+            default = getattr(policy, key)
+            if isinstance(default, bool):
+                # bool("false") 为True，开关只接受JSON的true/false
+                if not isinstance(config[key], bool):
+                    raise ValueError(f"sync_retry.{key}必须是true或false: {config[key]!r}")
+                setattr(policy, key, config[key])
+            else:
+                setattr(policy, key, type(default)(config[key]))
+        return policy
+
+    def delay(self, failures: int) -> float:
+        """第 failures 次失败后的等待时间"""
+        delay = min(self.base_delay * (2 ** max(failures - 1, 0)), self.max_delay)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+@dataclass
+class SyncFailureState:
+    """项目的同步失败状态"""
+    version: str = ""
+    failures: int = 0
+    next_attempt_time: float = 0
+    last_error: str = ""
+    # 尚未完成的文件 {"//depot/file#rev": 文件大小}，None表示没有可续传的计划
+    remaining_files: Optional[Dict[str, int]] = None
+
+
+class SyncRetryManager:
+    """
+    同步重试管理
+
+    记录每个项目的连续失败次数和下一次允许重试的时间；
+    失败时保存同步计划中尚未完成的文件，重试时只同步这些文件，避免重新比对整个目录树。
+    """
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.states: Dict[str, SyncFailureState] = {}
+
+    def is_ready(self, project_name: str, now: Optional[float] = None) -> bool:
+        """项目是否已过退避等待时间"""
+        state = self.states.get(project_name)
+        if state is None:
+            return True
+        return (now or time.time()) >= state.next_attempt_time
+
+    def resume_plan(self, project_name: str, version: str) -> Optional[Dict[str, int]]:
+        """获取可续传的剩余文件（版本必须一致）"""
+        if not self.policy.resume:
+            return None
+        state = self.states.get(project_name)
+        if state is None or state.version != version or not state.remaining_files:
+            return None
+        return state.remaining_files
+
+    def record_failure(self, project_name: str, version: str, error: str,
+                       planned_files: Optional[Dict[str, int]] = None,
+                       completed_files: Optional[set] = None) -> Optional[float]:
+        """
+        记录一次同步失败
+
+        Args:
+            project_name: 项目名称
+            version: 同步的目标版本
+            error: 失败原因
+            planned_files: 本次同步计划的文件 {"//depot/file#rev": 文件大小}
+            completed_files: 本次已完成的文件
+
+        Returns:
+            下一次重试前的等待时间（秒）；连续失败次数用尽时返回None（进入冷却）
+        """
+        state = self.get_state(project_name, version)
+        state.failures += 1
+        state.last_error = error
+        self.save_remaining(state, planned_files, completed_files)
+
+        if state.failures > self.policy.max_retries:
+            # 冷却：清零失败次数，保留剩余文件以便之后继续续传
+            state.failures = 0
+            state.next_attempt_time = time.time() + self.policy.max_delay
+            return None
+
+        delay = self.policy.delay(state.failures)
+        state.next_attempt_time = time.time() + delay
+        return delay
+
+    def record_interruption(self, project_name: str, version: str,
+                            planned_files: Optional[Dict[str, int]] = None,
+                            completed_files: Optional[set] = None):
+        """
+        记录一次被中断（抢占）的同步：保存未完成的文件以便续传，不计入失败次数，也不需要等待
+        """
+        state = self.get_state(project_name, version)
+        self.save_remaining(state, planned_files, completed_files)
+
+    def get_state(self, project_name: str, version: str) -> SyncFailureState:
+        """获取项目的状态（目标版本变化时重新开始）"""
+        state = self.states.get(project_name)
+        if state is None or state.version != version:
+            state = SyncFailureState(version=version)
+            self.states[project_name] = state
+        return state
+
+    @staticmethod
+    def save_remaining(state: SyncFailureState, planned_files: Optional[Dict[str, int]],
+                       completed_files: Optional[set]):
+        """保存同步计划中尚未完成的文件"""
+        if planned_files is None:
+            return
+        completed_files = completed_files or set()
+        state.remaining_files = {name: size for name, size in planned_files.items()
+                                 if name not in completed_files}
+
+    def record_success(self, project_name: str):
+        """同步成功，清除失败状态"""
+        self.states.pop(project_name, None)
+
+    def failures(self, project_name: str) -> int:
+        """当前连续失败次数"""
+        state = self.states.get(project_name)
+        return state.failures if state else 0
+
+    @staticmethod
+    def write_file_list(list_file: Path, files: List[str]):
+        """写入 p4 -x 使用的文件列表"""
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for name in files:
+                f.write(name + '\n')
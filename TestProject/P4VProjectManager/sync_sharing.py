@@ -0,0 +1,186 @@
+import os
+import stat
+import shutil
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+SHARE_MODES = ('copy', 'hardlink', 'shared')
+
+
+def normalize_depot_path(depot_path: str) -> Optional[str]:
+    """
+    把depot路径规范为目录前缀，如 "//depot/main/..." -> "//depot/main/"
+
+    Returns:
+        目录前缀；路径不是 "目录/..." 形式（如包含其他通配符）时返回None，不参与共享
+    """
+    if not depot_path or not depot_path.startswith('//') or not depot_path.endswith('/...'):
+        return None
+    prefix = depot_path[:-3]
+    if any(wildcard in prefix for wildcard in ('...', '*', '%%', '@', '#')):
+        return None
+    return prefix
+
+
+def depot_relative(depot_file: str, prefix: str) -> Optional[str]:
+    """depot文件相对于目录前缀的路径（去掉 #版本），不在该目录下时返回None"""
+    depot_file = depot_file.split('#', 1)[0]
+    if not depot_file.startswith(prefix):
+        return None
+    return depot_file[len(prefix):]
+
+
+@dataclass
+class SyncGroup:
+    """
+    共享同步的项目组
+
+    主项目(leader)的depot路径包含组内其他项目(follower)的路径，
+    只有主项目真正从服务器同步，同步结果再分发给其他项目。
+    """
+    leader: str
+    prefix: str  # 主项目的depot目录前缀
+    # {follower项目: (depot目录前缀, 相对主项目目录的子路径)}
+    followers: Dict[str, Tuple[str, str]] = field(default_factory=dict)
+
+
+def find_sync_groups(projects: Dict[str, Dict]) -> Dict[str, SyncGroup]:
+    """
+    检测depot路径相同或嵌套的项目，按主项目分组
+
+    路径最短（同样长时配置中靠前）的项目作为主项目；设置了 "share_sync": false 的项目不参与。
+
+    Returns:
+        {主项目: SyncGroup}，只包含至少有一个follower的组
+    """
+    candidates = []
+    for index, (name, config) in enumerate(projects.items()):
+        if not config.get('share_sync', True):
+            continue
+        prefix = normalize_depot_path(config.get('depot_path', ''))
+        if prefix:
+            candidates.append((len(prefix), index, name, prefix))
+
+    groups: List[SyncGroup] = []
+    for _, _, name, prefix in sorted(candidates):
+        for group in groups:
+            if prefix.startswith(group.prefix):
+                group.followers[name] = (prefix, prefix[len(group.prefix):])
+                break
+        else:
+            groups.append(SyncGroup(leader=name, prefix=prefix))
+
+    return {group.leader: group for group in groups if group.followers}
+
+
+class WorkspaceFanout:
+    """
+    把主项目工作区中的文件分发到其他项目的工作区
+
+    copy: 复制文件，各工作区互不影响；
+    hardlink: 硬链接（跨磁盘或不支持时退回复制），不占用额外空间。p4同步时会替换文件而不是原地修改，
+    已有的硬链接仍指向旧内容；但 p4 edit 后的原地写入、构建脚本修改已同步的文件或改变文件属性，
+    会同时改变主项目和所有follower中的同一个文件，只适合不会修改已同步文件的工作区。
+    """
+
+    def __init__(self, mode: str = 'copy'):
+        self.mode = mode
+
+    def place_file(self, source: Path, target: Path) -> int:
+        """
+        把单个文件放到目标位置（先写临时文件再替换）
+
+        Returns:
+            复制的字节数（硬链接为0）
+        """
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(target.name + '.fanout.tmp')
+        if temp.exists():
+            temp.unlink()
+        # p4同步的文件通常是只读的，Windows上无法直接替换只读文件
+        self.make_writable(target)
+
+        if self.mode == 'hardlink':
+            try:
+                os.link(source, temp)
+                os.replace(temp, target)
+                return 0
+            except OSError:
+                pass  # 跨磁盘或文件系统不支持，改为复制
+
+        shutil.copy2(source, temp)
+        os.replace(temp, target)
+        return source.stat().st_size
+
+    @staticmethod
+    def make_writable(path: Path):
+        """
+        去掉文件的只读属性，以便替换或删除（只在Windows上需要）
+
+        其他系统上替换和删除不需要文件的写权限，不修改属性，避免通过硬链接影响其他工作区中的同一个文件
+        """
+        if os.name == 'nt' and path.exists() and not os.access(path, os.W_OK):
+            os.chmod(path, path.stat().st_mode | stat.S_IWRITE)
+
+    @staticmethod
+    def same_file(source: Path, target: Path) -> bool:
+        """目标是否已经与源文件相同（同一硬链接，或大小和修改时间一致）"""
+        try:
+            source_stat = source.stat()
+            target_stat = target.stat()
+        except OSError:
+            return False
+        if (source_stat.st_dev, source_stat.st_ino) == (target_stat.st_dev, target_stat.st_ino):
+            return True
+        return (source_stat.st_size == target_stat.st_size and
+                source_stat.st_mtime_ns == target_stat.st_mtime_ns)
+
+    def fan_out_files(self, source_root: Path, target_root: Path, relative_paths: Iterable[str],
+                      cancelled: Optional[threading.Event] = None) -> Tuple[int, int, int]:
+        """
+        只分发列出的文件；主项目中已不存在的文件（被删除）在目标中也删除
+
+        Args:
+            cancelled: 设置后在下一个文件之前停止
+
+        Returns:
+            (更新的文件数, 删除的文件数, 复制的字节数)
+        """
+        updated = deleted = copied = 0
+        for relative in relative_paths:
+            if cancelled is not None and cancelled.is_set():
+                break
+            source = source_root / relative
+            target = target_root / relative
+            if source.is_file():
+                if not self.same_file(source, target):
+                    copied += self.place_file(source, target)
+                    updated += 1
+            elif target.is_file():
+                self.make_writable(target)
+                target.unlink()
+                deleted += 1
+        return updated, deleted, copied
+
+    def mirror(self, source_root: Path, target_root: Path) -> Tuple[int, int, int]:
+        """
+        没有同步文件列表时分发整个目录（跳过已相同的文件，不删除目标中多出的文件）
+
+        Returns:
+            (更新的文件数, 删除的文件数, 复制的字节数)
+        """
+        updated = copied = 0
+        for directory, _, files in os.walk(source_root):
+            relative_dir = Path(directory).relative_to(source_root)
+            for name in files:
+                source = Path(directory) / name
+                target = target_root / relative_dir / name
+                if not self.same_file(source, target):
+                    copied += self.place_file(source, target)
+                    updated += 1
+        return updated, 0, copied
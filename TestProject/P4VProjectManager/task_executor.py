@@ -0,0 +1,218 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+POOLS = ('cpu', 'io')
+
+
+class ExecutorBusy(Exception):
+    """执行器队列已满（非阻塞提交时）"""
+
+
+class TaskFuture(Future):
+    """任务结果；取消时同时取消池中的任务，已开始执行的任务不能取消（返回False）"""
+
+    def __init__(self):
+        super().__init__()
+        self.inner: Optional[Future] = None
+
+    def cancel(self) -> bool:
+        if self.inner is not None and not self.inner.cancel():
+            return False
+        return super().cancel()
+
+
+def timed_call(fn: Callable, args: Tuple, kwargs: Dict) -> Tuple[float, float, Any]:
+    """在工作线程/进程中执行任务并记录开始和结束时间（模块级函数，可以传给进程池）"""
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return start, time.time(), result
+
+
+def percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class TaskStats:
+    """某类任务的统计"""
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    rejected: int = 0  # 队列已满被拒绝
+    in_flight: int = 0  # 已提交尚未完成（排队+执行中）
+    wait_times: Deque[float] = field(default_factory=lambda: deque(maxlen=200))  # 排队时间
+    run_times: Deque[float] = field(default_factory=lambda: deque(maxlen=200))  # 执行时间
+
+    def to_dict(self) -> Dict:
+        latencies = [wait + run for wait, run in zip(self.wait_times, self.run_times)]
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'in_flight': self.in_flight,
+            'wait_p50': percentile(self.wait_times, 0.5),
+            'run_p50': percentile(self.run_times, 0.5),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95)
+        }
+
+
+class TaskExecutor:
+    """
+    后台任务执行器
+
+    cpu: 解析、哈希等CPU密集的任务，在进程池中执行，不与主循环争用GIL（不可用或关闭时退回线程池）；
+    io: 压缩、文件复制等主要等待I/O的任务，在线程池中执行。
+    每个池的排队+执行中的任务数有上限：阻塞提交时等待空位（反压），非阻塞提交时抛出 ExecutorBusy，
+    主循环中只使用非阻塞提交，队列满时推迟到下个周期。按任务类型统计排队时间、执行时间和队列深度。
+    """
+
+    def __init__(self, cpu_workers: int = 0, io_workers: int = 4, max_queue: int = 64,
+                 use_processes: bool = True):
+        """
+        Args:
+            cpu_workers: CPU任务的工作进程数，0表示CPU核数-1
+            io_workers: I/O任务的工作线程数
+            max_queue: 每个池排队+执行中的任务数上限
+            use_processes: CPU任务是否使用进程池
+        """
+        self.cpu_workers = cpu_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.pools: Dict[str, Any] = {'io': ThreadPoolExecutor(io_workers, thread_name_prefix='io')}
+        self.cpu_processes = False
+        if use_processes:
+            try:
+                self.pools['cpu'] = self.new_process_pool()
+                self.cpu_processes = True
+            except (OSError, NotImplementedError, ImportError) as e:
+                logger.warning(f"无法创建进程池，CPU任务改为在线程中执行: {e}")
+        if 'cpu' not in self.pools:
+            self.pools['cpu'] = ThreadPoolExecutor(self.cpu_workers, thread_name_prefix='cpu')
+
+        self.max_queue = max_queue
+        self.slots = {pool: threading.BoundedSemaphore(max_queue) for pool in POOLS}
+        self.depth = {pool: 0 for pool in POOLS}  # 排队+执行中的任务数
+        self.stats: Dict[str, TaskStats] = {}
+        self.lock = threading.Lock()
+
+    def new_process_pool(self) -> ProcessPoolExecutor:
+        """创建CPU任务的进程池（统一使用spawn：主进程中已有控制接口、构建代理等线程，fork可能复制被持有的锁）"""
+        return ProcessPoolExecutor(self.cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, pool: str, task_type: str, fn: Callable, *args,
+               block: bool = True, timeout: Optional[float] = None, **kwargs) -> Future:
+        """
+        提交任务
+
+        Args:
+            pool: 'cpu' 或 'io'；cpu任务的函数和参数需要可以pickle（模块级函数）
+            task_type: 任务类型（用于统计）
+            block: 队列已满时是否等待
+            timeout: 等待空位的最长时间（秒）
+
+        Returns:
+            任务结果的Future
+
+        Raises:
+            ExecutorBusy: 队列已满
+        """
+        with self.lock:
+            stats = self.stats.setdefault(task_type, TaskStats())
+        if not self.slots[pool].acquire(blocking=block, timeout=timeout if block else None):
+            with self.lock:
+                stats.rejected += 1
+            raise ExecutorBusy(f"{pool} 队列已满 ({self.max_queue})")
+
+        submitted_at = time.time()
+        with self.lock:
+            stats.submitted += 1
+            stats.in_flight += 1
+            self.depth[pool] += 1
+
+        outer = TaskFuture()
+
+        def release():
+            self.slots[pool].release()
+            with self.lock:
+                stats.in_flight -= 1
+                self.depth[pool] -= 1
+
+        def on_done(inner: Future):
+            release()
+            if inner.cancelled():
+                outer.cancel()
+                return
+            error = inner.exception()
+            with self.lock:
+                if error is None:
+                    start, end, result = inner.result()
+                    stats.completed += 1
+                    stats.wait_times.append(max(0.0, start - submitted_at))
+                    stats.run_times.append(end - start)
+                else:
+                    stats.failed += 1
+            if error is None:
+                outer.set_result(result)
+            else:
+                outer.set_exception(error)
+
+        try:
+            try:
+                inner = self.pools[pool].submit(timed_call, fn, args, kwargs)
+            except BrokenProcessPool:
+                # 工作进程异常退出（如被系统结束）后进程池不可再用，重新创建
+                logger.warning("CPU任务进程池已损坏，重新创建")
+                self.pools[pool] = self.new_process_pool()
+                inner = self.pools[pool].submit(timed_call, fn, args, kwargs)
+        except Exception:
+            release()
+            with self.lock:
+                stats.failed += 1
+            raise
+        outer.inner = inner
+        inner.add_done_callback(on_done)
+        return outer
+
+    def snapshot(self) -> Dict:
+        """统计信息（可以JSON序列化）"""
+        with self.lock:
+            return {
+                'cpu_processes': self.cpu_processes,
+                'max_queue': self.max_queue,
+                'queue_depth': dict(self.depth),
+                'tasks': {task_type: stats.to_dict() for task_type, stats in self.stats.items()}
+            }
+
+    def describe(self) -> List[str]:
+        """每类任务的文字描述"""
+        descriptions = []
+        for task_type, stats in self.snapshot()['tasks'].items():
+            parts = [f"{task_type} {stats['completed']}/{stats['submitted']}"]
+            for key, label in (('in_flight', '进行中'), ('failed', '失败'), ('rejected', '拒绝')):
+                if stats[key]:
+                    parts.append(f"{label} {stats[key]}")
+            if stats['latency_p50'] is not None:
+                parts.append(f"p50 {stats['latency_p50']:.2f}秒")
+            descriptions.append(' '.join(parts))
+        return descriptions
+
+    def shutdown(self):
+        """停止执行器，取消尚未开始的任务"""
+        for executor in self.pools.values():
+            try:
+                executor.shutdown(wait=False, cancel_futures=True)
+            except TypeError:  # Python 3.8 不支持 cancel_futures
+                executor.shutdown(wait=False)
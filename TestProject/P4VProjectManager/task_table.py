@@ -0,0 +1,140 @@
+import heapq
+from enum import Enum
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+
+class ProjectStatus(Enum):
+    """项目状态枚举"""
+    IDLE = "idle"  # 空闲
+    PENDING_SYNC = "pending_sync"  # 等待同步
+    SYNCING = "syncing"  # 正在同步
+    PENDING_BUILD = "pending_build"  # 等待构建
+    BUILDING = "building"  # 正在构建
+    BISECTING = "bisecting"  # 构建失败后正在二分定位
+    VERIFYING = "verifying"  # 正在校验/修复工作区
+    PUBLISHING = "publishing"  # 构建成功后正在发布产物
+    COMPLETED = "completed"  # 完成
+    FAILED = "failed"  # 失败
+
+
+class ProjectTask:
+    """
+    项目任务信息
+
+    使用 __slots__ 减少大量项目时的内存占用；状态通过属性修改，
+    加入任务表后每次状态变化都会通知任务表更新按状态的索引。
+    """
+    __slots__ = ('project_name', 'depot_path', 'local_path', 'version', '_status',
+                 'sync_start_time', 'build_start_time', 'last_update_time', '_table')
+
+    def __init__(self, project_name: str, depot_path: str, local_path: str, version: str,
+                 status: ProjectStatus = ProjectStatus.IDLE, sync_start_time: float = 0,
+                 build_start_time: float = 0, last_update_time: float = 0):
+        self.project_name = project_name
+        self.depot_path = depot_path
+        self.local_path = local_path
+        self.version = version
+        self._status = status
+        self.sync_start_time = sync_start_time
+        self.build_start_time = build_start_time
+        self.last_update_time = last_update_time
+        self._table: Optional['TaskTable'] = None
+
+    @property
+    def status(self) -> ProjectStatus:
+        return self._status
+
+    @status.setter
+    def status(self, value: ProjectStatus):
+        old = self._status
+        if old is value:
+            return
+        self._status = value
+        if self._table is not None:
+            self._table.on_status_change(self, old, value)
+
+    def __repr__(self):
+        return (f"ProjectTask(project_name={self.project_name!r}, version={self.version!r}, "
+                f"status={self._status})")
+
+
+class TaskTable(Mapping):
+    """
+    任务表
+
+    除了按名称查找，还为每个状态维护一个按进入该状态先后排序的索引（dict作为有序集合），
+    调度时只需访问处于特定状态的项目，而不必扫描全部项目；
+    同时记录自上次取出以来状态发生变化的项目，以及每个项目下一次检查更新的时间（最小堆）。
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, ProjectTask] = {}
+        self.status_index: Dict[ProjectStatus, Dict[str, None]] = {status: {} for status in ProjectStatus}
+        self.changed: Dict[str, None] = {}
+        self.poll_heap: List[Tuple[float, str]] = []
+
+    def __getitem__(self, project_name: str) -> ProjectTask:
+        return self.tasks[project_name]
+
+    def __setitem__(self, project_name: str, task: ProjectTask):
+        self.add(task)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tasks)
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    def __contains__(self, project_name) -> bool:
+        return project_name in self.tasks
+
+    def add(self, task: ProjectTask):
+        """加入任务（同名任务会被替换）"""
+        old = self.tasks.get(task.project_name)
+        if old is not None:
+            self.status_index[old.status].pop(old.project_name, None)
+            old._table = None
+
+        task._table = self
+        self.tasks[task.project_name] = task
+        self.status_index[task.status][task.project_name] = None
+        self.changed[task.project_name] = None
+
+    def on_status_change(self, task: ProjectTask, old: ProjectStatus, new: ProjectStatus):
+        """任务状态变化时更新索引"""
+        self.status_index[old].pop(task.project_name, None)
+        self.status_index[new][task.project_name] = None
+        self.changed[task.project_name] = None
+
+    def mark_changed(self, project_name: str):
+        """记录状态以外的变化（如暂停、优先级调整），与状态变化一样在下次取出时返回"""
+        self.changed[project_name] = None
+
+    def with_status(self, status: ProjectStatus) -> List[str]:
+        """处于某状态的项目（按进入该状态的先后）"""
+        return list(self.status_index[status])
+
+    def count(self, status: ProjectStatus) -> int:
+        """处于某状态的项目数"""
+        return len(self.status_index[status])
+
+    def drain_changed(self) -> List[str]:
+        """取出并清空自上次取出以来状态变化的项目"""
+        changed = list(self.changed)
+        self.changed.clear()
+        return changed
+
+    def schedule_poll(self, project_name: str, due_time: float):
+        """安排项目下一次检查更新的时间"""
+        heapq.heappush(self.poll_heap, (due_time, project_name))
+
+    def pop_due(self, now: float) -> List[str]:
+        """取出所有已到检查时间的项目"""
+        due = []
+        while self.poll_heap and self.poll_heap[0][0] <= now:
+            due.append(heapq.heappop(self.poll_heap)[1])
+        return due
+
+    def next_due_time(self) -> Optional[float]:
+        """最近一次检查更新的时间"""
+        return self.poll_heap[0][0] if self.poll_heap else None
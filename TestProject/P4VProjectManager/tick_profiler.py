@@ -0,0 +1,271 @@
+import os
+import sys
+import time
+import pstats
+import signal
+import logging
+import cProfile
+import threading
+import functools
+from pathlib import Path
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 直方图的桶上限（毫秒）
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+CAPTURE_MODES = ('cprofile', 'sample')
+NULL_PHASE = nullcontext()
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class TickProfiler:
+    """
+    主循环性能分析
+
+    阶段计时（需要启用）：记录每个周期中各阶段和外部调用（p4命令、状态文件读取、进程启动等）的耗时，
+    每类保留最近 window 个样本，报告分位数和直方图；周期超过 slow_tick_ms 时输出该周期各阶段的耗时。
+    未启用时 phase() 返回共用的空上下文，timed 装饰的函数只多一次属性判断。
+
+    按需采集（无论是否启用阶段计时）：通过信号或控制接口请求，
+    cprofile 在主循环线程中启用cProfile，sample 在后台线程中定期采样主循环线程的调用栈，
+    持续 seconds 秒后写入 dir 目录（.prof/.txt 或 .folded，可用flamegraph等工具查看）。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = 1000
+        self.slow_tick = 1.0
+        self.report_interval = 300.0
+        self.output_dir = Path('profiles')
+        self.sample_interval = 0.005
+        self.samples: Dict[str, Deque[float]] = {}
+        self.totals: Dict[str, int] = {}  # 每类的累计次数
+        self.tick_phases: Dict[str, float] = {}  # 当前周期中各阶段的耗时
+        self.tick_start = 0.0
+        self.last_report = time.time()
+        self.loop_thread: Optional[int] = None
+        self.lock = threading.Lock()
+        # 按需采集
+        self.pending_capture: Optional[Tuple[str, float]] = None
+        self.capture_mode: Optional[str] = None
+        self.capture_deadline = 0.0
+        self.cprofile: Optional[cProfile.Profile] = None
+
+    def configure(self, config: Dict, default_dir: Path):
+        """
+        Args:
+            config: profiling 配置
+            default_dir: 未配置 dir 时的输出目录
+        """
+        self.enabled = config.get('enabled', False)
+        self.window = config.get('window', 1000)
+        self.slow_tick = config.get('slow_tick_ms', 1000) / 1000
+        self.report_interval = config.get('report_interval', 300)
+        self.output_dir = Path(config.get('dir', str(default_dir)))
+        self.sample_interval = config.get('sample_interval_ms', 5) / 1000
+
+    def install_signal_handlers(self, seconds: float = 30):
+        """SIGUSR1 采集cProfile，SIGUSR2 采样调用栈（Windows没有这两个信号，使用控制接口）"""
+        handlers = (('SIGUSR1', 'cprofile'), ('SIGUSR2', 'sample'))
+        for signal_name, mode in handlers:
+            signum = getattr(signal, signal_name, None)
+            if signum is None:
+                continue
+            try:
+                signal.signal(signum, lambda *_, mode=mode: self.request_capture(mode, seconds))
+            except ValueError:
+                return  # 不在主线程中
+
+    # ---------- 阶段计时 ----------
+
+    def phase(self, name: str):
+        """计时一个阶段（with profiler.phase('name'): ...）"""
+        if not self.enabled:
+            return NULL_PHASE
+        return self._timed_phase(name)
+
+    @contextmanager
+    def _timed_phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, elapsed: float):
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(elapsed)
+            self.totals[name] = self.totals.get(name, 0) + 1
+            if threading.get_ident() == self.loop_thread:
+                self.tick_phases[name] = self.tick_phases.get(name, 0.0) + elapsed
+
+    def begin_tick(self):
+        """主循环每个周期开始时调用"""
+        self.loop_thread = threading.get_ident()
+        if self.pending_capture:
+            self.start_capture(*self.pending_capture)
+        if self.enabled:
+            self.tick_phases = {}
+            self.tick_start = time.perf_counter()
+
+    def end_tick(self):
+        """主循环每个周期结束时调用（等待下一个周期之前）"""
+        if self.capture_mode == 'cprofile' and time.time() >= self.capture_deadline:
+            self.finish_cprofile()
+        if not self.enabled:
+            return
+
+        elapsed = time.perf_counter() - self.tick_start
+        self.record('tick', elapsed)
+        self.tick_phases.pop('tick', None)
+        if elapsed >= self.slow_tick:
+            phases = sorted(self.tick_phases.items(), key=lambda item: -item[1])
+            breakdown = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in phases[:8])
+            logger.warning(f"主循环周期耗时 {elapsed * 1000:.0f}ms: {breakdown}")
+
+        if self.report_interval and time.time() - self.last_report >= self.report_interval:
+            self.last_report = time.time()
+            self.log_report()
+
+    def report(self) -> Dict[str, Dict]:
+        """各阶段最近样本的统计（毫秒，可以JSON序列化）"""
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            totals = dict(self.totals)
+
+        report = {}
+        for name, ordered in samples.items():
+            histogram = {}
+            index = 0
+            for bound in BUCKETS_MS:
+                count = 0
+                while index < len(ordered) and ordered[index] * 1000 <= bound:
+                    count += 1
+                    index += 1
+                histogram[f"<={bound}ms"] = count
+            histogram[f">{BUCKETS_MS[-1]}ms"] = len(ordered) - index
+            report[name] = {
+                'count': totals.get(name, 0),
+                'window': len(ordered),
+                'total_ms': sum(ordered) * 1000,
+                'p50_ms': percentile(ordered, 0.5) * 1000,
+                'p95_ms': percentile(ordered, 0.95) * 1000,
+                'p99_ms': percentile(ordered, 0.99) * 1000,
+                'max_ms': ordered[-1] * 1000,
+                'histogram': histogram
+            }
+        return report
+
+    def log_report(self):
+        """输出耗时最多的阶段"""
+        report = self.report()
+        if not report:
+            return
+        logger.info(f"主循环耗时统计 (最近 {self.window} 个样本):")
+        for name, stats in sorted(report.items(), key=lambda item: -item[1]['total_ms'])[:15]:
+            logger.info(f"  {name:<32} 次数 {stats['count']:>7}  合计 {stats['total_ms']:>9.1f}ms  "
+                        f"p50 {stats['p50_ms']:>7.2f}ms  p95 {stats['p95_ms']:>7.2f}ms  "
+                        f"最大 {stats['max_ms']:>8.2f}ms")
+
+    # ---------- 按需采集 ----------
+
+    def request_capture(self, mode: str, seconds: float) -> Tuple[bool, str]:
+        """请求采集（可以在任意线程或信号处理中调用）"""
+        if mode not in CAPTURE_MODES:
+            return False, f"未知的采集方式: {mode}"
+        if self.capture_mode or self.pending_capture:
+            return False, f"正在采集 ({self.capture_mode or self.pending_capture[0]})"
+        if mode == 'sample':
+            # 采样在后台线程中进行，可以立即开始
+            self.start_capture(mode, seconds)
+        else:
+            # cProfile只能分析启用它的线程，在主循环的下一个周期开始时启用
+            self.pending_capture = (mode, seconds)
+        return True, f"开始采集 {mode}，持续 {seconds} 秒，输出到 {self.output_dir}"
+
+    def capture_path(self, mode: str, suffix: str) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        return self.output_dir / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{mode}{suffix}"
+
+    def start_capture(self, mode: str, seconds: float):
+        self.pending_capture = None
+        self.capture_mode = mode
+        self.capture_deadline = time.time() + seconds
+        logger.info(f"开始性能采集 ({mode}, {seconds} 秒)")
+        if mode == 'cprofile':
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        else:
+            thread_id = self.loop_thread or threading.main_thread().ident
+            threading.Thread(target=self.sample_stacks, args=(thread_id,), daemon=True).start()
+
+    def finish_cprofile(self):
+        self.cprofile.disable()
+        path = self.capture_path('cprofile', '.prof')
+        self.cprofile.dump_stats(str(path))
+        summary = path.with_suffix('.txt')
+        with open(summary, 'w', encoding='utf-8') as f:
+            pstats.Stats(self.cprofile, stream=f).sort_stats('cumulative').print_stats(50)
+        self.cprofile = None
+        self.capture_mode = None
+        logger.info(f"cProfile采集完成: {path} (摘要: {summary.name})")
+
+    def sample_stacks(self, thread_id: int):
+        """定期采样主循环线程的调用栈，按折叠格式（调用栈;... 次数）保存"""
+        stacks: Counter = Counter()
+        while time.time() < self.capture_deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+        path = self.capture_path('sample', '.folded')
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.capture_mode = None
+
+        leaves: Counter = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(stacks.values()) or 1
+        logger.info(f"调用栈采样完成: {path} ({total} 个样本)")
+        for leaf, count in leaves.most_common(5):
+            logger.info(f"  {count * 100 / total:5.1f}%  {leaf}")
+
+
+# 全局实例：timed 装饰器在定义类时就需要引用它
+PROFILER = TickProfiler()
+
+
+def timed(name: str) -> Callable:
+    """计时函数调用的装饰器（未启用时直接调用）"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                PROFILER.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
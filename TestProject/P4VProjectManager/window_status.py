@@ -0,0 +1,86 @@
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger('P4VProjectManager')
+
+# 记录中的状态
+IDLE = "IDLE"
+RUNNING = "RUNNING"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+STATES = (IDLE, RUNNING, COMPLETED, FAILED)
+
+# 单条记录的最大长度（序号、状态、错误码和脚本名）
+MAX_RECORD_SIZE = 1024
+
+
+@dataclass(frozen=True)
+class StatusRecord:
+    """监控窗口写入的一条状态记录"""
+    seq: int  # 窗口进程内单调递增的序号
+    state: str
+    code: int = 0  # 失败脚本的错误码
+    script: str = ""  # 正在执行的脚本，或第一个失败的脚本
+
+
+# 窗口刚启动、还没有写入任何记录
+NO_RECORD = StatusRecord(0, IDLE)
+
+
+def parse_record(data: bytes) -> Optional[StatusRecord]:
+    """解析一行 "序号 状态 错误码 [脚本]"，格式不对时返回None"""
+    parts = data.decode('utf-8', errors='replace').strip().split(None, 3)
+    if len(parts) < 3 or parts[1] not in STATES:
+        return None
+    try:
+        seq, code = int(parts[0]), int(parts[2])
+    except ValueError:
+        return None
+    script = parts[3].strip().strip('"') if len(parts) > 3 else ""
+    return StatusRecord(seq, parts[1], code, script)
+
+
+class StatusReader:
+    """
+    读取监控窗口的状态记录
+
+    监控批处理每次更新状态时把一整行记录写入临时文件，再用 move /y 替换状态文件，
+    因此状态文件要么是旧记录，要么是新记录，不会读到写了一半或追加混在一起的内容。
+    读取时先比较序号，序号不变就直接返回上次解析的记录。
+
+    读取失败、记录损坏或序号倒退时返回None（状态未知），调用方应保持原来的状态，
+    不能当作空闲处理。
+    """
+
+    def __init__(self, status_file: Path):
+        self.status_file = Path(status_file)
+        self.temp_file = self.status_file.with_suffix('.tmp')
+        self.record = NO_RECORD  # 最近一次成功读取的记录
+
+    def read(self) -> Optional[StatusRecord]:
+        """读取当前记录；状态未知时返回None"""
+        try:
+            with open(self.status_file, 'rb') as f:
+                data = f.read(MAX_RECORD_SIZE)
+        except FileNotFoundError:
+            # 窗口启动时会删除旧的状态文件，写入第一条记录之前视为空闲
+            return self.record if self.record.seq == 0 else None
+        except OSError as e:
+            logger.debug(f"读取状态文件 {self.status_file} 出错: {e}")
+            return None
+
+        head = data.split(None, 1)
+        try:
+            if head and int(head[0]) == self.record.seq:
+                return self.record
+        except ValueError:
+            pass
+
+        record = parse_record(data)
+        if record is None or record.seq < self.record.seq:
+            logger.debug(f"状态文件 {self.status_file} 内容无效: {data[:80]!r}")
+            return None
+        self.record = record
+        return record
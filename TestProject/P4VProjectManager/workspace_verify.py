@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from content_cache import workspace_digest
+
+logger = logging.getLogger('P4VProjectManager')
+
+HAVE_FIELDS = 'depotFile,clientFile,haveRev,headType,fileSize,digest'
+
+
+@dataclass
+class HaveFile:
+    """have列表中的一个文件"""
+    depot_file: str
+    client_file: str
+    revision: str
+    file_type: str
+    size: int
+    digest: str  # 服务器上该版本内容的MD5
+
+    @property
+    def kind(self) -> Optional[str]:
+        """
+        校验方式：'binary' 按原始内容比较，'text' 在Windows上把CRLF换算为LF后比较；
+        关键字展开（+k）、unicode/utf16、符号链接等类型的本地内容与服务器的digest不可比，返回None（跳过）
+        """
+        base, _, modifiers = self.file_type.partition('+')
+        if 'k' in modifiers or base.startswith('k'):
+            return None
+        if base.endswith('text'):
+            return 'text'
+        if base.endswith('binary'):
+            return 'binary'
+        return None
+
+
+def parse_have_list(output: str) -> List[HaveFile]:
+    """解析 p4 -ztag fstat -Ol 的输出（记录之间以空行分隔）"""
+    files = []
+    record: Dict[str, str] = {}
+    for line in output.splitlines() + ['']:
+        if not line.strip():
+            if record.get('clientFile') and record.get('haveRev'):
+                files.append(HaveFile(record.get('depotFile', ''), record['clientFile'], record['haveRev'],
+                                      record.get('headType', ''), int(record.get('fileSize', 0) or 0),
+                                      record.get('digest', '').upper()))
+            record = {}
+            continue
+        if line.startswith('... '):
+            key, _, value = line[4:].partition(' ')
+            record[key] = value
+    return files
+
+
+def list_have_files(depot_path: str, cwd: Optional[str], env: Optional[Dict[str, str]],
+                    timeout: float = 600) -> List[HaveFile]:
+    """列出工作区中depot路径下已同步的文件及其digest"""
+    result = subprocess.run(f'p4 -ztag fstat -Ol -T {HAVE_FIELDS} "{depot_path}#have"', shell=True,
+                            capture_output=True, text=True, encoding='utf-8', cwd=cwd, env=env, timeout=timeout)
+    # 没有已同步的文件时p4返回非0并提示 no such file(s)
+    if result.returncode != 0 and result.stdout.strip() == '':
+        if 'no such file' in result.stderr or 'not in client view' in result.stderr:
+            return []
+        raise RuntimeError(result.stderr.strip())
+    return parse_have_list(result.stdout)
+
+
+def digest_workspace_files(items: List[Tuple[str, bool]]) -> Dict[str, str]:
+    """计算一批 (路径, 是否文本) 的MD5（模块级函数，可以在工作进程中执行），跳过无法读取的文件"""
+    digests = {}
+    for path, text in items:
+        try:
+            digests[path] = workspace_digest(path, text)
+        except OSError:
+            pass
+    return digests
+
+
+class WorkspaceIndex:
+    """
+    工作区文件索引 {本地路径: [大小, 修改时间(ns), MD5]}
+
+    文件的大小和修改时间都没有变化时直接使用记录的MD5，不重新读取文件。
+    """
+
+    def __init__(self, index_file: Path):
+        self.index_file = Path(index_file)
+        self.files: Dict[str, List] = {}
+        if self.index_file.exists():
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.files = json.load(f).get('files', {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"加载工作区索引失败，将重新计算所有文件: {e}")
+
+    def lookup(self, path: str, stat: os.stat_result) -> Optional[str]:
+        entry = self.files.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def update(self, path: str, stat: os.stat_result, digest: str):
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def retain(self, paths: List[str]):
+        """只保留仍在have列表中的文件"""
+        keep = set(paths)
+        self.files = {path: entry for path, entry in self.files.items() if path in keep}
+
+    def save(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_file, self.index_file)
+
+
+@dataclass
+class VerifySession:
+    """一次工作区校验"""
+    project_name: str
+    repair: bool
+    state: str = "running"  # running / done / error / cancelled
+    phase: str = "have"  # have（获取have列表）/ hash（比较文件）/ repair（重新同步）
+    files: int = 0  # have列表中的文件数
+    checked: int = 0  # 已比较的文件数
+    hashed: int = 0  # 重新计算MD5的文件数
+    cached: int = 0  # 使用索引中MD5的文件数
+    skipped: int = 0  # 无法校验的文件类型
+    missing: List[str] = field(default_factory=list)  # 缺失的文件 "//depot/file#rev"
+    modified: List[str] = field(default_factory=list)  # 内容与have版本不同的文件
+    repaired: int = 0
+    error: str = ""
+    start_time: float = field(default_factory=time.time)
+    end_time: float = 0
+
+    @property
+    def differences(self) -> List[str]:
+        return self.missing + self.modified
+
+    def summary(self) -> Dict:
+        """结果摘要（可以JSON序列化，文件列表只保留前20个）"""
+        return {
+            'state': self.state,
+            'phase': self.phase,
+            'files': self.files,
+            'checked': self.checked,
+            'hashed': self.hashed,
+            'cached': self.cached,
+            'skipped': self.skipped,
+            'missing': len(self.missing),
+            'modified': len(self.modified),
+            'repaired': self.repaired,
+            'sample': self.differences[:20],
+            'error': self.error,
+            'start_time': self.start_time,
+            'elapsed': (self.end_time or time.time()) - self.start_time
+        }
+
+
+class WorkspaceVerifier:
+    """
+    工作区校验和修复
+
+    把工作区中的文件与have列表（p4 fstat -Ol 给出的每个版本的大小和MD5）比较：大小和修改时间与索引记录相同的文件
+    直接使用记录的MD5，其余文件在执行器的工作进程中分批重新计算；修复时只对缺失或内容不同的文件执行
+    p4 sync -f，不需要强制重新同步整个工作区。不在have列表中的多余文件不处理。
+    """
+
+    def __init__(self, executor, index_dir: Path, batch_size: int = 256, timeout: float = 7200):
+        """
+        Args:
+            executor: 后台任务执行器（TaskExecutor）
+            index_dir: 工作区索引目录（每个项目一个文件）
+            batch_size: 每个哈希任务的文件数
+            timeout: 获取have列表和重新同步的超时时间（秒）
+        """
+        self.executor = executor
+        self.index_dir = Path(index_dir)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.sessions: Dict[str, VerifySession] = {}
+
+    def start(self, project_name: str, depot_path: str, local_path: str,
+              env: Optional[Dict[str, str]], server, repair: bool = True) -> VerifySession:
+        """
+        开始校验（在后台线程中执行）
+
+        Args:
+            project_name: 项目名称
+            depot_path: 项目的depot路径
+            local_path: 工作区目录
+            env: p4命令的环境变量（项目的服务器和工作区）
+            server: 项目所在的服务器（P4Server），p4命令计入其并发和速率限制
+            repair: 是否重新同步不一致的文件
+        """
+        session = VerifySession(project_name, repair)
+        self.sessions[project_name] = session
+        thread = threading.Thread(target=self.run, args=(session, depot_path, local_path, env, server),
+                                  name=f"verify-{project_name}", daemon=True)
+        thread.start()
+        return session
+
+    def run(self, session: VerifySession, depot_path: str, local_path: str,
+            env: Optional[Dict[str, str]], server):
+        index = WorkspaceIndex(self.index_dir / f"{session.project_name}.json")
+        try:
+            # p4 fstat 是子进程，主要在等待服务器，在io线程中执行，不占用哈希使用的工作进程
+            have_files = server.call(lambda: self.executor.submit(
+                'io', 'have_list', list_have_files, depot_path, local_path, env, self.timeout).result())
+            session.files = len(have_files)
+            session.phase = "hash"
+            self.compare(session, have_files, index)
+            index.retain([have.client_file for have in have_files])
+
+            if session.repair and session.differences and session.state == "running":
+                session.phase = "repair"
+                self.resync(session, local_path, env, server)
+                repaired = set(session.differences)
+                for have in have_files:
+                    if f"{have.depot_file}#{have.revision}" in repaired and have.kind:
+                        try:
+                            index.update(have.client_file, os.stat(have.client_file), have.digest)
+                        except OSError:
+                            pass
+            if session.state == "running":
+                session.state = "done"
+        except Exception as e:
+            session.state = "error"
+            session.error = str(e)
+        finally:
+            try:
+                index.save()
+            except OSError as e:
+                logger.warning(f"保存项目 {session.project_name} 的工作区索引失败: {e}")
+            session.end_time = time.time()
+
+    def compare(self, session: VerifySession, have_files: List[HaveFile], index: WorkspaceIndex):
+        """比较工作区文件与have版本：先用索引和文件大小判断，剩余的文件分批并行计算MD5"""
+        pending: Dict[str, Tuple[HaveFile, os.stat_result]] = {}
+        for have in have_files:
+            revision = f"{have.depot_file}#{have.revision}"
+            kind = have.kind
+            try:
+                stat = os.stat(have.client_file)
+            except OSError:
+                session.missing.append(revision)
+                session.checked += 1
+                continue
+            if kind is None:
+                session.skipped += 1
+                session.checked += 1
+                continue
+            digest = index.lookup(have.client_file, stat)
+            if digest is not None:
+                session.cached += 1
+                session.checked += 1
+                if digest != have.digest:
+                    session.modified.append(revision)
+            elif kind == 'binary' and have.size and stat.st_size != have.size:
+                # 二进制文件大小不同，不需要读取内容
+                session.checked += 1
+                session.modified.append(revision)
+            else:
+                pending[have.client_file] = (have, stat)
+
+        paths = list(pending)
+        batches = []
+        for start in range(0, len(paths), self.batch_size):
+            if session.state != "running":
+                return
+            items = [(path, pending[path][0].kind == 'text') for path in paths[start:start + self.batch_size]]
+            # 阻塞提交：执行器队列满时等待（反压）
+            batches.append((items, self.executor.submit('cpu', 'workspace_digest', digest_workspace_files, items)))
+
+        for items, future in batches:
+            if session.state != "running":
+                future.cancel()
+                continue
+            digests = future.result()
+            for path, _ in items:
+                have, stat = pending[path]
+                revision = f"{have.depot_file}#{have.revision}"
+                session.checked += 1
+                digest = digests.get(path)
+                if digest is None:
+                    session.missing.append(revision)
+                    continue
+                session.hashed += 1
+                index.update(path, stat, digest)
+                if digest != have.digest:
+                    session.modified.append(revision)
+
+    def resync(self, session: VerifySession, local_path: str, env: Optional[Dict[str, str]], server):
+        """只重新同步不一致的文件"""
+        list_file = self.index_dir / f"_repair_{session.project_name}.txt"
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        list_file.write_text('\n'.join(session.differences) + '\n', encoding='utf-8')
+        try:
+            result = server.call(subprocess.run, f'p4 -x "{list_file}" sync -f', shell=True,
+                                 capture_output=True, text=True, cwd=local_path, env=env, timeout=self.timeout)
+        finally:
+            list_file.unlink()
+        if result.returncode != 0:
+            raise RuntimeError(f"重新同步失败: {result.stderr.strip()}")
+        session.repaired = len(session.differences)
+
+    def cancel(self, project_name: str):
+        session = self.sessions.get(project_name)
+        if session and session.state == "running":
+            session.state = "cancelled"
+
+    def finished(self) -> List[Tuple[str, VerifySession]]:
+        """取出已结束的校验"""
+        done = [(name, session) for name, session in self.sessions.items() if session.end_time]
+        for name, _ in done:
+            del self.sessions[name]
+        return done
+
+    def describe(self) -> List[str]:
+        """正在进行的校验的文字描述"""
+        descriptions = []
+        for name, session in self.sessions.items():
+            if session.phase == "have":
+                descriptions.append(f"{name} (获取have列表)")
+            elif session.phase == "hash":
+                descriptions.append(f"{name} ({session.checked}/{session.files} 个文件, "
+                                    f"不一致 {len(session.differences)})")
+            else:
+                descriptions.append(f"{name} (重新同步 {len(session.differences)} 个文件)")
+        return descriptions